@@ -4,6 +4,13 @@ from model.elb import ELB
 from util.ssh import SSHConnector
 from util.utils import *
 from util.decorators import *
+from util.executor import DAGExecutor
+from util.session import get_client
+from util.ratelimit import limiter
+from util.trace import tracer
+from util.waiter import wait_for
+from util.state import BuildState
+from util.cache import cache
 
 
 class DefaultBuilder:
@@ -26,11 +33,14 @@ class DefaultBuilder:
         pem_key_path: key pair path
         alb_name: load balancer name
         tgr: target group name
+        max_workers: number of build steps to run at once(default: 8)
+        ssh_workers: number of web servers to provision at once through bastion(default: 5)
+        state_path: build state file, finished steps are skipped on rerun(default: None, {vpc_name}-state.json)
     """
     def __init__(self, region, vpc_cidr, vpc_name,
                  pub_sub_num, pri_sub_num, ami, bastion_subnet,
                  bastion_name, pem_key_name, web_inbound_list,
-                 user_name, pem_key_path, alb_name, tgr_name):
+                 user_name, pem_key_path, alb_name, tgr_name, max_workers=8, ssh_workers=5, state_path=None):
 
         self.web_list = []
 
@@ -49,38 +59,107 @@ class DefaultBuilder:
         self.pem_key_path = pem_key_path
         self.alb_name = alb_name
         self.tgr_name = tgr_name
+        self.max_workers = max_workers
+        self.ssh_workers = ssh_workers
+
+        self.elb = ELB(region=region)
+        self.state = BuildState(state_path or "{}-state.json".format(vpc_name),
+                                config={"region": region, "vpc_name": vpc_name, "vpc_cidr": vpc_cidr})
 
     def _set_vpc(self):
-        """Create VPC resources(subnet, routing table, internet gateway, NAT)"""
-        default_vpc = DefaultVPC(region=self.region) \
-            .create_VPC(cidr_block=self.vpc_cidr, vpc_name=self.vpc_name) \
-            .create_sub(pub_sub_num=self.pub_sub_num, pri_sub_num=self.pri_sub_num) \
-            .create_ig() \
-            .set_ig_rtb() \
-            .create_nat() \
-            .set_nat_rtb()
+        """Create VPC"""
+        self.default_vpc = DefaultVPC(region=self.region) \
+            .create_VPC(cidr_block=self.vpc_cidr, vpc_name=self.vpc_name)
 
-        self.default_vpc = default_vpc
+        return {"vpc": [self.default_vpc.vpc.id]}
 
-    def _set_bastion_ec2(self):
-        """Create bastion EC2 on public subnet"""
-        default_ec2 = DefaultEc2(region=self.region, vpc_id=self.default_vpc.vpc.id)
+    def _restore_vpc(self, resources):
+        self.default_vpc = DefaultVPC(region=self.region) \
+            .load_VPC(resources["vpc"][0], cidr_block=self.vpc_cidr)
+
+    def _set_subnets(self):
+        """Create public and private subnets"""
+        self.default_vpc.create_sub(pub_sub_num=self.pub_sub_num, pri_sub_num=self.pri_sub_num)
+
+        return {"subnet:public": [sub.id for sub in self.default_vpc.pub_sub_list],
+                "subnet:private": [sub.id for sub in self.default_vpc.pri_sub_list]}
+
+    def _restore_subnets(self, resources):
+        ec2 = self.default_vpc.ec2
+        self.default_vpc.pub_sub_list = [ec2.Subnet(subnet_id) for subnet_id in resources["subnet:public"]]
+        self.default_vpc.pri_sub_list = [ec2.Subnet(subnet_id) for subnet_id in resources["subnet:private"]]
+
+    def _set_ig(self):
+        """Create internet gateway and attach on VPC"""
+        self.default_vpc.create_ig()
+
+        return {"internet_gateway": [self.default_vpc.ig.id]}
+
+    def _restore_ig(self, resources):
+        self.default_vpc.ig = self.default_vpc.ec2.InternetGateway(resources["internet_gateway"][0])
+
+    def _set_ig_rtb(self):
+        """Route public subnets to internet gateway"""
+        self.default_vpc.set_ig_rtb()
+
+        return {"route_table": [self.default_vpc.ig_rtb.id]}
+
+    def _set_nat(self):
+        """Create NAT Gateway and route private subnets to it"""
+        self.default_vpc.create_nat().set_nat_rtb()
+
+        return {"nat_gateway": [self.default_vpc.nat["NatGateway"]["NatGatewayId"]],
+                "route_table": [self.default_vpc.nat_rtb.id]}
 
-        ### make bastion
+    def _restore_nat(self, resources):
+        self.default_vpc.nat = {"NatGateway": {"NatGatewayId": resources["nat_gateway"][0]}}
+
+    def _set_ec2(self):
+        """Create EC2 helper on VPC and key pair"""
+        default_ec2 = DefaultEc2(region=self.region, vpc_id=self.default_vpc.vpc.id)
         default_ec2.create_pem_key(pem_key_name=self.pem_key_name)
 
-        bastion_sg = default_ec2.create_sg(group_name="Bastion-SG")
+        self.default_ec2 = default_ec2
+
+        return {"key_pair": [self.pem_key_name]}
+
+    def _restore_ec2(self, resources):
+        self.default_ec2 = DefaultEc2(region=self.region, vpc_id=self.default_vpc.vpc.id)
+
+    def _set_bastion_sg(self):
+        """Create bastion security group"""
+        self.bastion_sg = self.default_ec2.create_sg(group_name="Bastion-SG")
+
+        return {"security_group": [self.bastion_sg.id]}
 
+    def _restore_bastion_sg(self, resources):
+        self.bastion_sg = self.default_ec2.ec2.SecurityGroup(resources["security_group"][0])
+
+    def _set_web_sg(self):
+        """Create web server security group"""
+        self.web_sg = self.default_ec2.create_sg(group_name="web-SG", inbound_list=self.web_inbound_list)
+
+        return {"security_group": [self.web_sg.id]}
+
+    def _restore_web_sg(self, resources):
+        self.web_sg = self.default_ec2.ec2.SecurityGroup(resources["security_group"][0])
+
+    def _set_bastion_ec2(self):
+        """Create bastion EC2 on public subnet"""
         subnet_id = self.default_vpc.pub_sub_list[self.bastion_subnet].id
-        bastion = default_ec2.create_ec2(ec2_name=self.bastion_name,
-                                         subnet_id=subnet_id,
-                                         sg_id_list=[bastion_sg.id],
-                                         pem_key_name=self.pem_key_name,
-                                         associate_p_ip=True,
-                                         image_id=self.ami)
+        bastion = self.default_ec2.create_ec2(ec2_name=self.bastion_name,
+                                              subnet_id=subnet_id,
+                                              sg_id_list=[self.bastion_sg.id],
+                                              pem_key_name=self.pem_key_name,
+                                              associate_p_ip=True,
+                                              image_id=self.ami)
 
         self.bastion = bastion[0]
-        self.default_ec2 = default_ec2
+
+        return {"instance": [self.bastion.id]}
+
+    def _restore_bastion_ec2(self, resources):
+        self.bastion = self.default_ec2.ec2.Instance(resources["instance"][0])
 
     def _set_web_ec2(self):
         """
@@ -88,18 +167,17 @@ class DefaultBuilder:
         If you have 2 private subnets, then this function will build a EC2 each
         """
         ### make web server on private subnet
-        self.web_sg = self.default_ec2.create_sg(group_name="web-SG", inbound_list=self.web_inbound_list)
+        placements = [(subnet.id, "WEB-{}".format(i)) for i, subnet in enumerate(self.default_vpc.pri_sub_list)]
+        self.web_list = self.default_ec2.create_ec2_fleet(placements=placements,
+                                                          sg_id_list=[self.web_sg.id],
+                                                          pem_key_name=self.pem_key_name,
+                                                          associate_p_ip=False,
+                                                          image_id=self.ami)
 
-        subnet_list = self.default_vpc.pri_sub_list
-        for i in range(len(subnet_list)):
-            web = self.default_ec2.create_ec2(ec2_name="WEB-{}".format(i),
-                                              subnet_id=subnet_list[i].id,
-                                              sg_id_list=[self.web_sg.id],
-                                              pem_key_name=self.pem_key_name,
-                                              associate_p_ip=False,
-                                              image_id=self.ami)
+        return {"instance": [web.id for web in self.web_list]}
 
-            self.web_list.append(web[0])
+    def _restore_web_ec2(self, resources):
+        self.web_list = [self.default_ec2.ec2.Instance(instance_id) for instance_id in resources["instance"]]
 
     @Printer(pre="ec2 instances", post="Created ec2 instances")
     def _check_ec2(self):
@@ -108,61 +186,142 @@ class DefaultBuilder:
         for web in self.web_list:
             all_instance_ids.append(web.id)
 
-        self.default_ec2.ec2_client.get_waiter("instance_status_ok") \
-            .wait(InstanceIds=all_instance_ids)
+        wait_for(self.default_ec2.ec2_client, "instance_status_ok", all_instance_ids)
 
     def _install_nginx(self):
-        """Connect to web server on private subnet and install nginx server"""
+        """Connect to web servers on private subnet through bastion and install nginx server at once"""
         ssh = SSHConnector(region=self.region)
+        web_ids = [web.id for web in self.web_list]
+        # bastion and web servers in one describe call
+        cache.prefetch(self.default_ec2.ec2_client, "instance", web_ids + [self.bastion.id])
 
-        for web in self.web_list:
-            with ssh.tunneling(host=get_ip(ssh.ec2, self.bastion.id, True),
-                               host_port=22,
-                               user=self.user_name,
-                               pem_key_path=self.pem_key_path,
-                               remote_ip=get_ip(ssh.ec2, web.id, False),
-                               remote_port=22) as tunnel:
-                tunnel.start()
-                ssh.connect_ssh(ip_address="127.0.0.1", port=10022, pem_key_path=self.pem_key_path)
-                ssh.command_delivery("sudo amazon-linux-extras install nginx1 -y && sudo service nginx start")
-                tunnel.stop()
+        results = ssh.run_parallel(target_ips=get_ips(self.default_ec2.ec2_client, web_ids, False),
+                                   commands="sudo amazon-linux-extras install nginx1 -y && sudo service nginx start",
+                                   pem_key_path=self.pem_key_path,
+                                   user=self.user_name,
+                                   bastion_ip=get_ip(ssh.ec2, self.bastion.id, True),
+                                   max_workers=self.ssh_workers)
+        ssh.print_results(results)
+
+        failed = [r.host for r in results if not r.ok]
+        if failed:
+            raise RuntimeError("nginx install failed on {}".format(", ".join(failed)))
 
     def _set_alb(self):
+        """Create application load balancer(needs only subnets and web security group)"""
+        pub_sub_list = [sub.id for sub in self.default_vpc.pub_sub_list]
+        elb_response = self.elb.create_elb(elb_name=self.alb_name,
+                                           subnet_list=pub_sub_list,
+                                           sg_list=[self.web_sg.id])
+        self.elb_response = elb_response
+        self.elb_arn = elb_response['LoadBalancers'][0]['LoadBalancerArn']
+
+        return {"load_balancer": [self.elb_arn]}
+
+    def _restore_alb(self, resources):
+        self.elb_arn = resources["load_balancer"][0]
+        self.elb_response = self.elb.elb_client.describe_load_balancers(LoadBalancerArns=[self.elb_arn])
+
+    def _set_tgr(self):
+        """Create target group"""
+        tgr_response = self.elb.create_tgr(tgr_name=self.tgr_name,
+                                           vpc_id=self.default_vpc.vpc.id)
+        self.tgr_arn = tgr_response['TargetGroups'][0]['TargetGroupArn']
+
+        return {"target_group": [self.tgr_arn]}
+
+    def _restore_tgr(self, resources):
+        self.tgr_arn = resources["target_group"][0]
+
+    def _register_targets(self):
+        """Register web servers to target group(instances must be running)"""
+        target_list = [web.id for web in self.web_list]
+        self.elb.register_targets(targets=target_list, tgr_arn=self.tgr_arn)
+
+    def _set_listener(self):
+        """Register target group to load balancer"""
+        self.elb.create_listener(elb_arn=self.elb_arn, tgr_arn=self.tgr_arn)
+
+        print("DNS is : {}".format(self.elb_response["LoadBalancers"][0]["DNSName"]))
+
+    def _resumable(self, name, run, restore=None):
         """
-        Create application load balancer and target group
-        Register target and Listener
+        Make step function that is skipped when state has it finished
+
+        :param name: step name
+        :param run: step function(returns created resources or None)
+        :param restore: function to rebuild objects from recorded resources(default: None)
+        :return: step function
         """
-        elb = ELB(region=self.region)
+        def step():
+            if self.state.is_done(name):
+                if restore is not None:
+                    restore(self.state.resources(name))
+                return "skipped"
 
-        ### create ELB
-        pub_sub_list = [sub.id for sub in self.default_vpc.pub_sub_list]
-        elb_response = elb.create_elb(elb_name=self.alb_name,
-                                      subnet_list=pub_sub_list,
-                                      sg_list=[self.web_sg.id])
-        elb_arn = elb_response['LoadBalancers'][0]['LoadBalancerArn']
+            self.state.complete(name, run())
 
-        ### create target group
-        tgr_response = elb.create_tgr(tgr_name=self.tgr_name,
-                                      vpc_id=self.default_vpc.vpc.id)
-        tgr_arn = tgr_response['TargetGroups'][0]['TargetGroupArn']
+        return step
 
-        ### register targets to target group
-        target_list = [web.id for web in self.web_list]
-        elb.register_targets(targets=target_list, tgr_arn=tgr_arn)
+    def _graph(self):
+        """
+        Build dependency graph of build steps
+        - NAT Gateway waiter only blocks the steps that need internet from private subnets
+        - NAT Gateway is created after the internet gateway is attached(a public NAT Gateway fails without it)
+        - Steps finished in state file restore their objects instead of creating resources
+        """
+        return DAGExecutor(max_workers=self.max_workers) \
+            .add("vpc", self._resumable("vpc", self._set_vpc, self._restore_vpc)) \
+            .add("subnets", self._resumable("subnets", self._set_subnets, self._restore_subnets), requires=["vpc"]) \
+            .add("ig", self._resumable("ig", self._set_ig, self._restore_ig), requires=["vpc"]) \
+            .add("ig_rtb", self._resumable("ig_rtb", self._set_ig_rtb), requires=["subnets", "ig"]) \
+            .add("nat", self._resumable("nat", self._set_nat, self._restore_nat), requires=["subnets", "ig"]) \
+            .add("key_pair", self._resumable("key_pair", self._set_ec2, self._restore_ec2), requires=["vpc"]) \
+            .add("bastion_sg", self._resumable("bastion_sg", self._set_bastion_sg, self._restore_bastion_sg),
+                 requires=["key_pair"]) \
+            .add("web_sg", self._resumable("web_sg", self._set_web_sg, self._restore_web_sg),
+                 requires=["key_pair"]) \
+            .add("bastion", self._resumable("bastion", self._set_bastion_ec2, self._restore_bastion_ec2),
+                 requires=["subnets", "bastion_sg"]) \
+            .add("web", self._resumable("web", self._set_web_ec2, self._restore_web_ec2),
+                 requires=["subnets", "web_sg"]) \
+            .add("check_ec2", self._resumable("check_ec2", self._check_ec2), requires=["bastion", "web"]) \
+            .add("nginx", self._resumable("nginx", self._install_nginx), requires=["check_ec2", "ig_rtb", "nat"]) \
+            .add("alb", self._resumable("alb", self._set_alb, self._restore_alb), requires=["subnets", "ig", "web_sg"]) \
+            .add("tgr", self._resumable("tgr", self._set_tgr, self._restore_tgr), requires=["vpc"]) \
+            .add("targets", self._resumable("targets", self._register_targets), requires=["tgr", "check_ec2"]) \
+            .add("listener", self._resumable("listener", self._set_listener), requires=["alb", "tgr"])
 
-        ### register target group to elb
-        elb.create_listener(elb_arn=elb_arn, tgr_arn=tgr_arn)
+    def build(self, trace_prefix=None):
+        """
+        Build default infrastructure(independent steps run concurrently)
 
-        print("DNS is : {}".format(elb_response["LoadBalancers"][0]["DNSName"]))
+        :param trace_prefix: save trace to {prefix}-trace.json and {prefix}-chrome.json(default: None)
+        :return: self
+        """
+        executor = self._graph()
+        if self.state.resumed:
+            reset = self.state.reconcile(ec2_client=get_client("ec2", self.region),
+                                         elb_client=self.elb.elb_client,
+                                         requires={name: step.requires for name, step in executor.steps.items()})
+            done = [name for name in executor.steps if self.state.is_done(name)]
+            print("Resuming build from state file {}: {} of {} steps done, rebuild: {}".format(
+                self.state.path, len(done), len(executor.steps), ", ".join(reset) or "none"))
+        else:
+            print("New build, state file: {}".format(self.state.path))
+        try:
+            with tracer.span("build", kind="build"):
+                executor.run()
+        finally:
+            executor.print_summary()
+            limiter.print_summary()
+            cache.print_summary()
+            tracer.print_summary()
+            if trace_prefix:
+                tracer.save("{}-trace.json".format(trace_prefix))
+                tracer.save_chrome("{}-chrome.json".format(trace_prefix))
 
-    def build(self):
-        """Build default infrastructure"""
-        self._set_vpc()
-        self._set_bastion_ec2()
-        self._set_web_ec2()
-        self._check_ec2()
-        self._install_nginx()
-        self._set_alb()
+        return self
 
 
 if __name__ == '__main__':
@@ -194,4 +353,4 @@ if __name__ == '__main__':
                    pem_key_name=pem_key_name, web_inbound_list=web_inbound_list,
                    user_name=user_name, pem_key_path=pem_key_path, alb_name=alb_name,
                    tgr_name=tgr_name) \
-        .build()
+        .build(trace_prefix="build")
@@ -0,0 +1,643 @@
+from model.ec2 import DefaultEc2
+from model.vpc import DefaultVPC
+from model.elb import ELB
+from tools.cleaner.discovery import VPCInventory, paginate
+from util.executor import DAGExecutor
+from util.session import get_client
+from util.ratelimit import limiter
+from util.utils import name_tag_spec
+from util.cidr import CIDRPlanner, availability_zones, az_suffix
+from util.sg_rules import RuleSet, submit
+import json
+import re
+import sys
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+DEFAULT_AMI = "ami-077e31c4939f6a2f3"
+DEFAULT_INSTANCE_TYPE = "t2.micro"
+DEFAULT_INBOUND = [{"cidr": "0.0.0.0/0", "protocol": "tcp", "f_port": 22, "t_port": 22}]
+
+
+def load_spec(path):
+    """
+    Load infrastructure spec(.json, or .yaml/.yml if PyYAML is installed)
+
+    :param path: spec file path
+    :return: normalized spec dict
+    """
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ImportError("PyYAML is required for yaml spec files(pip install pyyaml)")
+            data = yaml.safe_load(f)
+        else:
+            data = json.load(f)
+
+    return normalize_spec(data)
+
+
+def normalize_spec(data):
+    """
+    Fill default values of spec and check required keys
+
+    :param data: spec dict
+    :return: normalized spec dict
+    """
+    for key in ("region", "vpc"):
+        if key not in data:
+            raise ValueError("spec requires '{}'".format(key))
+
+    spec = dict(data)
+    spec["vpc"] = dict({"name": "TEST-VPC", "cidr": "10.0.0.0/16"}, **data["vpc"])
+    spec["subnets"] = dict({"public": 2, "private": 2, "prefix": None}, **data.get("subnets", {}))
+    spec.setdefault("nat_gateway", spec["subnets"]["private"] > 0)
+    spec.setdefault("key_pair", None)
+    spec.setdefault("ami", DEFAULT_AMI)
+    spec.setdefault("instance_type", DEFAULT_INSTANCE_TYPE)
+    spec["security_groups"] = [dict({"description": "None", "ingress": DEFAULT_INBOUND}, **group)
+                               for group in data.get("security_groups", [])]
+    spec["instances"] = [dict({"subnet": "private", "index": 0, "per_subnet": False, "security_groups": [],
+                               "public_ip": False}, **instance)
+                         for instance in data.get("instances", [])]
+    for instance in spec["instances"]:
+        if instance["subnet"] not in ("public", "private"):
+            raise ValueError("instance {} subnet must be public or private".format(instance["name"]))
+    spec.setdefault("load_balancer", None)
+
+    if spec["nat_gateway"] and spec["subnets"]["public"] < 1:
+        raise ValueError("nat_gateway needs at least one public subnet")
+    for instance in spec["instances"]:
+        if instance["per_subnet"]:
+            continue
+        count = spec["subnets"][instance["subnet"]]
+        if not 0 <= instance["index"] < count:
+            raise ValueError("instance {} index {} is out of {} {} subnets".format(
+                instance["name"], instance["index"], count, instance["subnet"]))
+
+    return spec
+
+
+def _name(item):
+    return next((tag["Value"] for tag in item.get("Tags", []) if tag["Key"] == "Name"), None)
+
+
+def _instance_groups(instance):
+    """Security groups of primary network interface(the groups `modify_instance_attribute` changes)"""
+    for eni in instance.get("NetworkInterfaces", []):
+        if eni.get("Attachment", {}).get("DeviceIndex") == 0:
+            return eni.get("Groups", [])
+
+    return instance.get("SecurityGroups", [])
+
+
+class Change:
+    """
+    This class is one planned change
+
+    Init
+        key: unique key in plan(ex. "subnet:PriSub-3a")
+        action: create, update or delete
+        description: printed description
+        func: callable to apply change
+        requires: change keys to finish before(keys not in plan are ignored)
+    """
+    def __init__(self, key, action, description, func, requires=None):
+        self.key = key
+        self.action = action
+        self.description = description
+        self.func = func
+        self.requires = list(requires or [])
+
+
+class SpecPlanner:
+    """
+    This class diff a declarative spec against the live VPC and apply only the delta
+    - Live VPC is found by Name tag and discovered in one paginated pass(`VPCInventory`)
+    - Resources are matched by Name tag(security groups by group name, ALB and target group by name)
+    - Matched instances are diffed too: other ami, instance type or public ip replaces a running instance,
+      other security groups are changed in place, ALB security groups and listener port are updated in place
+    - Other attributes(subnet CIDRs, route targets, NAT subnet, target group port ...) are matched by presence only
+    - Failed NAT Gateways and shutting-down instances are treated as missing and created again
+    - Subnets are named like `DefaultBuilder`(PubSub-1a, PriSub-1a ...), new subnets use the lowest free /24
+      (existing subnets are matched by kind and number, names from older zone layouts are kept)
+    - Changes run on the DAG executor, independent changes run at once
+    - Extra resources(subnets, instances, rules, targets) are deleted only with `prune`
+
+    Init
+        spec: normalized spec(`load_spec`, `normalize_spec`)
+        max_workers: changes to apply at once(default: 8)
+    """
+    def __init__(self, spec, max_workers=8):
+        self.spec = spec
+        self.region = spec["region"]
+        self.max_workers = max_workers
+        self.ec2_client = get_client("ec2", self.region)
+        self.elb = ELB(region=self.region)
+        self.elb_client = self.elb.elb_client
+
+        self.inventory = None
+        self.vpc_id = None
+        self.changes = []
+        self.notes = []
+        # live resource ids, filled by discovery and by applied changes
+        self.subnet_ids = {}
+        self.subnet_cidrs = []
+        self.sg_ids = {}
+        self.instance_ids = {}
+        self.instances = {}
+        self.replaced = set()
+        self.igw_id = None
+        self.ig_rtb_id = None
+        self.nat_rtb_id = None
+        self.nat_id = None
+        self.alb = None
+        self.tgr = None
+        self.listeners = {}
+        self.target_ids = set()
+
+    ###############
+    # Discovery
+    ###############
+    def discover(self):
+        """
+        Find VPC by Name tag and discover its resources
+
+        :return: self
+        """
+        vpcs = paginate(self.ec2_client, "describe_vpcs", "Vpcs",
+                        Filters=[{"Name": "tag:Name", "Values": [self.spec["vpc"]["name"]]}])
+        if len(vpcs) > 1:
+            raise ValueError("{} VPCs are named {}".format(len(vpcs), self.spec["vpc"]["name"]))
+        if not vpcs:
+            return self
+
+        self.vpc_id = vpcs[0]["VpcId"]
+        inventory = self.inventory = VPCInventory(vpc_id=self.vpc_id, ec2_client=self.ec2_client,
+                                                  elb_client=self.elb_client).discover()
+
+        for subnet in inventory.subnets:
+            self.subnet_ids[_name(subnet)] = subnet["SubnetId"]
+            self.subnet_cidrs.append(subnet["CidrBlock"])
+        self.sg_ids = {group["GroupName"]: group["GroupId"] for group in inventory.security_groups}
+        for instance in inventory.instances:
+            if instance["State"]["Name"] == "shutting-down":
+                continue
+            self.instance_ids.setdefault(_name(instance), []).append(instance["InstanceId"])
+            self.instances[instance["InstanceId"]] = instance
+        if inventory.internet_gateways:
+            self.igw_id = inventory.internet_gateways[0]["InternetGatewayId"]
+        for rt in inventory.route_tables:
+            if _name(rt) == "IG-RTB":
+                self.ig_rtb_id = rt["RouteTableId"]
+            elif _name(rt) == "NAT-RTB":
+                self.nat_rtb_id = rt["RouteTableId"]
+        nat_gateways = [nat for nat in inventory.nat_gateways if nat["State"] != "failed"]
+        if nat_gateways:
+            self.nat_id = nat_gateways[0]["NatGatewayId"]
+
+        lb_spec = self.spec["load_balancer"]
+        if lb_spec:
+            self.alb = next((lb for lb in inventory.load_balancers if lb["LoadBalancerName"] == lb_spec["name"]),
+                            None)
+            self.tgr = next((tgr for tgr in inventory.target_groups
+                             if tgr["TargetGroupName"] == lb_spec["target_group"]), None)
+            if self.alb:
+                listeners = self.elb_client.describe_listeners(LoadBalancerArn=self.alb["LoadBalancerArn"])
+                self.listeners = {listener["Port"]: listener["ListenerArn"] for listener in listeners["Listeners"]}
+            if self.tgr:
+                health = self.elb_client.describe_target_health(TargetGroupArn=self.tgr["TargetGroupArn"])
+                self.target_ids = set(target["Target"]["Id"] for target in health["TargetHealthDescriptions"])
+
+        return self
+
+    def _route_table_subnets(self, rt_id):
+        if self.inventory is None:
+            return set()
+        for rt in self.inventory.route_tables:
+            if rt["RouteTableId"] == rt_id:
+                return set(rta.get("SubnetId") for rta in rt.get("Associations", []))
+        return set()
+
+    ###############
+    # Desired state
+    ###############
+    def _desired_subnets(self):
+        """
+        Get [(name, public)] in spec order(spread over all available zones like `DefaultVPC.create_sub`)
+        Existing subnets are matched by kind and number and keep their name and zone
+        (ex. PriSub-2c of a stack built with a/c zones stays, PriSub-2b is not added)
+        """
+        existing = {}
+        for name in self.subnet_ids:
+            match = re.match(r"^(PubSub|PriSub)-(\d+)[a-z]*$", name or "")
+            if match:
+                existing.setdefault((match.group(1), int(match.group(2))), name)
+
+        zones = availability_zones(self.ec2_client, self.region)
+        subnets = []
+        for kind, count, public in (("PubSub", self.spec["subnets"]["public"], True),
+                                    ("PriSub", self.spec["subnets"]["private"], False)):
+            for i in range(count):
+                name = existing.get((kind, i + 1)) or \
+                    "{}-{}{}".format(kind, i + 1, az_suffix(zones[i % len(zones)], self.region))
+                subnets.append((name, public))
+
+        return subnets
+
+    def _desired_instances(self):
+        """Get {instance name: (subnet name, instance spec)}"""
+        public = [name for name, is_public in self._desired_subnets() if is_public]
+        private = [name for name, is_public in self._desired_subnets() if not is_public]
+        instances = {}
+        for instance in self.spec["instances"]:
+            subnets = public if instance["subnet"] == "public" else private
+            if instance["per_subnet"]:
+                for i, subnet_name in enumerate(subnets):
+                    instances[instance["name"].format(i=i)] = (subnet_name, instance)
+            else:
+                instances[instance["name"]] = (subnets[instance["index"]], instance)
+
+        return instances
+
+    def _free_cidrs(self, count):
+        """Get lowest free blocks of VPC(block 0 is not used, like `DefaultBuilder`)"""
+        planner = CIDRPlanner(self.spec["vpc"]["cidr"], existing=self.subnet_cidrs)
+
+        return planner.allocate_many(count, self.spec["subnets"]["prefix"])
+
+    ###############
+    # Plan
+    ###############
+    def _add(self, key, action, description, func, requires=None):
+        self.changes.append(Change(key, action, description, func, requires))
+
+    def plan(self, prune=False):
+        """
+        Diff spec against discovered VPC
+
+        :param prune: delete resources that are not in spec
+        :return: Change list
+        """
+        self.changes = []
+        self.notes = []
+        spec = self.spec
+
+        if self.vpc_id is None:
+            self._add("vpc", "create", "VPC {} {}".format(spec["vpc"]["name"], spec["vpc"]["cidr"]), self._create_vpc)
+
+        # subnets
+        subnets = self._desired_subnets()
+        missing = [(name, public) for name, public in subnets if name not in self.subnet_ids]
+        for (name, public), cidr in zip(missing, self._free_cidrs(len(missing))):
+            self._add("subnet:{}".format(name), "create", "subnet {} {}".format(name, cidr),
+                      lambda name=name, cidr=cidr: self._create_subnet(name, cidr), requires=["vpc"])
+        pub_names = [name for name, public in subnets if public]
+        pri_names = [name for name, public in subnets if not public]
+
+        # internet gateway and public routes
+        if pub_names:
+            if self.igw_id is None:
+                self._add("igw", "create", "internet gateway", self._create_igw, requires=["vpc"])
+            subnet_keys = ["subnet:{}".format(name) for name in pub_names]
+            if self.ig_rtb_id is None:
+                self._add("ig_rtb", "create", "IG-RTB for {} public subnets".format(len(pub_names)),
+                          lambda: self._create_route_table("IG-RTB", pub_names, gateway=True),
+                          requires=["igw"] + subnet_keys)
+            else:
+                unassociated = [name for name in pub_names if name not in self.subnet_ids
+                                or self.subnet_ids[name] not in self._route_table_subnets(self.ig_rtb_id)]
+                if unassociated:
+                    self._add("ig_rtb", "update", "associate {} to IG-RTB".format(", ".join(unassociated)),
+                              lambda: self._associate(self.ig_rtb_id, unassociated), requires=subnet_keys)
+
+        # NAT Gateway and private routes
+        if spec["nat_gateway"] and pri_names:
+            subnet_keys = ["subnet:{}".format(name) for name in pri_names]
+            if self.nat_id is None:
+                self._add("nat", "create", "NAT Gateway on {}".format(pub_names[min(1, len(pub_names) - 1)]),
+                          lambda: self._create_nat(pub_names[min(1, len(pub_names) - 1)]),
+                          requires=["subnet:{}".format(name) for name in pub_names] + ["ig_rtb"])
+            if self.nat_rtb_id is None:
+                self._add("nat_rtb", "create", "NAT-RTB for {} private subnets".format(len(pri_names)),
+                          lambda: self._create_route_table("NAT-RTB", pri_names, gateway=False),
+                          requires=["nat"] + subnet_keys)
+            else:
+                if self.nat_id is None:
+                    # NAT Gateway is created again(ex. old one failed), default route moves to it
+                    self._add("nat_route", "update", "NAT-RTB default route to new NAT Gateway",
+                              lambda: self.ec2_client.replace_route(RouteTableId=self.nat_rtb_id,
+                                                                    DestinationCidrBlock="0.0.0.0/0",
+                                                                    NatGatewayId=self.nat_id),
+                              requires=["nat"])
+                unassociated = [name for name in pri_names if name not in self.subnet_ids
+                                or self.subnet_ids[name] not in self._route_table_subnets(self.nat_rtb_id)]
+                if unassociated:
+                    self._add("nat_rtb", "update", "associate {} to NAT-RTB".format(", ".join(unassociated)),
+                              lambda: self._associate(self.nat_rtb_id, unassociated), requires=subnet_keys)
+
+        # key pair
+        key_name = spec["key_pair"]
+        if key_name and (self.inventory is None or key_name not in self.inventory.key_pairs):
+            existing = self.ec2_client.describe_key_pairs(
+                Filters=[{"Name": "key-name", "Values": [key_name]}])["KeyPairs"]
+            if not existing:
+                self._add("key_pair", "create", "key pair {}".format(key_name), self._create_key_pair,
+                          requires=["vpc"])
+
+        # security groups and rules
+        existing_groups = {group["GroupName"]: group for group in (self.inventory.security_groups
+                                                                   if self.inventory else [])}
+        for group in spec["security_groups"]:
+            desired = RuleSet(group["ingress"])
+            key = "sg:{}".format(group["name"])
+            if group["name"] not in existing_groups:
+                self._add(key, "create", "security group {} ({} rules)".format(group["name"], len(desired)),
+                          lambda group=group: self._create_sg(group), requires=["vpc"])
+                continue
+            current = RuleSet.from_permissions(existing_groups[group["name"]].get("IpPermissions", []))
+            add, revoke = desired.diff(current)
+            if not prune:
+                revoke = RuleSet()
+            if add or revoke:
+                self._add(key, "update", "security group {} +{} -{} rules".format(group["name"], len(add), len(revoke)),
+                          lambda group=group, add=add, revoke=revoke: self._update_sg_rules(group["name"], add, revoke))
+
+        # instances
+        desired_instances = self._desired_instances()
+        self.replaced = set()
+        for name, (subnet_name, instance) in desired_instances.items():
+            requires = ["subnet:{}".format(subnet_name), "key_pair"] + \
+                       ["sg:{}".format(group) for group in instance["security_groups"]]
+            if name not in self.instance_ids:
+                self._add("instance:{}".format(name), "create", "instance {} on {}".format(name, subnet_name),
+                          lambda name=name, subnet_name=subnet_name, instance=instance:
+                          self._create_instance(name, subnet_name, instance), requires=requires)
+                continue
+
+            replace, update_groups = self._instance_diff(name, self.instance_ids[name], instance)
+            if replace:
+                self.replaced.add(name)
+                self._add("instance:{}".format(name), "replace",
+                          "instance {} ({})".format(name, ", ".join(replace)),
+                          lambda name=name, subnet_name=subnet_name, instance=instance:
+                          self._replace_instance(name, subnet_name, instance), requires=requires)
+            elif update_groups:
+                self._add("instance:{}".format(name), "update", "security groups of instance {}".format(name),
+                          lambda name=name, instance=instance: self._set_instance_groups(name, instance),
+                          requires=requires)
+        if prune:
+            patterns = [re.compile("^{}$".format(re.escape(instance["name"]).replace(re.escape("{i}"), r"\d+")))
+                        for instance in spec["instances"]]
+            for name, ids in self.instance_ids.items():
+                if name not in desired_instances and name and any(p.match(name) for p in patterns):
+                    self._add("instance:{}".format(name), "delete", "terminate {} ({})".format(name, ", ".join(ids)),
+                              lambda ids=ids: DefaultEc2(vpc_id=self.vpc_id, region=self.region)
+                              .delete_ec2_by_ids(ids), requires=["targets:deregister"])
+
+        # extra subnets(after their instances are terminated)
+        if prune:
+            desired_names = set(name for name, _ in subnets)
+            for name, subnet_id in self.subnet_ids.items():
+                if name and re.match(r"^(PubSub|PriSub)-\d+", name) and name not in desired_names:
+                    self._add("subnet:{}".format(name), "delete", "subnet {}".format(name),
+                              lambda subnet_id=subnet_id: self.ec2_client.delete_subnet(SubnetId=subnet_id),
+                              requires=[change.key for change in self.changes
+                                        if change.action == "delete" and change.key.startswith("instance:")])
+
+        self._plan_load_balancer(pub_names, desired_instances, prune)
+
+        return self.changes
+
+    def _instance_diff(self, name, instance_ids, instance):
+        """
+        Compare live instances with instance spec
+        Only pending and running instances are replaced, stopped instances are reported in `notes`
+
+        :param name: instance name
+        :param instance_ids: live instance ids of name
+        :param instance: instance spec
+        :return: (changed attributes that need a new instance, True if security groups differ)
+        """
+        ami = instance.get("ami", self.spec["ami"])
+        instance_type = instance.get("instance_type", self.spec["instance_type"])
+        group_names = instance["security_groups"]
+        group_ids = set(self.sg_ids.get(group) for group in group_names)
+
+        replace = []
+        update_groups = False
+        stopped = []
+        for instance_id in instance_ids:
+            live = self.instances[instance_id]
+            # no groups in spec means the default group of VPC
+            if group_names and set(group["GroupId"] for group in _instance_groups(live)) != group_ids:
+                update_groups = True
+            if live["State"]["Name"] not in ("pending", "running"):
+                stopped.append(instance_id)
+                continue
+            if live.get("ImageId") != ami and "ami" not in replace:
+                replace.append("ami")
+            if live.get("InstanceType") != instance_type and "instance_type" not in replace:
+                replace.append("instance_type")
+            if bool(live.get("PublicIpAddress")) != instance["public_ip"] and "public_ip" not in replace:
+                replace.append("public_ip")
+
+        # a stopped instance has no public ip and may be stopped on purpose, it is never terminated by apply
+        if stopped:
+            self.notes.append("instance {} is stopped({}), start it to compare ami, instance type and public ip"
+                              .format(name, ", ".join(stopped)))
+            replace = []
+
+        return replace, update_groups
+
+    def _plan_load_balancer(self, pub_names, desired_instances, prune):
+        lb_spec = self.spec["load_balancer"]
+        if not lb_spec:
+            return
+
+        group_names = lb_spec.get("security_groups", [])
+        if self.alb is None:
+            self._add("alb", "create", "load balancer {}".format(lb_spec["name"]), self._create_alb,
+                      requires=["subnet:{}".format(name) for name in pub_names] + ["igw", "ig_rtb"] +
+                               ["sg:{}".format(group) for group in group_names])
+        elif group_names and set(self.alb.get("SecurityGroups", [])) != set(self.sg_ids.get(group)
+                                                                           for group in group_names):
+            self._add("alb", "update", "security groups of load balancer {}".format(lb_spec["name"]),
+                      self._set_alb_groups, requires=["sg:{}".format(group) for group in group_names])
+        if self.tgr is None:
+            self._add("tgr", "create", "target group {}".format(lb_spec["target_group"]), self._create_tgr,
+                      requires=["vpc"])
+        port = lb_spec.get("port", 80)
+        if port not in self.listeners:
+            if len(self.listeners) == 1:
+                old_port = next(iter(self.listeners))
+                self._add("listener", "update", "listener :{} -> :{}".format(old_port, port),
+                          lambda: self.elb_client.modify_listener(ListenerArn=self.listeners[old_port], Port=port),
+                          requires=["tgr"])
+            else:
+                self._add("listener", "create", "listener :{}".format(port), self._create_listener,
+                          requires=["alb", "tgr"])
+
+        patterns = [re.compile("^{}$".format(re.escape(target).replace(r"\*", ".*")))
+                    for target in lb_spec.get("targets", [])]
+        target_names = [name for name in desired_instances if any(p.match(name) for p in patterns)]
+        # replaced instances are registered again with their new ids
+        known = [name for name in target_names if name in self.instance_ids and name not in self.replaced]
+        new = [name for name in target_names if name not in self.instance_ids or name in self.replaced]
+        register = [instance_id for name in known for instance_id in self.instance_ids[name]
+                    if instance_id not in self.target_ids]
+        if register or new:
+            self._add("targets", "update", "register {} targets".format(len(register) + len(new)),
+                      lambda: self._register(target_names),
+                      requires=["tgr"] + ["instance:{}".format(name) for name in new])
+        if prune:
+            # old ids of replaced instances leave the target group when they are terminated
+            desired_ids = set(instance_id for name in target_names for instance_id in self.instance_ids.get(name, []))
+            deregister = sorted(self.target_ids - desired_ids)
+            if deregister:
+                self._add("targets:deregister", "delete", "deregister {} targets".format(len(deregister)),
+                          lambda: self.elb_client.deregister_targets(TargetGroupArn=self.tgr["TargetGroupArn"],
+                                                                     Targets=[{"Id": i} for i in deregister]))
+
+    def print_plan(self):
+        print("----- Plan for {} ({}) -----".format(self.spec["vpc"]["name"], self.vpc_id or "new"))
+        if not self.changes:
+            print("No changes")
+        for change in self.changes:
+            print("{:<7} {}".format(change.action, change.description))
+        for note in self.notes:
+            print("{:<7} {}".format("note", note))
+
+        return self
+
+    ###############
+    # Apply
+    ###############
+    def _vpc(self):
+        return DefaultVPC(region=self.region).load_VPC(self.vpc_id, cidr_block=self.spec["vpc"]["cidr"])
+
+    def _create_vpc(self):
+        self.vpc_id = DefaultVPC(region=self.region) \
+            .create_VPC(cidr_block=self.spec["vpc"]["cidr"], vpc_name=self.spec["vpc"]["name"]).vpc.id
+
+    def _create_subnet(self, name, cidr):
+        az = self.region + re.sub(r"^\w+-\d+", "", name)
+        self.subnet_ids[name] = self._vpc()._create_subnet(cidr, az, name)
+
+    def _create_igw(self):
+        self.igw_id = self._vpc().create_ig().ig.id
+
+    def _create_route_table(self, name, subnet_names, gateway):
+        response = self.ec2_client.create_route_table(VpcId=self.vpc_id,
+                                                      TagSpecifications=name_tag_spec("route-table", name))
+        rt_id = response["RouteTable"]["RouteTableId"]
+        if gateway:
+            self.ec2_client.create_route(RouteTableId=rt_id, DestinationCidrBlock="0.0.0.0/0", GatewayId=self.igw_id)
+            self.ig_rtb_id = rt_id
+        else:
+            self.ec2_client.create_route(RouteTableId=rt_id, DestinationCidrBlock="0.0.0.0/0", NatGatewayId=self.nat_id)
+            self.nat_rtb_id = rt_id
+        self._associate(rt_id, subnet_names)
+
+    def _associate(self, rt_id, subnet_names):
+        for name in subnet_names:
+            self.ec2_client.associate_route_table(RouteTableId=rt_id, SubnetId=self.subnet_ids[name])
+
+    def _create_nat(self, subnet_name):
+        vpc = self._vpc().create_nat(subnet_id=self.subnet_ids[subnet_name])
+        self.nat_id = vpc.nat["NatGateway"]["NatGatewayId"]
+
+    def _create_key_pair(self):
+        DefaultEc2(vpc_id=self.vpc_id, region=self.region).create_pem_key(pem_key_name=self.spec["key_pair"])
+
+    def _create_sg(self, group):
+        sg = DefaultEc2(vpc_id=self.vpc_id, region=self.region) \
+            .create_sg(group_name=group["name"], desc=group["description"], inbound_list=group["ingress"])
+        self.sg_ids[group["name"]] = sg.id
+
+    def _update_sg_rules(self, group_name, add, revoke):
+        submit(self.ec2_client, self.sg_ids[group_name], "ingress", add, revoke)
+
+    def _create_instance(self, name, subnet_name, instance):
+        ids = DefaultEc2(vpc_id=self.vpc_id, region=self.region) \
+            ._run_instances(self.subnet_ids[subnet_name], name, 1,
+                            [self.sg_ids[group] for group in instance["security_groups"]],
+                            instance.get("key_pair", self.spec["key_pair"]),
+                            instance.get("ami", self.spec["ami"]),
+                            instance.get("instance_type", self.spec["instance_type"]),
+                            instance["public_ip"])
+        self.instance_ids[name] = ids
+
+    def _replace_instance(self, name, subnet_name, instance):
+        DefaultEc2(vpc_id=self.vpc_id, region=self.region).delete_ec2_by_ids(self.instance_ids[name])
+        self._create_instance(name, subnet_name, instance)
+
+    def _set_instance_groups(self, name, instance):
+        for instance_id in self.instance_ids[name]:
+            self.ec2_client.modify_instance_attribute(InstanceId=instance_id,
+                                                      Groups=[self.sg_ids[group]
+                                                              for group in instance["security_groups"]])
+
+    def _set_alb_groups(self):
+        self.elb_client.set_security_groups(LoadBalancerArn=self.alb["LoadBalancerArn"],
+                                            SecurityGroups=[self.sg_ids[group] for group in
+                                                            self.spec["load_balancer"].get("security_groups", [])])
+
+    def _create_alb(self):
+        lb_spec = self.spec["load_balancer"]
+        response = self.elb.create_elb(elb_name=lb_spec["name"],
+                                       subnet_list=[self.subnet_ids[name] for name, public in self._desired_subnets()
+                                                    if public],
+                                       sg_list=[self.sg_ids[group] for group in lb_spec.get("security_groups", [])])
+        self.alb = response["LoadBalancers"][0]
+
+    def _create_tgr(self):
+        lb_spec = self.spec["load_balancer"]
+        response = self.elb.create_tgr(tgr_name=lb_spec["target_group"], vpc_id=self.vpc_id,
+                                       port=lb_spec.get("target_port", 80))
+        self.tgr = response["TargetGroups"][0]
+
+    def _create_listener(self):
+        self.elb.create_listener(elb_arn=self.alb["LoadBalancerArn"], tgr_arn=self.tgr["TargetGroupArn"],
+                                 port=self.spec["load_balancer"].get("port", 80))
+
+    def _register(self, target_names):
+        ids = [instance_id for name in target_names for instance_id in self.instance_ids.get(name, [])
+               if instance_id not in self.target_ids]
+        if ids:
+            self.elb.register_targets(targets=ids, tgr_arn=self.tgr["TargetGroupArn"])
+
+    def apply(self):
+        """
+        Apply planned changes on dependency graph
+
+        :return: DAGExecutor
+        """
+        keys = set(change.key for change in self.changes)
+        executor = DAGExecutor(max_workers=self.max_workers)
+        for change in self.changes:
+            executor.add(change.key, change.func, requires=[key for key in change.requires if key in keys])
+
+        try:
+            if self.changes:
+                executor.run()
+        finally:
+            executor.print_summary()
+            limiter.print_summary()
+
+        return executor
+
+
+if __name__ == '__main__':
+    ### Usage
+    # python spec.py {spec file}          : print plan
+    # python spec.py {spec file} apply    : apply plan
+    # python spec.py {spec file} prune    : apply plan and delete resources not in spec
+    planner = SpecPlanner(load_spec(sys.argv[1])).discover()
+    planner.plan(prune=len(sys.argv) > 2 and sys.argv[2] == "prune")
+    planner.print_plan()
+    if len(sys.argv) > 2 and sys.argv[2] in ("apply", "prune"):
+        planner.apply()
@@ -1,7 +1,33 @@
-import boto3
+from util.session import get_client, get_resource
+import os
+from botocore.exceptions import ClientError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from util.utils import *
+from util.decorators import Trace
+from util.trace import propagate
+from util.waiter import wait_for
+from util.sg_rules import sync_rules
 
 
+class FleetLaunchError(Exception):
+    """
+    This class is raised when some RunInstances calls of a fleet launch fail
+
+    Init
+        errors: exceptions of failed calls
+        instance_ids: instance ids launched by successful calls
+        terminated: True if those instances were terminated
+    """
+    def __init__(self, errors, instance_ids, terminated):
+        self.errors = errors
+        self.instance_ids = instance_ids
+        self.terminated = terminated
+        super().__init__("{} of fleet launch calls failed({}), {} launched instances {}".format(
+            len(errors), errors[0], len(instance_ids), "terminated" if terminated else "left running"))
+
+
+@Trace()
 class DefaultEc2:
     """
     This class have create and delete features about ec2 instance
@@ -20,46 +46,71 @@ class DefaultEc2:
         region: region(us-east-1)
     """
     def __init__(self, vpc_id, region="us-east-2"):
-        self.ec2 = boto3.resource("ec2", region_name=region)
-        self.ec2_client = boto3.client('ec2', region_name=region)
+        self.ec2_client = get_client("ec2", region)
+        self.region = region
         self.vpc = self.ec2.Vpc(vpc_id)
 
-    def create_sg(self, group_name, desc="None", inbound_list=None):
+    @property
+    def ec2(self):
+        """ec2 resource of current thread(`util.session`)"""
+        return get_resource("ec2", self.region)
+
+    def create_sg(self, group_name, desc="None", inbound_list=None, prune=False):
         """
         Create security group
+        Inbound rules are merged and authorized in one call(`util.sg_rules`)
+        If group exists in VPC, only missing rules are authorized(other rules are kept unless prune)
 
         :param group_name: group name
         :param desc: group description
         :param inbound_list: inbound rule list
+        :param prune: revoke rules of existing group that are not in inbound_list(default: False)
         :return: security object
         """
         if inbound_list is None:
             inbound_list = [{"cidr": "0.0.0.0/0", "protocol": "tcp", "f_port": 22, "t_port": 22}]
 
-        securitygroup = self.ec2.create_security_group(GroupName=group_name,
-                                                       Description=desc,
-                                                       VpcId=self.vpc.id)
-        add_name_tag(securitygroup, group_name)
+        try:
+            securitygroup = self.ec2.create_security_group(GroupName=group_name,
+                                                           Description=desc,
+                                                           VpcId=self.vpc.id,
+                                                           TagSpecifications=name_tag_spec("security-group",
+                                                                                           group_name))
+            group = {"IpPermissions": []}
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "InvalidGroup.Duplicate":
+                raise
+            group = self.ec2_client.describe_security_groups(
+                Filters=[{"Name": "vpc-id", "Values": [self.vpc.id]},
+                         {"Name": "group-name", "Values": [group_name]}])["SecurityGroups"][0]
+            securitygroup = self.ec2.SecurityGroup(group["GroupId"])
 
-        for inbound in inbound_list:
-            securitygroup.authorize_ingress(CidrIp=inbound.get("cidr"),
-                                            IpProtocol=inbound.get("protocol"),
-                                            FromPort=inbound.get("f_port"),
-                                            ToPort=inbound.get("t_port"))
+        sync_rules(self.ec2_client, securitygroup.id, ingress=inbound_list, group=group, prune=prune)
 
         return securitygroup
 
     def create_pem_key(self, pem_key_name):
         """
         Create key pair(using connect ec2)
+        Existing key pair is reused if its pem file is kept(rerun of a failed build)
 
         :param pem_key_name: key pair name
         :return: None
         """
-        with open(pem_key_name+'.pem', 'w') as key_file:
+        pem_path = pem_key_name + '.pem'
+        try:
             key_pair = self.ec2.create_key_pair(KeyName=pem_key_name)
-            key_pair_out = str(key_pair.key_material)
-            key_file.write(key_pair_out)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "InvalidKeyPair.Duplicate":
+                raise
+            # private key can't be downloaded again, pem file must be the one written on creation
+            if not os.path.exists(pem_path):
+                raise ValueError("key pair {} exists but {} is missing".format(pem_key_name, pem_path))
+            return
+
+        # pem file is written only after key pair exists(an existing file is never truncated on failure)
+        with open(pem_path, 'w') as key_file:
+            key_file.write(str(key_pair.key_material))
 
     def create_ec2(self, ec2_name, subnet_id, sg_id_list, pem_key_name, image_id="ami-077e31c4939f6a2f3", instance_type="t2.micro", associate_p_ip=False):
         """
@@ -87,8 +138,86 @@ class DefaultEc2:
                 'AssociatePublicIpAddress': associate_p_ip,
                 'Groups': sg_id_list
             }],
-            KeyName=pem_key_name)
-        add_name_tag_ec2(self.ec2_client, instances[0].id, ec2_name)
+            KeyName=pem_key_name,
+            TagSpecifications=name_tag_spec("instance", ec2_name))
+
+        return instances
+
+    def _run_instances(self, subnet_id, ec2_name, count, sg_id_list, pem_key_name,
+                       image_id, instance_type, associate_p_ip):
+        """
+        Launch same instances on one subnet with one RunInstances call
+
+        :return: instance id list
+        """
+        response = call_with_backoff(self.ec2_client.run_instances,
+                                     ImageId=image_id,
+                                     InstanceType=instance_type,
+                                     MaxCount=count,
+                                     MinCount=count,
+                                     NetworkInterfaces=[{
+                                         'SubnetId': subnet_id,
+                                         'DeviceIndex': 0,
+                                         'AssociatePublicIpAddress': associate_p_ip,
+                                         'Groups': sg_id_list
+                                     }],
+                                     KeyName=pem_key_name,
+                                     TagSpecifications=name_tag_spec("instance", ec2_name))
+
+        return [instance["InstanceId"] for instance in response["Instances"]]
+
+    def create_ec2_fleet(self, placements, sg_id_list, pem_key_name, image_id="ami-077e31c4939f6a2f3",
+                         instance_type="t2.micro", associate_p_ip=False, max_workers=8, terminate_on_error=True):
+        """
+        Create many ec2 instances
+        - Placements with the same subnet and name are launched with one RunInstances call
+        - Calls for different subnets are fired concurrently
+        - Name tags are applied at launch(TagSpecifications)
+
+        :param placements: (subnet id, ec2 name) list
+        :param sg_id_list: security group to mapping
+        :param pem_key_name: key pair to mapping
+        :param image_id: ami id to starting
+        :param instance_type: instance type(default: t2.micro)
+        :param associate_p_ip: Whether public ip is enabled or not
+        :param max_workers: number of RunInstances calls at once
+        :param terminate_on_error: terminate instances of successful calls if any call fails
+        :return: instance object list(same order as placements)
+        :raise FleetLaunchError: if any RunInstances call fails(launched ids are attached)
+        """
+        groups = OrderedDict()
+        for i, (subnet_id, ec2_name) in enumerate(placements):
+            groups.setdefault((subnet_id, ec2_name), []).append(i)
+
+        def launch(key):
+            subnet_id, ec2_name = key
+            return self._run_instances(subnet_id, ec2_name, len(groups[key]), sg_id_list, pem_key_name,
+                                       image_id, instance_type, associate_p_ip)
+
+        keys = list(groups)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(keys) or 1))) as pool:
+            futures = [pool.submit(propagate(launch), key) for key in keys]
+
+        # every call is finished before anything is raised, no launch is left unrecorded
+        launched = []
+        errors = []
+        for future in futures:
+            if future.exception() is None:
+                launched.append(future.result())
+            else:
+                launched.append([])
+                errors.append(future.exception())
+
+        if errors:
+            instance_ids = [instance_id for instance_ids in launched for instance_id in instance_ids]
+            if instance_ids and terminate_on_error:
+                self.ec2_client.terminate_instances(InstanceIds=instance_ids)
+            raise FleetLaunchError(errors, instance_ids, terminated=terminate_on_error)
+
+        instances = [None] * len(placements)
+        for key, instance_ids in zip(keys, launched):
+            for index, instance_id in zip(groups[key], instance_ids):
+                instances[index] = self.ec2.Instance(instance_id)
 
         return instances
 
@@ -102,8 +231,7 @@ class DefaultEc2:
         """
         self.ec2.instances.filter(InstanceIds=instance_ids).terminate()
 
-        self.ec2_client.get_waiter('instance_terminated') \
-            .wait(InstanceIds=instance_ids)
+        wait_for(self.ec2_client, "instance_terminated", instance_ids)
 
     def delete_key_pair_by_name(self, key_name):
         """
@@ -160,6 +288,4 @@ if __name__ == '__main__':
                      pem_key_name="TEST-PEM",
                      associate_p_ip=False)
 
-    d_ec2.ec2_client.get_waiter("instance_status_ok").wait(
-        InstanceIds=[bastion[0].id, web_1[0].id, web_2[0].id]
-    )
\ No newline at end of file
+    wait_for(d_ec2.ec2_client, "instance_status_ok", [bastion[0].id, web_1[0].id, web_2[0].id])
\ No newline at end of file
@@ -1,6 +1,8 @@
-import boto3
+from util.session import get_client
+from util.decorators import Trace
 
 
+@Trace()
 class ELB:
     """
     This class have create, register and delete features about Elastic Load Balancer
@@ -9,7 +11,7 @@ class ELB:
         region: region
     """
     def __init__(self, region="us-east-2"):
-        self.elb_client = boto3.client(service_name="elbv2", region_name=region)
+        self.elb_client = get_client("elbv2", region)
 
     def create_elb(self, elb_name, subnet_list, sg_list, type="application", schema="internet-facing"):
         """
@@ -1,7 +1,12 @@
-import boto3
+from util.session import get_client, get_resource
+from concurrent.futures import ThreadPoolExecutor
 from util.utils import *
 from util.decorators import *
+from util.trace import tracer, propagate
+from util.waiter import wait_for
+from util.cidr import CIDRPlanner, availability_zones, az_suffix
 
+@Trace()
 class DefaultVPC:
     """
     This class have create and delete features about VPC resources
@@ -19,120 +24,109 @@ class DefaultVPC:
         region: region
     """
     def __init__(self, region="us-east-2"):
-        self.ec2 = boto3.resource("ec2", region_name=region)
-        self.ec2_client = boto3.client('ec2', region_name=region)
+        self.ec2_client = get_client("ec2", region)
         self.region = region
         self.pub_sub_list = []
         self.pri_sub_list = []
+        self.cidr_block = None
+        self._cidr_planner = None
 
-    def _get_cidr_pre(self, cidr_block):
-        """
-        Get cidr block to use subnet
-        Example:
-            input: "10.0.0.0/16"
-            output: ("10.0.", 2)
-
-        :param cidr_block: vpc CIDR block
-        :return: (cidr block, used octet)
-        """
-        tmp = cidr_block.split('/')
-        cidr_list = cidr_block.split(".")
-        cidr_octet = int(int(tmp[1]) / 8)
+    @property
+    def ec2(self):
+        """ec2 resource of current thread(`util.session`)"""
+        return get_resource("ec2", self.region)
 
-        result = ""
-        for i in range(cidr_octet):
-            result += cidr_list[i] + "."
+    @property
+    def cidr_planner(self):
+        """`util.cidr.CIDRPlanner` of VPC(existing subnets are described once on first use of a loaded VPC)"""
+        if self._cidr_planner is None:
+            existing = [subnet.cidr_block for subnet in self.vpc.subnets.all()]
+            self._cidr_planner = CIDRPlanner(self.cidr_block, existing=existing)
 
-        return result, cidr_octet
+        return self._cidr_planner
 
-    def _get_sub_cidr_list(self, end, start=1):
+    @Printer(post="Created VPC")
+    def create_VPC(self, cidr_block, vpc_name="TEST-VPC"):
         """
-        This function make new subnet CIDR list
-        Example:
-            input:
-                self.sub_cidr_pre: "10.0."
-                self.octet: 2
-                end: 3
-                start: 1
-            output: ["10.0.1.0/24", "10.0.2.0/24"]
+        Create VPC
 
-        :param end: end block
-        :param start: start block
-        :return: CIDR list to make subnet
+        :param cidr_block: CIDR block to make VPC
+        :param vpc_name: VPC name
+        :return: self
         """
-        cidr_list = []
-        for i in range(start, end):
-            result = ""
-            if self.cidr_octet == 1:
-                result = "{}{}.0.0/16".format(self.sub_cidr_pre, str(i))
-            elif self.cidr_octet == 2:
-                result = "{}{}.0/24".format(self.sub_cidr_pre, str(i))
+        self.cidr_block = cidr_block
+        self._cidr_planner = CIDRPlanner(cidr_block)
 
-            cidr_list.append(result)
+        self.vpc = self.ec2.create_vpc(CidrBlock=cidr_block,
+                                       TagSpecifications=name_tag_spec("vpc", vpc_name))
 
-        return cidr_list
+        with tracer.waiting("vpc_available"):
+            self.vpc.wait_until_available()
 
-    def _get_az(self, num):
-        """
-        Get available zone by number
-        Example:
-            input: 1
-            output: "c"
+        return self
 
-        :param num: number
-        :return: available zone
+    def load_VPC(self, vpc_id, cidr_block):
         """
-        if num % 2 == 0:
-            return "a"
-        return "c"
+        Use existing VPC(resume build from state)
 
-    @Printer(post="Created VPC")
-    def create_VPC(self, cidr_block, vpc_name="TEST-VPC"):
-        """
-        Create VPC
-
-        :param cidr_block: CIDR block to make VPC
-        :param vpc_name: VPC name
+        :param vpc_id: VPC id
+        :param cidr_block: CIDR block of VPC
         :return: self
         """
-        self.sub_cidr_pre, self.cidr_octet = self._get_cidr_pre(cidr_block)
+        self.cidr_block = cidr_block
+        self._cidr_planner = None
+        self.vpc = self.ec2.Vpc(vpc_id)
 
-        self.vpc = self.ec2.create_vpc(CidrBlock=cidr_block)
+        return self
 
-        add_name_tag(self.vpc, vpc_name)
-        self.vpc.wait_until_available()
+    def _create_subnet(self, cidr_block, az, name):
+        """
+        Create single subnet with name tag(tagged at creation time)
 
-        return self
+        :param cidr_block: subnet CIDR block
+        :param az: availability zone name(ex. us-east-2a)
+        :param name: subnet name
+        :return: subnet id
+        """
+        response = call_with_backoff(self.ec2_client.create_subnet,
+                                     CidrBlock=cidr_block,
+                                     VpcId=self.vpc.id,
+                                     AvailabilityZone=az,
+                                     TagSpecifications=name_tag_spec("subnet", name))
+
+        return response["Subnet"]["SubnetId"]
 
     @Printer(post="Created all Subnets")
-    def create_sub(self, pub_sub_num=2, pri_sub_num=2):
+    def create_sub(self, pub_sub_num=2, pri_sub_num=2, max_workers=4, prefix=None):
         """
         Create public and private subnets(default: 2 public subnet, 2 private subnet)
+        Subnets are created concurrently, pub_sub_list/pri_sub_list keep the index order
+        CIDR blocks come from `cidr_planner`, subnets are spread over all available zones of region
 
         :param pub_sub_num: number of public subnet
         :param pri_sub_num: number of private subnet
-        :return: None
+        :param max_workers: number of subnets to create at once(1: serial)
+        :param prefix: subnet prefix(default: None, VPC prefix + 8)
+        :return: self
         """
-        pub_cidr_list = self._get_sub_cidr_list(end=pub_sub_num + 1, start=1)
-        pri_cidr_list = self._get_sub_cidr_list(start=pub_sub_num + 1, end=pub_sub_num + pri_sub_num + 1)
+        pub_cidr_list = self.cidr_planner.allocate_many(pub_sub_num, prefix)
+        pri_cidr_list = self.cidr_planner.allocate_many(pri_sub_num, prefix)
+        zones = availability_zones(self.ec2_client, self.region)
 
+        jobs = []
         for i in range(len(pub_cidr_list)):
-            subnet = self.ec2.create_subnet(CidrBlock=pub_cidr_list[i],
-                                            VpcId=self.vpc.id,
-                                            AvailabilityZone="{}{}".format(self.region, self._get_az(i)))
-
-            add_name_tag(subnet, "PubSub-{}{}".format(str(i + 1), self._get_az(i)))
-
-            self.pub_sub_list.append(subnet)
-
+            zone = zones[i % len(zones)]
+            jobs.append((pub_cidr_list[i], zone, "PubSub-{}{}".format(str(i + 1), az_suffix(zone, self.region))))
         for i in range(len(pri_cidr_list)):
-            subnet = self.ec2.create_subnet(CidrBlock=pri_cidr_list[i],
-                                            VpcId=self.vpc.id,
-                                            AvailabilityZone="{}{}".format(self.region, self._get_az(i)))
+            zone = zones[i % len(zones)]
+            jobs.append((pri_cidr_list[i], zone, "PriSub-{}{}".format(str(i + 1), az_suffix(zone, self.region))))
 
-            add_name_tag(subnet, "PriSub-{}{}".format(str(i + 1), self._get_az(i)))
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            subnet_ids = list(pool.map(propagate(lambda job: self._create_subnet(*job)), jobs))
 
-            self.pri_sub_list.append(subnet)
+        subnets = [self.ec2.Subnet(subnet_id) for subnet_id in subnet_ids]
+        self.pub_sub_list.extend(subnets[:len(pub_cidr_list)])
+        self.pri_sub_list.extend(subnets[len(pub_cidr_list):])
 
         return self
 
@@ -141,8 +135,7 @@ class DefaultVPC:
         """
         Create Internet Gateway and attach on vpc
         """
-        self.ig = self.ec2.create_internet_gateway()
-        add_name_tag(self.ig, "IGW")
+        self.ig = self.ec2.create_internet_gateway(TagSpecifications=name_tag_spec("internet-gateway", "IGW"))
 
         self.vpc.attach_internet_gateway(InternetGatewayId=self.ig.id)
 
@@ -152,8 +145,8 @@ class DefaultVPC:
         """
         Set Internet Gateway routing table on public subnet
         """
-        ig_rtb = self.vpc.create_route_table()
-        add_name_tag(ig_rtb, "IG-RTB")
+        ig_rtb = self.ig_rtb = self.vpc.create_route_table(
+            TagSpecifications=name_tag_spec("route-table", "IG-RTB"))
 
         ig_rtb.create_route(
             DestinationCidrBlock='0.0.0.0/0',
@@ -187,8 +180,7 @@ class DefaultVPC:
         self.nat = self.ec2_client.create_nat_gateway(AllocationId=nat_eip['AllocationId'],
                                                       SubnetId=subnet_id)
 
-        self.ec2_client.get_waiter('nat_gateway_available')\
-            .wait(NatGatewayIds=[self.nat['NatGateway']['NatGatewayId']])
+        wait_for(self.ec2_client, "nat_gateway_available", [self.nat['NatGateway']['NatGatewayId']])
 
         return self
 
@@ -196,8 +188,8 @@ class DefaultVPC:
         """
         Set NAT routing table on private subnet
         """
-        nat_rtb = self.vpc.create_route_table()
-        add_name_tag(nat_rtb, "NAT-RTB")
+        nat_rtb = self.nat_rtb = self.vpc.create_route_table(
+            TagSpecifications=name_tag_spec("route-table", "NAT-RTB"))
 
         nat_rtb.create_route(
             DestinationCidrBlock='0.0.0.0/0',
@@ -219,20 +211,7 @@ class DefaultVPC:
         """
         try:
             self.ec2_client.delete_nat_gateway(NatGatewayId=nat_id)
-            self.ec2_client.get_waiter('nat_gateway_available') \
-                .wait(Filters=[
-                {
-                    'Name': 'state',
-                    'Values': [
-                        'deleted',
-                    ]
-                }, {
-                    'Name': 'nat-gateway-id',
-                    'Values': [
-                        nat_id,
-                    ]
-                },
-            ])
+            wait_for(self.ec2_client, "nat_gateway_deleted", [nat_id])
         except:
             pass
 
@@ -0,0 +1,202 @@
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+
+import paramiko
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util.async_ssh import AsyncSSHConnector
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    """Accept the test key and run the tiny command language of `LocalSSHServer`"""
+    def __init__(self, server):
+        self.server = server
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        if key.get_base64() == self.server.client_key.get_base64():
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_REQUEST
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.server.execute, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+
+class LocalSSHServer:
+    """
+    In-process SSH server on 127.0.0.1
+    Commands:
+        echo <text>          -> stdout text, exit 0
+        hold <seconds> <text> -> sleep, stdout text, exit 0
+        fail <text>          -> stderr text, exit 3
+    """
+    def __init__(self, client_key):
+        self.client_key = client_key
+        self.host_key = paramiko.RSAKey.generate(1024)
+        self.active = 0
+        self.max_active = 0
+        self.commands = 0
+        self._lock = threading.Lock()
+        self._transports = []
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen(100)
+        self.port = self._sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=_ServerInterface(self))
+            self._transports.append(transport)
+
+    def execute(self, channel, command):
+        # exec reply is sent after check_channel_exec_request returns, don't close the channel before it
+        time.sleep(0.05)
+        with self._lock:
+            self.commands += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            name, _, arg = command.partition(" ")
+            if name == "hold":
+                seconds, _, arg = arg.partition(" ")
+                time.sleep(float(seconds))
+                name = "echo"
+            if name == "echo":
+                channel.sendall(arg.encode() + b"\n")
+                exit_code = 0
+            else:
+                channel.sendall_stderr(arg.encode() + b"\n")
+                exit_code = 3
+        finally:
+            with self._lock:
+                self.active -= 1
+        channel.send_exit_status(exit_code)
+        channel.close()
+
+    def close(self):
+        self._sock.close()
+        for transport in self._transports:
+            transport.close()
+
+
+@pytest.fixture(scope="module")
+def key_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("keys") / "test.pem")
+    paramiko.RSAKey.generate(1024).write_private_key_file(path)
+    return path
+
+
+@pytest.fixture
+def server(key_path):
+    server = LocalSSHServer(paramiko.RSAKey.from_private_key_file(key_path))
+    yield server
+    server.close()
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_exec_results(server, key_path):
+    async def run():
+        async with AsyncSSHConnector(pem_key_path=key_path, user="tester") as connector:
+            client = await connector.connect("127.0.0.1", port=server.port)
+            try:
+                ok = await connector.exec(client, "echo hello")
+                failed = await connector.exec(client, "fail boom")
+            finally:
+                client.close()
+            return ok, failed
+
+    ok, failed = asyncio.run(run())
+    assert (ok.host, ok.exit_code, ok.stdout, ok.stderr) == ("127.0.0.1", 0, "hello\n", "")
+    assert (failed.exit_code, failed.stdout, failed.stderr) == (3, "", "boom\n")
+
+
+def test_run_many_limits_hosts_at_once(server, key_path):
+    async def run():
+        async with AsyncSSHConnector(pem_key_path=key_path, user="tester") as connector:
+            return await connector.run_many(["127.0.0.1"] * 8, "hold 0.3 done", port=server.port, concurrency=3)
+
+    results = asyncio.run(run())
+    assert [result.stdout for result in results] == ["done\n"] * 8
+    assert all(result.ok for result in results)
+    assert server.commands == 8
+    assert 1 < server.max_active <= 3
+
+
+def test_refused_connect_backs_off_without_blocking_loop(key_path):
+    port = _free_port()
+    delays = []
+
+    async def run():
+        connector = AsyncSSHConnector(pem_key_path=key_path, retries=2, connect_timeout=2)
+
+        def backoff(attempt):
+            delays.append(attempt)
+            return 0.2
+
+        connector._backoff = backoff
+        ticks = 0
+        done = asyncio.Event()
+
+        async def ticker():
+            nonlocal ticks
+            while not done.is_set():
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker_task = asyncio.ensure_future(ticker())
+        try:
+            with pytest.raises((ConnectionRefusedError, paramiko.ssh_exception.NoValidConnectionsError)):
+                await connector.connect("127.0.0.1", port=port)
+        finally:
+            done.set()
+            await ticker_task
+            connector.close()
+
+        return ticks
+
+    started = time.time()
+    ticks = asyncio.run(run())
+    assert delays == [0, 1]
+    assert time.time() - started >= 0.4
+    # the loop kept running while connect was backing off
+    assert ticks >= 20
+
+
+def test_run_many_reports_refused_hosts(key_path):
+    async def run():
+        async with AsyncSSHConnector(pem_key_path=key_path, retries=0) as connector:
+            return await connector.run_many(["127.0.0.1"], "echo hi", port=_free_port())
+
+    result = asyncio.run(run())[0]
+    assert not result.ok
+    assert result.error
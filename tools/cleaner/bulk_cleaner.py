@@ -0,0 +1,194 @@
+from discovery import VPCInventory, paginate
+from teardown import TeardownEngine
+from util.session import get_client
+from util.ratelimit import limiter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+import threading
+import time
+
+
+def _parse_time(value):
+    """Parse ISO 8601 time of tag(naive time is UTC, None if invalid)"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+class BulkVPCCleaner:
+    """
+    This class delete many VPCs across regions
+    - VPCs are selected by Name tag pattern(`*` wildcard, server side filter) and/or age
+    - One selector is required, every non default VPC is selected only with `all_vpcs=True`
+    - Age is the `CreatedAt` tag of VPC(ISO 8601), else the oldest instance launch time on VPC
+      (VPCs without both don't match an age threshold)
+    - Default VPCs are never selected
+    - VPCs are torn down concurrently with per-region and global limits
+      (each region has its own workers, a worker takes a global slot only when its VPC starts)
+    - One boto3 session is shared, clients are made once per region(`util.session`)
+
+    Init
+        regions: region list
+        name_pattern: Name tag pattern(ex. "TEST-*", default: None, no name filter)
+        older_than_days: select VPCs older than N days(default: None, no age filter)
+        all_vpcs: select all non default VPCs without name and age filter(default: False)
+        max_per_region: VPCs to delete at once in one region(default: 2)
+        max_total: VPCs to delete at once in all regions(default: 8)
+        profile: aws profile name(default: None, default credentials)
+    """
+    def __init__(self, regions, name_pattern=None, older_than_days=None, all_vpcs=False,
+                 max_per_region=2, max_total=8, profile=None):
+        if not name_pattern and older_than_days is None and not all_vpcs:
+            raise ValueError("name_pattern or older_than_days is required(all_vpcs=True to select all VPCs)")
+
+        self.regions = regions
+        self.name_pattern = name_pattern
+        self.older_than_days = older_than_days
+        self.all_vpcs = all_vpcs
+        self.max_per_region = max_per_region
+        self.max_total = max_total
+
+        self.clients = {region: (get_client("ec2", region, profile), get_client("elbv2", region, profile))
+                        for region in regions}
+        self.total_limit = threading.Semaphore(max(1, max_total))
+        self.targets = []
+        self.report = []
+
+    def _vpc_ages(self, ec2_client, vpc_ids):
+        """Get oldest instance launch time by VPC(one paginated describe per region)"""
+        launched = {}
+        for i in range(0, len(vpc_ids), 200):
+            reservations = paginate(ec2_client, "describe_instances", "Reservations",
+                                    Filters=[{"Name": "vpc-id", "Values": vpc_ids[i:i + 200]}])
+            for reservation in reservations:
+                for instance in reservation["Instances"]:
+                    vpc_id = instance.get("VpcId")
+                    if vpc_id and (vpc_id not in launched or instance["LaunchTime"] < launched[vpc_id]):
+                        launched[vpc_id] = instance["LaunchTime"]
+
+        return launched
+
+    def _discover_region(self, region):
+        ec2_client = self.clients[region][0]
+        filters = [{"Name": "is-default", "Values": ["false"]}]
+        if self.name_pattern:
+            filters.append({"Name": "tag:Name", "Values": [self.name_pattern]})
+
+        vpcs = paginate(ec2_client, "describe_vpcs", "Vpcs", Filters=filters)
+        targets = []
+        created = {}
+        for vpc in vpcs:
+            tags = {tag["Key"]: tag["Value"] for tag in vpc.get("Tags", [])}
+            targets.append({"region": region, "vpc_id": vpc["VpcId"], "name": tags.get("Name", "")})
+            created_at = _parse_time(tags.get("CreatedAt"))
+            if created_at is not None:
+                created[vpc["VpcId"]] = created_at
+
+        if self.older_than_days is not None and targets:
+            untagged = [target["vpc_id"] for target in targets if target["vpc_id"] not in created]
+            if untagged:
+                created.update(self._vpc_ages(ec2_client, untagged))
+            limit = datetime.now(timezone.utc) - timedelta(days=self.older_than_days)
+            targets = [target for target in targets
+                       if target["vpc_id"] in created and created[target["vpc_id"]] < limit]
+
+        return targets
+
+    def discover(self):
+        """
+        Find VPCs to delete in all regions(regions are searched concurrently)
+
+        :return: [{"region": .., "vpc_id": .., "name": ..}]
+        """
+        with ThreadPoolExecutor(max_workers=max(1, len(self.regions))) as pool:
+            results = list(pool.map(self._discover_region, self.regions))
+        self.targets = [target for targets in results for target in targets]
+
+        return self.targets
+
+    def _teardown(self, target):
+        ec2_client, elb_client = self.clients[target["region"]]
+        result = dict(target, deleted={}, seconds=0.0, error=None)
+        with self.total_limit:
+            start = time.time()
+            try:
+                inventory = VPCInventory(vpc_id=target["vpc_id"], ec2_client=ec2_client,
+                                         elb_client=elb_client).discover()
+                engine = TeardownEngine(inventory=inventory, ec2_client=ec2_client, elb_client=elb_client)
+                result["deleted"] = engine.run(print_summary=False)
+            except Exception as e:
+                result["error"] = "{}: {}".format(type(e).__name__, e)
+            result["seconds"] = time.time() - start
+
+        print("{} {} {} ({:.1f}s)".format("Failed" if result["error"] else "Deleted",
+                                           target["region"], target["vpc_id"], result["seconds"]))
+
+        return result
+
+    def run(self, targets=None):
+        """
+        Delete VPCs
+
+        :param targets: targets to delete(default: None, discover)
+        :return: report list
+        """
+        if targets is None:
+            targets = self.discover()
+
+        by_region = {}
+        for target in targets:
+            by_region.setdefault(target["region"], []).append(target)
+
+        # one pool per region, a region waiting for its own slots never holds a global slot
+        def run_region(region_targets):
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_per_region, len(region_targets)))) as pool:
+                return list(pool.map(self._teardown, region_targets))
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, len(by_region))) as pool:
+            for region_results in pool.map(run_region, by_region.values()):
+                for result in region_results:
+                    results[(result["region"], result["vpc_id"])] = result
+        self.report = [results[(target["region"], target["vpc_id"])] for target in targets]
+
+        self.print_report()
+        limiter.print_summary()
+
+        return self.report
+
+    def print_report(self):
+        """Print deleted resources and time per VPC"""
+        totals = {}
+        print("----- Bulk cleanup report -----")
+        print("{:<16} {:<24} {:<20} {:>8} {:>9}  {}".format("REGION", "VPC", "NAME", "DELETED", "TIME", "ERROR"))
+        for result in self.report:
+            for resource_type, count in result["deleted"].items():
+                totals[resource_type] = totals.get(resource_type, 0) + count
+            print("{:<16} {:<24} {:<20} {:>8} {:>8.1f}s  {}".format(
+                result["region"], result["vpc_id"], result["name"][:20],
+                sum(result["deleted"].values()), result["seconds"], result["error"] or ""))
+
+        print("----- Total -----")
+        for resource_type, count in totals.items():
+            print("{:<20} {}".format(resource_type, count))
+        print("VPCs: {} deleted, {} failed".format(sum(1 for r in self.report if not r["error"]),
+                                                   sum(1 for r in self.report if r["error"])))
+
+
+if __name__ == '__main__':
+    ### Params
+    regions = ["us-east-1", "ap-northeast-2"]
+    name_pattern = "TEST-*"
+    older_than_days = None
+
+    cleaner = BulkVPCCleaner(regions=regions, name_pattern=name_pattern, older_than_days=older_than_days)
+    for target in cleaner.discover():
+        print("{region} {vpc_id} {name}".format(**target))
+
+    if input("Do you want to delete {} VPCs?(y/n) : ".format(len(cleaner.targets))) == "y":
+        cleaner.run(cleaner.targets)
@@ -0,0 +1,157 @@
+def paginate(client, operation, key, **kwargs):
+    """
+    get all items of describe api using boto3 paginator
+
+    :param client: boto3 client
+    :param operation: operation name(describe_instances ...)
+    :param key: list key of response(Reservations, SecurityGroups ...)
+    :return: item list
+    """
+    items = []
+    for page in client.get_paginator(operation).paginate(**kwargs):
+        items.extend(page.get(key, []))
+
+    return items
+
+
+RESOURCE_TYPES = ["instances", "load_balancers", "target_groups", "security_groups", "nat_gateways", "addresses",
+                  "subnets", "route_tables", "internet_gateways", "network_interfaces", "key_pairs"]
+
+
+class VPCInventory:
+    """
+    This class discover all resources attached to one VPC in a single pass
+    - boto3 paginators are used, nothing is missed after the first page
+    - EC2 describe calls are filtered by vpc-id on server side
+    - ELB APIs have no vpc filter, load balancers and target groups are filtered by VpcId locally
+    - EIPs are the addresses associated to network interfaces in the VPC(NAT Gateway, instances)
+    - Key pairs are the keys used by instances in the VPC and by no instance outside of it
+
+    Init
+        vpc_id: vpc id
+        ec2_client: boto3.client('ec2')
+        elb_client: boto3.client('elbv2')
+    """
+    def __init__(self, vpc_id, ec2_client, elb_client):
+        self.vpc_id = vpc_id
+        self.ec2_client = ec2_client
+        self.elb_client = elb_client
+
+        self.instances = []
+        self.load_balancers = []
+        self.target_groups = []
+        self.security_groups = []
+        self.nat_gateways = []
+        self.addresses = []
+        self.subnets = []
+        self.route_tables = []
+        self.internet_gateways = []
+        self.network_interfaces = []
+        self.key_pairs = []
+
+    def _vpc_filter(self, name="vpc-id"):
+        return [{"Name": name, "Values": [self.vpc_id]}]
+
+    def discover(self):
+        """
+        Describe all resources of VPC
+
+        :return: self
+        """
+        ec2 = self.ec2_client
+
+        reservations = paginate(ec2, "describe_instances", "Reservations",
+                                Filters=self._vpc_filter() + [{
+                                    "Name": "instance-state-name",
+                                    "Values": ["pending", "running", "stopping", "stopped", "shutting-down"]}])
+        self.instances = [instance for r in reservations for instance in r["Instances"]]
+
+        self.security_groups = paginate(ec2, "describe_security_groups", "SecurityGroups",
+                                        Filters=self._vpc_filter())
+        self.nat_gateways = [nat for nat in paginate(ec2, "describe_nat_gateways", "NatGateways",
+                                                     Filter=self._vpc_filter())
+                             if nat["State"] not in ("deleted", "deleting")]
+        self.subnets = paginate(ec2, "describe_subnets", "Subnets", Filters=self._vpc_filter())
+        self.route_tables = paginate(ec2, "describe_route_tables", "RouteTables", Filters=self._vpc_filter())
+        self.internet_gateways = paginate(ec2, "describe_internet_gateways", "InternetGateways",
+                                          Filters=self._vpc_filter("attachment.vpc-id"))
+        self.network_interfaces = paginate(ec2, "describe_network_interfaces", "NetworkInterfaces",
+                                           Filters=self._vpc_filter())
+
+        eni_ids = [eni["NetworkInterfaceId"] for eni in self.network_interfaces]
+        self.addresses = []
+        # describe_addresses has no paginator, filter values are sent in chunks
+        for i in range(0, len(eni_ids), 200):
+            response = ec2.describe_addresses(Filters=[{"Name": "network-interface-id",
+                                                        "Values": eni_ids[i:i + 200]}])
+            self.addresses.extend(response["Addresses"])
+
+        self.key_pairs = self._own_key_pairs()
+
+        self.load_balancers = [lb for lb in paginate(self.elb_client, "describe_load_balancers", "LoadBalancers")
+                               if lb.get("VpcId") == self.vpc_id]
+        self.target_groups = [tgr for tgr in paginate(self.elb_client, "describe_target_groups", "TargetGroups")
+                              if tgr.get("VpcId") == self.vpc_id]
+
+        return self
+
+    def _own_key_pairs(self):
+        """
+        Key names used by instances of VPC and by no instance outside of it
+        (key pairs are regional, a key shared with another VPC must not be deleted)
+
+        :return: sorted key names
+        """
+        key_names = sorted(set(instance["KeyName"] for instance in self.instances if instance.get("KeyName")))
+        if not key_names:
+            return []
+
+        reservations = paginate(self.ec2_client, "describe_instances", "Reservations",
+                                Filters=[{"Name": "key-name", "Values": key_names},
+                                         {"Name": "instance-state-name",
+                                          "Values": ["pending", "running", "stopping", "stopped"]}])
+        shared = set(instance["KeyName"] for r in reservations for instance in r["Instances"]
+                     if instance.get("VpcId") != self.vpc_id)
+
+        return [key_name for key_name in key_names if key_name not in shared]
+
+    def to_dict(self):
+        """
+        Serialize discovered resources(datetime values become strings)
+
+        :return: dict
+        """
+        return {"vpc_id": self.vpc_id,
+                "resources": {resource_type: getattr(self, resource_type) for resource_type in RESOURCE_TYPES}}
+
+    @classmethod
+    def from_dict(cls, data, ec2_client=None, elb_client=None):
+        """Restore inventory without discovering again"""
+        inventory = cls(vpc_id=data["vpc_id"], ec2_client=ec2_client, elb_client=elb_client)
+        for resource_type in RESOURCE_TYPES:
+            setattr(inventory, resource_type, data["resources"].get(resource_type, []))
+
+        return inventory
+
+    def counts(self):
+        """
+        Count resources by type
+
+        :return: {resource type: count}
+        """
+        return {"load_balancers": len(self.load_balancers),
+                "target_groups": len(self.target_groups),
+                "instances": len(self.instances),
+                "key_pairs": len(self.key_pairs),
+                "nat_gateways": len(self.nat_gateways),
+                "addresses": len(self.addresses),
+                "security_groups": len(self.security_groups),
+                "internet_gateways": len(self.internet_gateways),
+                "route_tables": len(self.route_tables),
+                "network_interfaces": len(self.network_interfaces),
+                "subnets": len(self.subnets)}
+
+    def print_summary(self):
+        print("----- Resources on {} -----".format(self.vpc_id))
+        for resource_type, count in self.counts().items():
+            print("{:<20} {}".format(resource_type, count))
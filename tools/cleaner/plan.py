@@ -0,0 +1,189 @@
+from discovery import VPCInventory
+from teardown import TEARDOWN_GRAPH, TeardownEngine
+from util.executor import DAGExecutor
+from datetime import datetime, timezone
+import json
+import os
+
+DEFAULT_STATS_PATH = os.path.expanduser("~/.vpc_cleaner_stats.json")
+
+# step seconds used until a resource type has been deleted once(waiters dominate)
+DEFAULT_STEP_SECONDS = {
+    "load_balancers": 60,
+    "instances": 90,
+    "nat_gateways": 60,
+    "key_pairs": 1,
+    "route_tables": 2,
+    "target_groups": 2,
+    "addresses": 2,
+    "internet_gateways": 3,
+    "network_interfaces": 3,
+    "security_groups": 3,
+    "subnets": 2,
+    "vpc": 2,
+}
+
+PLAN_VERSION = 1
+
+
+class LatencyStats:
+    """
+    This class keep deletion time of each step in a local stats file
+    - Step time is a moving average of real teardown runs(steps without resources are not recorded)
+    - Resources of one type are deleted concurrently, step time hardly depends on count
+
+    Init
+        path: stats file path(default: ~/.vpc_cleaner_stats.json)
+        alpha: weight of new sample(default: 0.3)
+    """
+    def __init__(self, path=DEFAULT_STATS_PATH, alpha=0.3):
+        self.path = path
+        self.alpha = alpha
+        self.steps = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.steps = json.load(f).get("steps", {})
+
+    def record(self, step, seconds, count):
+        """Add one step sample"""
+        if not count:
+            return
+        stat = self.steps.get(step)
+        if stat is None:
+            self.steps[step] = {"seconds": seconds, "samples": 1}
+            return
+        stat["seconds"] = self.alpha * seconds + (1 - self.alpha) * stat["seconds"]
+        stat["samples"] += 1
+
+    def record_executor(self, executor, counts):
+        """Add samples of all succeeded steps of teardown graph"""
+        for name, step in executor.steps.items():
+            if step.duration is not None and step.error is None:
+                self.record(name, step.duration, counts.get(name, 0))
+
+        return self
+
+    def estimate(self, step, count):
+        """
+        Estimate step seconds
+
+        :return: (seconds, source)
+        """
+        if not count:
+            return 0.0, "-"
+        if step in self.steps:
+            return self.steps[step]["seconds"], "history({})".format(self.steps[step]["samples"])
+
+        return float(DEFAULT_STEP_SECONDS.get(step, 5)), "default"
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump({"steps": self.steps}, f, indent=2)
+
+        return self
+
+
+def step_counts(inventory):
+    """
+    Count resources deleted by each teardown step
+
+    :return: {step name: count}
+    """
+    counts = dict(inventory.counts())
+    counts["vpc"] = 1
+
+    return counts
+
+
+class TeardownPlan:
+    """
+    This class is an ordered deletion plan made from one discovery pass
+    - Steps are in dependency order of `TEARDOWN_GRAPH`
+    - Wall-clock time is the longest dependency chain of estimated step times(steps run in parallel)
+    - Plan is saved to json with the inventory, `apply` deletes exactly the planned resources
+
+    Init
+        inventory: discovered `VPCInventory`
+        region: region
+        stats: `LatencyStats`(default: None, load default stats file)
+    """
+    def __init__(self, inventory, region, stats=None, created_at=None):
+        self.inventory = inventory
+        self.region = region
+        self.stats = stats or LatencyStats()
+        self.created_at = created_at or datetime.now(timezone.utc).isoformat()
+        self.counts = step_counts(inventory)
+
+        graph = DAGExecutor()
+        for name, requires in TEARDOWN_GRAPH:
+            graph.add(name, None, requires=requires)
+        self.requires = {name: requires for name, requires in TEARDOWN_GRAPH}
+        self.order = graph.topological_order()
+
+    def estimate(self):
+        """
+        Estimate each step and total time
+
+        :return: ([{step, count, seconds, finish, source}], total seconds)
+        """
+        finish = {}
+        rows = []
+        for name in self.order:
+            seconds, source = self.stats.estimate(name, self.counts.get(name, 0))
+            start = max([finish[dep] for dep in self.requires[name]] or [0.0])
+            finish[name] = start + seconds
+            rows.append({"step": name, "count": self.counts.get(name, 0), "seconds": seconds,
+                         "finish": finish[name], "source": source})
+
+        return rows, max(finish.values() or [0.0])
+
+    def print_plan(self):
+        rows, total = self.estimate()
+        print("----- Teardown plan for {} ({}) -----".format(self.inventory.vpc_id, self.region))
+        print("{:<4} {:<20} {:>6} {:>9} {:>9}  {}".format("#", "STEP", "COUNT", "TIME", "FINISH", "SOURCE"))
+        for i, row in enumerate(rows, 1):
+            print("{:<4} {:<20} {:>6} {:>8.1f}s {:>8.1f}s  {}".format(i, row["step"], row["count"], row["seconds"],
+                                                                      row["finish"], row["source"]))
+        print("Estimated: {:.1f}s (sum of all steps: {:.1f}s)".format(total, sum(row["seconds"] for row in rows)))
+
+        return self
+
+    def to_dict(self):
+        rows, total = self.estimate()
+        return {"version": PLAN_VERSION,
+                "region": self.region,
+                "created_at": self.created_at,
+                "steps": rows,
+                "estimated_seconds": total,
+                "inventory": self.inventory.to_dict()}
+
+    def save(self, path):
+        """Save plan to json file"""
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+
+        return self
+
+    @classmethod
+    def load(cls, path, stats=None):
+        """Load plan from json file"""
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != PLAN_VERSION:
+            raise ValueError("unsupported plan version: {}".format(data.get("version")))
+
+        return cls(inventory=VPCInventory.from_dict(data["inventory"]), region=data["region"],
+                   stats=stats, created_at=data["created_at"])
+
+    def apply(self, ec2_client, elb_client, max_workers=8):
+        """
+        Delete planned resources and record step times to stats file
+
+        :return: {resource type: deleted count}
+        """
+        engine = TeardownEngine(inventory=self.inventory, ec2_client=ec2_client, elb_client=elb_client,
+                                max_workers=max_workers)
+        try:
+            return engine.run()
+        finally:
+            self.stats.record_executor(engine.executor, self.counts).save()
@@ -0,0 +1,251 @@
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from util.executor import DAGExecutor
+from util.utils import call_with_backoff, THROTTLE_ERROR_CODES, DEPENDENCY_ERROR_CODES
+from util.trace import tracer
+from util.waiter import wait_for
+
+# step name: steps that must be finished before
+TEARDOWN_GRAPH = [
+    ("load_balancers", []),
+    ("instances", []),
+    ("nat_gateways", []),
+    ("key_pairs", []),
+    ("route_tables", []),
+    ("target_groups", ["load_balancers"]),
+    ("addresses", ["nat_gateways", "instances"]),
+    ("internet_gateways", ["load_balancers", "instances", "nat_gateways", "addresses"]),
+    ("network_interfaces", ["load_balancers", "instances", "nat_gateways"]),
+    ("security_groups", ["load_balancers", "instances", "network_interfaces"]),
+    ("subnets", ["load_balancers", "instances", "nat_gateways", "network_interfaces", "route_tables"]),
+    ("vpc", ["target_groups", "internet_gateways", "security_groups", "subnets", "key_pairs"]),
+]
+
+
+def _is_not_found(e):
+    return e.response.get("Error", {}).get("Code", "").endswith("NotFound")
+
+
+class TeardownEngine:
+    """
+    This class delete discovered VPC resources with a dependency graph
+    - Independent resource types are deleted at the same time(ex. load balancers, instances, NAT Gateway)
+    - Resources of one type are deleted concurrently
+    - All instances and all NAT Gateways are waited together
+    - Only dependency errors(DependencyViolation, ResourceInUse) and throttling are retried with backoff
+    - Already deleted resources(*.NotFound) are skipped
+
+    Init
+        inventory: discovered `VPCInventory`
+        ec2_client: boto3.client('ec2')
+        elb_client: boto3.client('elbv2')
+        max_workers: resources to delete at once per type(default: 8)
+        retries: dependency retry count(default: 10)
+        wait_timeout: max seconds to wait instances, NAT Gateway and load balancers(default: 900)
+    """
+    def __init__(self, inventory, ec2_client, elb_client, max_workers=8, retries=10, wait_timeout=900):
+        self.inventory = inventory
+        self.ec2_client = ec2_client
+        self.elb_client = elb_client
+        self.max_workers = max_workers
+        self.retries = retries
+        self.wait_timeout = wait_timeout
+        self.deleted = {}
+        self.executor = None
+
+    def _call(self, func, **kwargs):
+        """Call delete API(retry dependency and throttling errors, skip not found), return response or False"""
+        try:
+            return call_with_backoff(func, retries=self.retries, base_delay=2, max_delay=30,
+                                     error_codes=THROTTLE_ERROR_CODES + DEPENDENCY_ERROR_CODES, **kwargs)
+        except ClientError as e:
+            if _is_not_found(e):
+                return False
+            raise
+
+    def _delete_all(self, resource_type, items, func):
+        """Run func on every item concurrently and count deleted resources"""
+        if not items:
+            self.deleted[resource_type] = 0
+            return
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(items)))) as pool:
+            results = list(pool.map(func, items))
+        self.deleted[resource_type] = sum(1 for result in results if result is not False)
+
+    def _waiter_config(self, delay):
+        return {"Delay": delay, "MaxAttempts": max(1, int(self.wait_timeout / delay))}
+
+    def delete_load_balancers(self):
+        arns = [lb["LoadBalancerArn"] for lb in self.inventory.load_balancers]
+        self._delete_all("load_balancers", arns,
+                         lambda arn: self._call(self.elb_client.delete_load_balancer, LoadBalancerArn=arn))
+        if arns:
+            with tracer.waiting("load_balancers_deleted"):
+                self.elb_client.get_waiter("load_balancers_deleted") \
+                    .wait(LoadBalancerArns=arns, WaiterConfig=self._waiter_config(5))
+
+    def delete_target_groups(self):
+        self._delete_all("target_groups", [tgr["TargetGroupArn"] for tgr in self.inventory.target_groups],
+                         lambda arn: self._call(self.elb_client.delete_target_group, TargetGroupArn=arn))
+
+    def _terminate(self, instance_ids):
+        """
+        Terminate instances with one call
+        (one unknown id fails the whole call, ids are terminated one by one then)
+
+        :param instance_ids: instance ids(up to 1000)
+        :return: ids accepted by terminate_instances
+        """
+        response = self._call(self.ec2_client.terminate_instances, InstanceIds=instance_ids)
+        if response is False:
+            if len(instance_ids) == 1:
+                return []
+            return [instance_id for single in instance_ids for instance_id in self._terminate([single])]
+
+        return [instance["InstanceId"] for instance in response.get("TerminatingInstances", [])]
+
+    def _terminated(self, instance_ids):
+        """Ids of instances described as terminated"""
+        terminated = []
+        for i in range(0, len(instance_ids), 200):
+            for page in self.ec2_client.get_paginator("describe_instances").paginate(
+                    Filters=[{"Name": "instance-id", "Values": instance_ids[i:i + 200]},
+                             {"Name": "instance-state-name", "Values": ["terminated"]}]):
+                terminated.extend(instance["InstanceId"]
+                                  for reservation in page["Reservations"] for instance in reservation["Instances"])
+
+        return terminated
+
+    def delete_instances(self):
+        instance_ids = [instance["InstanceId"] for instance in self.inventory.instances]
+        self.deleted["instances"] = 0
+        terminating = []
+        # one call terminates all instances(up to 1000 ids per call)
+        for i in range(0, len(instance_ids), 1000):
+            terminating.extend(self._terminate(instance_ids[i:i + 1000]))
+        if not terminating:
+            return
+        wait_for(self.ec2_client, "instance_terminated", terminating, timeout=self.wait_timeout)
+        # only instances seen terminated are counted
+        self.deleted["instances"] = len(self._terminated(terminating))
+
+    def delete_nat_gateways(self):
+        nat_ids = [nat["NatGatewayId"] for nat in self.inventory.nat_gateways]
+        self._delete_all("nat_gateways", nat_ids,
+                         lambda nat_id: self._call(self.ec2_client.delete_nat_gateway, NatGatewayId=nat_id))
+        if nat_ids:
+            wait_for(self.ec2_client, "nat_gateway_deleted", nat_ids, timeout=self.wait_timeout)
+
+    def delete_key_pairs(self):
+        self._delete_all("key_pairs", self.inventory.key_pairs,
+                         lambda name: self._call(self.ec2_client.delete_key_pair, KeyName=name))
+
+    def release_addresses(self):
+        self._delete_all("addresses", [eip["AllocationId"] for eip in self.inventory.addresses],
+                         lambda allocation_id: self._call(self.ec2_client.release_address,
+                                                          AllocationId=allocation_id))
+
+    def delete_internet_gateways(self):
+        def delete(gw_id):
+            self._call(self.ec2_client.detach_internet_gateway,
+                       InternetGatewayId=gw_id, VpcId=self.inventory.vpc_id)
+            return self._call(self.ec2_client.delete_internet_gateway, InternetGatewayId=gw_id)
+
+        self._delete_all("internet_gateways",
+                         [gw["InternetGatewayId"] for gw in self.inventory.internet_gateways], delete)
+
+    def delete_route_tables(self):
+        def delete(rt):
+            for rta in rt.get("Associations", []):
+                self._call(self.ec2_client.disassociate_route_table, AssociationId=rta["RouteTableAssociationId"])
+            return self._call(self.ec2_client.delete_route_table, RouteTableId=rt["RouteTableId"])
+
+        # main route table is deleted with VPC
+        self._delete_all("route_tables",
+                         [rt for rt in self.inventory.route_tables
+                          if not any(rta.get("Main") for rta in rt.get("Associations", []))], delete)
+
+    def delete_network_interfaces(self):
+        # interfaces managed by AWS(NAT Gateway, load balancers) or deleted with instances are skipped
+        enis = [eni for eni in self.inventory.network_interfaces
+                if not eni.get("RequesterManaged")
+                and not eni.get("Attachment", {}).get("DeleteOnTermination")]
+        self._delete_all("network_interfaces", [eni["NetworkInterfaceId"] for eni in enis],
+                         lambda eni_id: self._call(self.ec2_client.delete_network_interface,
+                                                   NetworkInterfaceId=eni_id))
+
+    def delete_security_groups(self):
+        groups = [group for group in self.inventory.security_groups if group.get("GroupName") != "default"]
+
+        # rules that reference other groups block deleting those groups
+        def revoke(group):
+            ingress = [p for p in group.get("IpPermissions", []) if p.get("UserIdGroupPairs")]
+            egress = [p for p in group.get("IpPermissionsEgress", []) if p.get("UserIdGroupPairs")]
+            if ingress:
+                self._call(self.ec2_client.revoke_security_group_ingress,
+                           GroupId=group["GroupId"], IpPermissions=ingress)
+            if egress:
+                self._call(self.ec2_client.revoke_security_group_egress,
+                           GroupId=group["GroupId"], IpPermissions=egress)
+
+            return bool(ingress or egress)
+
+        self._delete_all("security_group_rules", groups, revoke)
+        self._delete_all("security_groups", [group["GroupId"] for group in groups],
+                         lambda group_id: self._call(self.ec2_client.delete_security_group, GroupId=group_id))
+
+    def delete_subnets(self):
+        self._delete_all("subnets", [subnet["SubnetId"] for subnet in self.inventory.subnets],
+                         lambda subnet_id: self._call(self.ec2_client.delete_subnet, SubnetId=subnet_id))
+
+    def delete_vpc(self):
+        self.deleted["vpc"] = 1 if self._call(self.ec2_client.delete_vpc, VpcId=self.inventory.vpc_id) else 0
+
+    def steps(self):
+        """
+        Get step functions by step name
+
+        :return: {step name: function}
+        """
+        return {"load_balancers": self.delete_load_balancers,
+                "instances": self.delete_instances,
+                "nat_gateways": self.delete_nat_gateways,
+                "key_pairs": self.delete_key_pairs,
+                "route_tables": self.delete_route_tables,
+                "target_groups": self.delete_target_groups,
+                "addresses": self.release_addresses,
+                "internet_gateways": self.delete_internet_gateways,
+                "network_interfaces": self.delete_network_interfaces,
+                "security_groups": self.delete_security_groups,
+                "subnets": self.delete_subnets,
+                "vpc": self.delete_vpc}
+
+    def graph(self, max_workers=6):
+        """
+        Build deletion graph
+
+        :param max_workers: steps to run at once
+        :return: DAGExecutor
+        """
+        steps = self.steps()
+        executor = DAGExecutor(max_workers=max_workers)
+        for name, requires in TEARDOWN_GRAPH:
+            executor.add(name, steps[name], requires=requires)
+
+        return executor
+
+    def run(self, print_summary=True):
+        """
+        Delete all resources
+
+        :param print_summary: print step timings(default: True)
+        :return: {resource type: deleted count}
+        """
+        executor = self.executor = self.graph()
+        try:
+            executor.run()
+        finally:
+            if print_summary:
+                executor.print_summary()
+
+        return self.deleted
@@ -2,68 +2,89 @@ from model.ec2 import DefaultEc2
 from model.vpc import DefaultVPC
 from model.elb import ELB
 from util.decorators import *
+from discovery import VPCInventory
+from plan import TeardownPlan, LatencyStats, DEFAULT_STATS_PATH
+from util.ratelimit import limiter
+import sys
 
 
 class VPCCleaner:
     """
     This class have delete all vpc resources features
+    Resources are discovered once(`VPCInventory`) and every delete step reads from that inventory
 
     Init
         vpc_id: vpc id to delete
         region: region
+        inventory: `VPCInventory` of a saved plan(default: None, discover)
     """
-    def __init__(self, vpc_id, region="us-east-1"):
+    def __init__(self, vpc_id, region="us-east-1", inventory=None):
+        self.region = region
         self.d_vpc = DefaultVPC(region=region)
         self.d_ec2 = DefaultEc2(vpc_id=vpc_id, region=region)
         self.d_elb = ELB(region=region)
         self.vpc_id = vpc_id
         self.vpc = self.d_ec2.vpc
 
+        if inventory is None:
+            inventory = VPCInventory(vpc_id=vpc_id,
+                                     ec2_client=self.d_ec2.ec2_client,
+                                     elb_client=self.d_elb.elb_client).discover()
+        self.inventory = inventory
+        self.inventory.print_summary()
+
+    @classmethod
+    def from_plan(cls, path):
+        """Make cleaner from saved plan file(no discovery)"""
+        plan = TeardownPlan.load(path)
+        return cls(vpc_id=plan.inventory.vpc_id, region=plan.region, inventory=plan.inventory)
+
+    def plan(self, stats_path=DEFAULT_STATS_PATH):
+        """
+        Make deletion plan with time estimate(nothing is deleted)
+
+        :param stats_path: deletion time stats file
+        :return: TeardownPlan
+        """
+        return TeardownPlan(inventory=self.inventory, region=self.region, stats=LatencyStats(stats_path))
+
     @Printer(post="Deleted all Load Balancers")
     def delete_all_elb(self):
-        """Delete all elb"""
-        response = self.d_elb.elb_client.describe_load_balancers()
-        for lb in response.get("LoadBalancers"):
+        """Delete all elb on VPC"""
+        for lb in self.inventory.load_balancers:
             self.d_elb.delete_elb_by_arn(lb.get("LoadBalancerArn"))
 
         return self
 
     @Printer(post="Deleted all Target Groups")
     def delete_all_tgr(self):
-        """Delete all target group on elb"""
-        response = self.d_elb.elb_client.describe_target_groups()
-        for tgr in response.get("TargetGroups"):
+        """Delete all target group on VPC"""
+        for tgr in self.inventory.target_groups:
             self.d_elb.delete_tgr_by_arn(tgr.get("TargetGroupArn"))
 
         return self
 
     @Printer(post="Deleted all EC2")
     def delete_all_ec2(self):
-        """Terminate all EC2"""
-        instance_ids = []
-        response = self.d_ec2.ec2_client.describe_instances()
-        for reservation in response.get("Reservations"):
-            for instance in reservation.get("Instances"):
-                instance_ids.append(instance.get("InstanceId"))
-
-        self.d_ec2.delete_ec2_by_ids(instance_ids)
+        """Terminate all EC2 on VPC"""
+        instance_ids = [instance.get("InstanceId") for instance in self.inventory.instances]
+        if instance_ids:
+            self.d_ec2.delete_ec2_by_ids(instance_ids)
 
         return self
 
     @Printer(post="Deleted all key pairs")
     def delete_all_key_pair(self):
-        """Delete all key pair"""
-        response = self.d_ec2.ec2_client.describe_key_pairs()
-        for key in response.get("KeyPairs"):
-            self.d_ec2.delete_key_pair_by_name(key.get("KeyName"))
+        """Delete key pairs used by EC2 on VPC"""
+        for key_name in self.inventory.key_pairs:
+            self.d_ec2.delete_key_pair_by_name(key_name)
 
         return self
 
     @Printer(post="Deleted all Security Groups")
     def delete_all_sg(self):
-        """Delete all security group"""
-        response = self.d_ec2.ec2_client.describe_security_groups()
-        for group in response.get("SecurityGroups"):
+        """Delete all security group on VPC(except default)"""
+        for group in self.inventory.security_groups:
             if group.get("GroupName") != "default":
                 self.d_ec2.delete_sg_by_id(group.get("GroupId"))
 
@@ -71,18 +92,16 @@ class VPCCleaner:
 
     @Printer(post="Deleted all NAT Gateway")
     def delete_all_nat(self):
-        """Delete all NAT Gateway"""
-        response = self.d_vpc.ec2_client.describe_nat_gateways()
-        for nat in response.get("NatGateways"):
+        """Delete all NAT Gateway on VPC"""
+        for nat in self.inventory.nat_gateways:
             self.d_vpc.delete_nat_by_id(nat.get("NatGatewayId"))
 
         return self
 
     @Printer(post="Release all EIP")
     def release_all_eip(self):
-        """Release all EIP"""
-        response = self.d_ec2.ec2_client.describe_addresses()
-        for eip in response.get("Addresses"):
+        """Release all EIP associated on VPC"""
+        for eip in self.inventory.addresses:
             self.d_ec2.release_eip_by_id(eip.get("AllocationId"))
 
         return self
@@ -90,47 +109,67 @@ class VPCCleaner:
     @Printer(post="Deleted VPC")
     def delete_vpc(self):
         """Delete resources(subnets, routing table, vpc) on VPC"""
-        for gw in self.vpc.internet_gateways.all():
-            self.vpc.detach_internet_gateway(InternetGatewayId=gw.id)
-            gw.delete()
+        ec2_client = self.d_ec2.ec2_client
+
+        for gw in self.inventory.internet_gateways:
+            ec2_client.detach_internet_gateway(InternetGatewayId=gw["InternetGatewayId"], VpcId=self.vpc_id)
+            ec2_client.delete_internet_gateway(InternetGatewayId=gw["InternetGatewayId"])
 
-        for rt in self.vpc.route_tables.all():
-            for rta in rt.associations:
-                if not rta.main:
-                    rta.delete()
+        for rt in self.inventory.route_tables:
+            if any(rta.get("Main") for rta in rt.get("Associations", [])):
+                continue
 
-            for r in rt.routes:
-                try:
-                    r.delete()
-                except:
-                    pass
+            for rta in rt.get("Associations", []):
+                ec2_client.disassociate_route_table(AssociationId=rta["RouteTableAssociationId"])
 
             try:
-                rt.delete()
+                ec2_client.delete_route_table(RouteTableId=rt["RouteTableId"])
             except:
                 pass
 
-        for subnet in self.vpc.subnets.all():
-            for interface in subnet.network_interfaces.all():
-                interface.delete()
-            subnet.delete()
+        for eni in self.inventory.network_interfaces:
+            try:
+                ec2_client.delete_network_interface(NetworkInterfaceId=eni["NetworkInterfaceId"])
+            except:
+                pass
+
+        for subnet in self.inventory.subnets:
+            ec2_client.delete_subnet(SubnetId=subnet["SubnetId"])
 
         self.d_vpc.delete_vpc_by_id(self.vpc_id)
 
         return self
 
+    def teardown(self, max_workers=8, stats_path=DEFAULT_STATS_PATH):
+        """
+        Delete all resources with dependency-aware parallel engine
+        Step times are recorded to stats file for later plan estimates
+
+        :param max_workers: resources to delete at once per type
+        :param stats_path: deletion time stats file
+        :return: {resource type: deleted count}
+        """
+        try:
+            return self.plan(stats_path).apply(ec2_client=self.d_ec2.ec2_client,
+                                               elb_client=self.d_elb.elb_client,
+                                               max_workers=max_workers)
+        finally:
+            limiter.print_summary()
+
 
 if __name__ == '__main__':
     ### Params
     region = "ap-northeast-2"
     vpc_id = "vpc-0d6841a3914124596"
-
-    VPCCleaner(vpc_id=vpc_id, region=region) \
-        .delete_all_elb() \
-        .delete_all_ec2() \
-        .delete_all_tgr() \
-        .delete_all_key_pair() \
-        .delete_all_nat() \
-        .release_all_eip() \
-        .delete_all_sg() \
-        .delete_vpc()
+    plan_path = "teardown-plan.json"
+
+    ### Usage
+    # python vpc_cleaner.py         : discover, save plan and delete after confirm
+    # python vpc_cleaner.py apply   : delete resources of saved plan(no discovery)
+    if len(sys.argv) > 1 and sys.argv[1] == "apply":
+        VPCCleaner.from_plan(plan_path).teardown()
+    else:
+        cleaner = VPCCleaner(vpc_id=vpc_id, region=region)
+        cleaner.plan().print_plan().save(plan_path)
+        if input("Do you want to apply this plan?(y/n) : ") == "y":
+            cleaner.teardown()
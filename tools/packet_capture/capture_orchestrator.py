@@ -0,0 +1,224 @@
+from packet_capture import RemotePCAP
+from util.ssh_pool import SSHPool
+from util.session import get_client
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import re
+import threading
+import time
+
+
+class CaptureOrchestrator:
+    """
+    This class capture packets on many EC2 at the same time
+    - Targets can be instance id(i-...), ip address or tag(Key=Value, `*` wildcard allowed)
+    - All sessions share one bastion connection(`util.ssh_pool.SSHPool`)
+    - tcpdump is started and stopped on every host at once, pcap files are downloaded in parallel
+    - {pcap_prefix}-manifest.json has per host file, start/stop time and clock offset to merge captures
+
+    Init
+        region: region
+        targets: target list(instance id, ip address or tag)
+        pem_key_path: key pair path to connecting
+        p_kill_script: script file to kill tcpdump process
+        pcap_prefix: pcap file name prefix(file: {prefix}-{instance id or ip}.pcap)
+        eth: ethernet interface to packet capturing
+        bastion_ip: bastion ip address to connecting private servers(default: None)
+        user_name: user name on server(default: ec2-user)
+        local_pcap_path: local path to save packet capture logs
+        max_workers: hosts to handle at once(default: 10)
+        options: `util.pcap.CaptureOptions` for every host(default: None)
+    """
+    def __init__(self, region, targets, pem_key_path, p_kill_script, pcap_prefix="capture",
+                 eth="eth0", bastion_ip=None, user_name="ec2-user", local_pcap_path="./", max_workers=10,
+                 options=None):
+        self.ec2_client = get_client("ec2", region)
+        self.region = region
+        self.pem_key_path = pem_key_path
+        self.p_kill_script = p_kill_script
+        self.pcap_prefix = pcap_prefix
+        self.eth = eth
+        self.bastion_ip = bastion_ip
+        self.user_name = user_name
+        self.local_pcap_path = local_pcap_path
+        self.max_workers = max_workers
+        self.options = options
+
+        self.pool = SSHPool(bastion_ip=bastion_ip, pem_key_path=pem_key_path, user=user_name)
+        self.hosts = self._resolve_targets(targets)
+        self.captures = []
+
+    def _describe(self, filters):
+        instances = []
+        paginator = self.ec2_client.get_paginator("describe_instances")
+        for page in paginator.paginate(Filters=filters + [{"Name": "instance-state-name", "Values": ["running"]}]):
+            for reservation in page["Reservations"]:
+                instances.extend(reservation["Instances"])
+
+        return instances
+
+    def _resolve_targets(self, targets):
+        """
+        Resolve targets to (instance id, ip address) list
+        One describe call for ids, one for ips and one per tag
+
+        :param targets: target list
+        :return: [{"instance_id": ..., "ip": ...}]
+        """
+        ids = [t for t in targets if t.startswith("i-")]
+        ips = [t for t in targets if re.match(r"^\d+\.\d+\.\d+\.\d+$", t)]
+        tags = [t for t in targets if "=" in t]
+
+        instances = []
+        if ids:
+            instances += self._describe([{"Name": "instance-id", "Values": ids}])
+        if ips:
+            ip_filter = "private-ip-address" if self.bastion_ip else "ip-address"
+            instances += self._describe([{"Name": ip_filter, "Values": ips}])
+        for tag in tags:
+            key, value = tag.split("=", 1)
+            instances += self._describe([{"Name": "tag:{}".format(key), "Values": [value]}])
+
+        hosts = []
+        seen = set()
+        for instance in instances:
+            if instance["InstanceId"] in seen:
+                continue
+            seen.add(instance["InstanceId"])
+            ip = instance.get("PrivateIpAddress") if self.bastion_ip else instance.get("PublicIpAddress")
+            hosts.append({"instance_id": instance["InstanceId"], "ip": ip})
+
+        # ip addresses that are not our instances are used as they are
+        found_ips = set(host["ip"] for host in hosts)
+        for ip in ips:
+            if ip not in found_ips:
+                hosts.append({"instance_id": None, "ip": ip})
+
+        if not hosts:
+            raise ValueError("no running instance matches {}".format(targets))
+
+        return hosts
+
+    def _map(self, func, items, max_workers=None):
+        with ThreadPoolExecutor(max_workers=max(1, max_workers or self.max_workers)) as executor:
+            return list(executor.map(func, items))
+
+    def _clock_offset(self, capture):
+        """
+        Measure server clock offset(server - local) using midpoint of request
+
+        :return: (offset seconds, round trip seconds)
+        """
+        sent = time.time()
+        stream = capture.ssh_connector.stream_command("date +%s.%N")
+        lines = [line for name, line in stream if name == "stdout"]
+        received = time.time()
+
+        return float(lines[0]) - (sent + received) / 2, received - sent
+
+    def _connect(self, host):
+        name = host["instance_id"] or host["ip"]
+        capture = RemotePCAP(region=self.region, target_ip=host["ip"], pem_key_path=self.pem_key_path,
+                             pcap_file_name="{}-{}.pcap".format(self.pcap_prefix, name),
+                             p_kill_script=self.p_kill_script, eth=self.eth, bastion_ip=self.bastion_ip,
+                             user_name=self.user_name, local_pcap_path=self.local_pcap_path, pool=self.pool,
+                             options=self.options)
+        capture.prepare()
+        host["clock_offset"], host["rtt"] = self._clock_offset(capture)
+        host["file"] = os.path.join(self.local_pcap_path, capture.pcap_file_name)
+
+        return capture
+
+    def start(self):
+        """Connect all hosts, then start tcpdump on every host at the same moment"""
+        futures = []
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+                futures = [executor.submit(self._connect, host) for host in self.hosts]
+            self.captures = [future.result() for future in futures]
+        except BaseException:
+            # sessions already opened to other hosts are closed with the pool
+            for future in futures:
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    future.result().ssh_connector.release_pool()
+            self.pool.close()
+            raise
+
+        barrier = threading.Barrier(len(self.captures))
+
+        def run(item):
+            host, capture = item
+            barrier.wait()
+            # control ssh connection is resolved by prepare(), only the tcpdump command is sent here
+            capture.run_tcpdump()
+            host["start"] = time.time()
+
+        # every host needs own thread to pass the barrier together
+        self._map(run, list(zip(self.hosts, self.captures)), max_workers=len(self.captures))
+
+        return self
+
+    def stop(self):
+        """
+        Stop tcpdump on every host at once and download all pcap files in parallel
+
+        :return: manifest dict
+        """
+        barrier = threading.Barrier(len(self.captures))
+
+        def kill(item):
+            host, capture = item
+            barrier.wait()
+            host["stop"] = time.time()
+            host["tcpdump"] = capture.kill_tcpdump()
+
+        items = list(zip(self.hosts, self.captures))
+        try:
+            self._map(kill, items, max_workers=len(items))
+            self._map(lambda item: item[1].download(), items)
+        finally:
+            # bastion transport and leased sessions are closed even if a host fails
+            self.pool.close()
+
+        return self.write_manifest()
+
+    def write_manifest(self, path=None):
+        """
+        Write manifest of captures
+        start/stop are local epoch seconds, add clock_offset to get server time
+
+        :param path: manifest path(default: {local_pcap_path}/{pcap_prefix}-manifest.json)
+        :return: manifest dict
+        """
+        manifest = {"region": self.region,
+                    "interface": self.eth,
+                    "created": time.time(),
+                    "hosts": self.hosts}
+        path = path or os.path.join(self.local_pcap_path, "{}-manifest.json".format(self.pcap_prefix))
+        with open(path, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+        return manifest
+
+
+if __name__ == '__main__':
+    ### Params
+    region = "{us-east-1}"
+    bastion_ip = "{enter your bastion IP(public ip address)}"
+    targets = ["Name=WEB-*", "{enter instance id or IP}"]
+    pem_key_path = "{enter your private pem key}"
+    local_pcap_path = "./"
+
+    orchestrator = CaptureOrchestrator(region=region, targets=targets, pem_key_path=pem_key_path,
+                                       p_kill_script="../../scripts/kill_tcpdump.sh",
+                                       bastion_ip=bastion_ip, local_pcap_path=local_pcap_path)
+    orchestrator.start()
+
+    answer = ""
+    while answer != "y":
+        print("packet capture is running on {} hosts...".format(len(orchestrator.hosts)))
+        answer = input("Do you want to quit and save?(y/n) : ")
+
+    orchestrator.stop()
+    print("bye")
@@ -1,5 +1,43 @@
 from util.ssh import SSHConnector
+from util.ssh_pool import SSHPool
+from util.pcap import CaptureOptions, PcapStreamParser, RotatingPcapWriter, parse_tcpdump_stats
 import atexit
+import os
+import socket
+import threading
+import time
+
+
+class StreamCaptureStats:
+    """
+    This class hold statistics of streaming capture
+    """
+    def __init__(self):
+        self.started_at = None
+        self.finished_at = None
+        self.packets = 0
+        self.bytes = 0
+        self.files = []
+        self.tcpdump = {}
+
+    @property
+    def duration(self):
+        return (self.finished_at or time.time()) - self.started_at if self.started_at else 0.0
+
+    @property
+    def throughput(self):
+        """Bytes per second received from server"""
+        return self.bytes / self.duration if self.duration else 0.0
+
+    @property
+    def dropped(self):
+        """Packets dropped by kernel(None if tcpdump did not report)"""
+        return self.tcpdump.get("dropped")
+
+    def summary(self):
+        return "packets: {}, bytes: {}, {:.1f} KB/s, dropped: {}, files: {}".format(
+            self.packets, self.bytes, self.throughput / 1024,
+            "-" if self.dropped is None else self.dropped, len(self.files))
 
 
 class RemotePCAP:
@@ -19,10 +57,13 @@ class RemotePCAP:
         bastion_ip: bastion ip address to connecting private server(default: None)
         user_name: user name on server(default: ec2-user)
         local_pcap_path: local path to save packet capture logs
+        pool: `util.ssh_pool.SSHPool` to share bastion connection(default: None, make own pool)
+        options: `util.pcap.CaptureOptions`(filter, snaplen, ring buffer ...)
+            default: all packets except the control ssh connection
     """
     def __init__(self, region, target_ip, pem_key_path, pcap_file_name,
                  p_kill_script, eth="eth0", bastion_ip=None, user_name="ec2-user",
-                 local_pcap_path="./"):
+                 local_pcap_path="./", pool=None, options=None):
         self.ssh_connector = SSHConnector(region=region)
         self.target_ip = target_ip
         self.pem_key_path = pem_key_path
@@ -34,43 +75,190 @@ class RemotePCAP:
         self.local_pcap_path = local_pcap_path
 
         self.remote_kill_script = "/home/ec2-user/kill_tcpdump.sh"
+        self.options = options or CaptureOptions()
+        self.capture_stats = {}
+        # (peer ip, peer port, local port) of control ssh connection, resolved once
+        self.control_ssh = None
 
-        self.tunnel = None
-        if self.bastion_ip is None:
-            self.ssh_connector.connect_ssh(ip_address=self.target_ip, pem_key_path=self.pem_key_path)
-        else:
-            self.tunnel = self.ssh_connector.tunneling(host=self.bastion_ip,
-                                         host_port=22,
-                                         user=self.user_name,
-                                         pem_key_path=self.pem_key_path,
-                                         remote_ip=self.target_ip,
-                                         remote_port=22)
-            self.tunnel.start()
-            self.ssh_connector.connect_ssh(ip_address="127.0.0.1", port=10022, pem_key_path=self.pem_key_path)
+        self.own_pool = pool is None
+        if self.own_pool:
+            pool = SSHPool(bastion_ip=self.bastion_ip, pem_key_path=self.pem_key_path, user=self.user_name)
+        self.pool = pool
+        self.ssh_connector.connect_pool(self.pool, self.target_ip,
+                                        user=self.user_name, pem_key_path=self.pem_key_path)
 
     def install_tcpdump(self):
         """Install tcpdump package on server"""
         self.ssh_connector.command_delivery(commands="sudo yum install tcpdump -y")
 
+    def prepare(self):
+        """Send kill script to server and resolve control ssh connection(nothing is asked when tcpdump starts)"""
+        self.ssh_connector.send_file(local_path=self.p_kill_script, remote_path=self.remote_kill_script)
+        self.resolve_control_ssh()
+
+    def _control_ssh(self):
+        """
+        Get control ssh connection seen from server($SSH_CLIENT)
+
+        :return: (peer ip, peer port, local port) or None
+        """
+        stream = self.ssh_connector.stream_command("echo $SSH_CLIENT")
+        lines = [line.split() for name, line in stream if name == "stdout"]
+        if not lines or len(lines[0]) != 3:
+            return None
+
+        return tuple(lines[0])
+
+    def resolve_control_ssh(self):
+        """
+        Get control ssh connection once(cached in `control_ssh`)
+
+        :return: (peer ip, peer port, local port) or None
+        """
+        if self.options.exclude_control_ssh and self.control_ssh is None:
+            self.control_ssh = self._control_ssh()
+
+        return self.control_ssh
+
+    def _tcpdump_args(self, output, ring=True):
+        return self.options.tcpdump_args(self.eth, output, control_ssh=self.resolve_control_ssh(), ring=ring)
+
+    def run_tcpdump(self):
+        """Run tcpdump on server(background, exit summary is saved to {pcap_file_name}.log)"""
+        self.ssh_connector.command_delivery(commands="sudo nohup tcpdump {} > /dev/null 2> {}.log".format(
+            self._tcpdump_args(self.pcap_file_name), self.pcap_file_name), is_buf_over=True)
+
     def start(self):
         """Start packet capture on server"""
+        self.prepare()
+        self.run_tcpdump()
+
+    def start_stream(self, rotate_bytes=None, rotate_seconds=None, compress=False, chunk_size=65536):
+        """
+        Start packet capture and stream packets to local files while capturing
+        - tcpdump writes to stdout(`-w -`) over ssh channel, nothing is saved on server
+        - Local files are rotated by size or time({local_pcap_path}/{pcap_file_name}-0000.pcap ...)
+
+        :param rotate_bytes: max bytes per local file(default: None, no limit)
+        :param rotate_seconds: max seconds per local file(default: None, no limit)
+        :param compress: gzip local files(default: False)
+        :param chunk_size: bytes to read at once
+        :return: StreamCaptureStats(updated while capturing)
+        """
         self.ssh_connector.send_file(local_path=self.p_kill_script, remote_path=self.remote_kill_script)
 
-        self.ssh_connector.command_delivery(commands="sudo nohup tcpdump -i {} -w {}".format(self.eth, self.pcap_file_name), is_buf_over=True)
+        prefix = os.path.join(self.local_pcap_path, os.path.splitext(self.pcap_file_name)[0])
+        self.stream_writer = RotatingPcapWriter(prefix, rotate_bytes=rotate_bytes,
+                                                rotate_seconds=rotate_seconds, compress=compress)
+        self.stream_stats = StreamCaptureStats()
+        self.stream_channel = self.ssh_connector.ssh.get_transport().open_session()
+        self.stream_channel.exec_command("sudo tcpdump {}".format(self._tcpdump_args("-", ring=False)))
+        self.stream_stats.started_at = time.time()
 
-    def stop(self):
-        """Stop packet capture process and save logs on local PC"""
-        # kill tcpdump process
+        self.stream_thread = threading.Thread(target=self._receive_stream, args=(chunk_size,), daemon=True)
+        self.stream_thread.start()
+
+        return self.stream_stats
+
+    def _receive_stream(self, chunk_size):
+        """Read pcap stream from channel and write records to local files"""
+        parser = PcapStreamParser()
+        stderr = bytearray()
+        channel = self.stream_channel
+        rotate_seconds = self.stream_writer.rotate_seconds
+        if rotate_seconds:
+            # wake up on a quiet link to rotate by time
+            channel.settimeout(min(1.0, rotate_seconds))
+        try:
+            while True:
+                try:
+                    data = channel.recv(chunk_size)
+                except socket.timeout:
+                    self.stream_writer.tick()
+                    continue
+                while channel.recv_stderr_ready():
+                    stderr.extend(channel.recv_stderr(chunk_size))
+                if not data:
+                    break
+
+                self.stream_stats.bytes += len(data)
+                records = parser.feed(data)
+                if parser.global_header is not None and self.stream_writer.global_header is None:
+                    self.stream_writer.write_header(parser.global_header)
+                for record in records:
+                    self.stream_writer.write(record)
+                self.stream_stats.packets += len(records)
+
+            channel.recv_exit_status()
+            while channel.recv_stderr_ready():
+                stderr.extend(channel.recv_stderr(chunk_size))
+        finally:
+            self.stream_writer.close()
+            self.stream_stats.files = list(self.stream_writer.files)
+            self.stream_stats.tcpdump = parse_tcpdump_stats(stderr.decode("utf-8", "replace"))
+            self.stream_stats.finished_at = time.time()
+
+    def stop_stream(self, timeout=30):
+        """
+        Stop streaming capture and close local files
+
+        :param timeout: seconds to wait for remaining packets
+        :return: StreamCaptureStats
+        """
+        self.ssh_connector.command_delivery(commands=". {}".format(self.remote_kill_script))
+
+        self.stream_thread.join(timeout)
+        self.stream_channel.close()
+
+        self.ssh_connector.release_pool()
+        if self.own_pool:
+            self.pool.close()
+
+        print(self.stream_stats.summary())
+
+        return self.stream_stats
+
+    def kill_tcpdump(self, timeout=10):
+        """
+        Stop tcpdump process on server and read capture statistics
+
+        :param timeout: seconds to wait for tcpdump exit summary
+        :return: {"captured": .., "received": .., "dropped": ..}
+        """
         self.ssh_connector.command_delivery(commands=". {}".format(self.remote_kill_script))
 
-        # get pcap file
-        self.ssh_connector.get_file(remote_path="/home/ec2-user/{}".format(self.pcap_file_name),
-                                    local_path=self.local_pcap_path)
+        deadline = time.time() + timeout
+        while True:
+            stream = self.ssh_connector.stream_command("cat {}.log".format(self.pcap_file_name))
+            self.capture_stats = parse_tcpdump_stats("\n".join(line for name, line in stream))
+            if "captured" in self.capture_stats or time.time() > deadline:
+                break
+            time.sleep(0.5)
+
+        print("{}: {}".format(self.target_ip, self.capture_stats or "no tcpdump summary"))
 
-        self.ssh_connector.ssh.close()
+        return self.capture_stats
+
+    def download(self):
+        """Get pcap file(all ring buffer files if -C is used) from server"""
+        remote_files = [self.pcap_file_name]
+        if self.options.ring_file_mb:
+            stream = self.ssh_connector.stream_command("ls -1 {}*".format(self.pcap_file_name))
+            remote_files = [line for name, line in stream
+                            if name == "stdout" and not line.endswith(".log")]
+
+        for remote_file in remote_files:
+            self.ssh_connector.get_file(remote_path="/home/ec2-user/{}".format(remote_file),
+                                        local_path=self.local_pcap_path)
+
+    def stop(self):
+        """Stop packet capture process and save logs on local PC"""
+        self.kill_tcpdump()
+        self.download()
 
-        if self.tunnel:
-            self.tunnel.stop()
+        self.ssh_connector.release_pool()
+        if self.own_pool:
+            self.pool.close()
 
 if __name__ == '__main__':
     ### Params
@@ -0,0 +1,346 @@
+from util.pcap import GLOBAL_HEADER_LEN, RECORD_HEADER_LEN, open_pcap, parse_global_header
+import gzip
+import ipaddress
+import json
+import os
+import struct
+import sys
+
+# link types
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+
+PROTOCOLS = {6: "tcp", 17: "udp", 1: "icmp", 58: "icmpv6"}
+
+INDEX_VERSION = 1
+
+
+def iter_records(f):
+    """
+    read pcap records one by one(constant memory)
+
+    :param f: pcap file object(at start of file)
+    :return: generator of (record offset, timestamp, packet data), global header info
+    """
+    header = f.read(GLOBAL_HEADER_LEN)
+    endian, is_nsec, snaplen, linktype = parse_global_header(header)
+    record_format = endian + "IIII"
+    divisor = 1e9 if is_nsec else 1e6
+
+    def records():
+        offset = GLOBAL_HEADER_LEN
+        while True:
+            record_header = f.read(RECORD_HEADER_LEN)
+            if len(record_header) < RECORD_HEADER_LEN:
+                return
+            ts_sec, ts_frac, incl_len, orig_len = struct.unpack(record_format, record_header)
+            data = f.read(incl_len)
+            if len(data) < incl_len:
+                return
+            yield offset, ts_sec + ts_frac / divisor, data
+            offset += RECORD_HEADER_LEN + incl_len
+
+    return records(), linktype
+
+
+def parse_packet(linktype, data):
+    """
+    parse packet to flow fields
+
+    :param linktype: pcap link type
+    :param data: packet data
+    :return: (protocol, src ip, src port, dst ip, dst port, tcp seq, payload length, tcp flags) or None
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        if len(data) < 14:
+            return None
+        ether_type = struct.unpack_from("!H", data, 12)[0]
+        offset = 14
+        while ether_type in (0x8100, 0x88a8) and len(data) >= offset + 4:
+            ether_type = struct.unpack_from("!H", data, offset + 2)[0]
+            offset += 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if len(data) < 16:
+            return None
+        ether_type = struct.unpack_from("!H", data, 14)[0]
+        offset = 16
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        if not data:
+            return None
+        ether_type = 0x0800 if data[0] >> 4 == 4 else 0x86dd
+        offset = 0
+    else:
+        return None
+
+    if ether_type == 0x0800:
+        if len(data) < offset + 20:
+            return None
+        ihl = (data[offset] & 0x0f) * 4
+        total_len = struct.unpack_from("!H", data, offset + 2)[0]
+        proto = data[offset + 9]
+        src = str(ipaddress.IPv4Address(data[offset + 12:offset + 16]))
+        dst = str(ipaddress.IPv4Address(data[offset + 16:offset + 20]))
+        l4 = offset + ihl
+        ip_payload_len = total_len - ihl
+    elif ether_type == 0x86dd:
+        if len(data) < offset + 40:
+            return None
+        ip_payload_len = struct.unpack_from("!H", data, offset + 4)[0]
+        proto = data[offset + 6]
+        src = str(ipaddress.IPv6Address(data[offset + 8:offset + 24]))
+        dst = str(ipaddress.IPv6Address(data[offset + 24:offset + 40]))
+        l4 = offset + 40
+    else:
+        return None
+
+    sport = dport = seq = flags = None
+    payload_len = 0
+    if proto == 6 and len(data) >= l4 + 14:
+        sport, dport, seq = struct.unpack_from("!HHI", data, l4)
+        data_offset = (data[l4 + 12] >> 4) * 4
+        flags = data[l4 + 13]
+        payload_len = max(0, ip_payload_len - data_offset)
+    elif proto == 17 and len(data) >= l4 + 4:
+        sport, dport = struct.unpack_from("!HH", data, l4)
+        payload_len = max(0, ip_payload_len - 8)
+
+    return PROTOCOLS.get(proto, str(proto)), src, sport, dst, dport, seq, payload_len, flags
+
+
+def flow_key(protocol, src, sport, dst, dport):
+    """
+    make bidirectional flow key(both directions are the same flow)
+    Example: "tcp 10.0.1.5:80 <-> 10.0.3.7:41234"
+    """
+    a = "{}:{}".format(src, sport) if sport is not None else src
+    b = "{}:{}".format(dst, dport) if dport is not None else dst
+    return "{} {} <-> {}".format(protocol, *sorted([a, b]))
+
+
+class Flow:
+    """
+    This class hold per flow statistics and record offsets
+    """
+    def __init__(self, key):
+        self.key = key
+        self.packets = 0
+        self.bytes = 0
+        self.first = None
+        self.last = None
+        self.retransmits = 0
+        self.offsets = []
+        # per direction highest tcp sequence end
+        self._seq_end = {}
+
+    def add(self, offset, ts, size, direction=None, seq=None, payload_len=0, flags=None):
+        self.packets += 1
+        self.bytes += size
+        if self.first is None:
+            self.first = ts
+        self.last = ts
+        self.offsets.append(offset)
+
+        if seq is None:
+            return
+        # SYN and FIN use one sequence number
+        seq_len = payload_len + (1 if flags is not None and flags & 0x03 else 0)
+        if seq_len == 0:
+            return
+        end = (seq + seq_len) & 0xffffffff
+        last_end = self._seq_end.get(direction)
+        # sequence space wraps at 2^32, compare with serial number arithmetic
+        if last_end is not None and ((last_end - end) & 0xffffffff) < 0x80000000:
+            self.retransmits += 1
+        else:
+            self._seq_end[direction] = end
+
+    def to_dict(self):
+        deltas = [self.offsets[0]] + [b - a for a, b in zip(self.offsets, self.offsets[1:])] if self.offsets else []
+        return {"packets": self.packets, "bytes": self.bytes, "first": self.first, "last": self.last,
+                "retransmits": self.retransmits, "offsets": deltas}
+
+    @classmethod
+    def from_dict(cls, key, data):
+        flow = cls(key)
+        flow.packets = data["packets"]
+        flow.bytes = data["bytes"]
+        flow.first = data["first"]
+        flow.last = data["last"]
+        flow.retransmits = data["retransmits"]
+        offset = 0
+        for delta in data["offsets"]:
+            offset += delta
+            flow.offsets.append(offset)
+
+        return flow
+
+
+class PcapIndex:
+    """
+    This class index pcap file by flow and extract one flow without rescanning
+    - pcap is read record by record(constant memory)
+    - Index is saved to a sidecar file({pcap}.idx, gzip json, offsets are delta encoded)
+    - Size and mtime of pcap are saved with index, a sidecar of an older pcap with the same name is rebuilt
+
+    Init
+        pcap_path: pcap file path(.pcap or .pcap.gz)
+    """
+    def __init__(self, pcap_path):
+        self.pcap_path = pcap_path
+        self.global_header = None
+        self.flows = {}
+        self.packets = 0
+        self.unparsed = 0
+        # [size, mtime_ns] of indexed pcap
+        self.source = None
+
+    @property
+    def index_path(self):
+        return "{}.idx".format(self.pcap_path)
+
+    def _stat(self):
+        stat = os.stat(self.pcap_path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def is_current(self):
+        """True if pcap is still the file the index was built from"""
+        try:
+            return self.source is not None and self.source == self._stat()
+        except OSError:
+            return False
+
+    def build(self):
+        """
+        Scan pcap and build flow index
+
+        :return: self
+        """
+        self.flows = {}
+        self.source = self._stat()
+        with open_pcap(self.pcap_path) as f:
+            records, linktype = iter_records(f)
+            for offset, ts, data in records:
+                self.packets += 1
+                parsed = parse_packet(linktype, data)
+                if parsed is None:
+                    self.unparsed += 1
+                    continue
+                protocol, src, sport, dst, dport, seq, payload_len, flags = parsed
+                key = flow_key(protocol, src, sport, dst, dport)
+                flow = self.flows.get(key)
+                if flow is None:
+                    flow = self.flows[key] = Flow(key)
+                flow.add(offset, ts, len(data), direction=(src, sport), seq=seq,
+                         payload_len=payload_len, flags=flags)
+
+            f.seek(0)
+            self.global_header = f.read(GLOBAL_HEADER_LEN)
+
+        return self
+
+    def save(self, path=None):
+        """Save index to sidecar file"""
+        data = {"version": INDEX_VERSION,
+                "pcap": self.pcap_path,
+                "source": self.source,
+                "global_header": self.global_header.hex(),
+                "packets": self.packets,
+                "unparsed": self.unparsed,
+                "flows": {key: flow.to_dict() for key, flow in self.flows.items()}}
+        with gzip.open(path or self.index_path, "wt") as f:
+            json.dump(data, f, separators=(",", ":"))
+
+        return self
+
+    @classmethod
+    def load(cls, pcap_path, path=None):
+        """Load index from sidecar file"""
+        index = cls(pcap_path)
+        with gzip.open(path or index.index_path, "rt") as f:
+            data = json.load(f)
+        if data.get("version") != INDEX_VERSION:
+            raise ValueError("unsupported index version: {}".format(data.get("version")))
+
+        index.global_header = bytes.fromhex(data["global_header"])
+        index.packets = data["packets"]
+        index.unparsed = data["unparsed"]
+        index.source = data.get("source")
+        index.flows = {key: Flow.from_dict(key, flow) for key, flow in data["flows"].items()}
+
+        return index
+
+    @classmethod
+    def open(cls, pcap_path):
+        """Load sidecar index if exists and matches pcap, else build and save it"""
+        try:
+            index = cls.load(pcap_path)
+            if index.is_current():
+                return index
+        except (OSError, ValueError):
+            pass
+
+        return cls(pcap_path).build().save()
+
+    def find(self, host=None, port=None, protocol=None):
+        """
+        Find flows by host, port or protocol
+
+        :return: Flow list(largest first)
+        """
+        flows = []
+        for key, flow in self.flows.items():
+            proto, a, _, b = key.split(" ")
+            endpoints = [a.rsplit(":", 1) if proto in ("tcp", "udp") else [a, None],
+                         b.rsplit(":", 1) if proto in ("tcp", "udp") else [b, None]]
+            if protocol and proto != protocol:
+                continue
+            if host and host not in [ep[0] for ep in endpoints]:
+                continue
+            if port and str(port) not in [ep[1] for ep in endpoints]:
+                continue
+            flows.append(flow)
+
+        return sorted(flows, key=lambda flow: flow.bytes, reverse=True)
+
+    def extract(self, key, out_path):
+        """
+        Write one flow to new pcap(seek to each record, no rescan)
+
+        :param key: flow key
+        :param out_path: output pcap path
+        :return: number of packets
+        """
+        flow = self.flows[key]
+        endian = parse_global_header(self.global_header)[0]
+        with open_pcap(self.pcap_path) as src, open_pcap(out_path, "wb") as dst:
+            dst.write(self.global_header)
+            for offset in flow.offsets:
+                src.seek(offset)
+                record_header = src.read(RECORD_HEADER_LEN)
+                incl_len = struct.unpack_from(endian + "I", record_header, 8)[0]
+                dst.write(record_header)
+                dst.write(src.read(incl_len))
+
+        return len(flow.offsets)
+
+    def print_summary(self, limit=20):
+        """Print largest flows"""
+        print("packets: {}, flows: {}, unparsed: {}".format(self.packets, len(self.flows), self.unparsed))
+        print("{:<60} {:>8} {:>12} {:>8} {:>9}".format("FLOW", "PACKETS", "BYTES", "RETRANS", "DURATION"))
+        for flow in self.find()[:limit]:
+            print("{:<60} {:>8} {:>12} {:>8} {:>8.1f}s".format(flow.key, flow.packets, flow.bytes,
+                                                               flow.retransmits, flow.last - flow.first))
+
+
+if __name__ == '__main__':
+    ### Usage
+    # python pcap_index.py {pcap file}                      : print flows
+    # python pcap_index.py {pcap file} "{flow key}" {out}   : extract one flow
+    index = PcapIndex.open(sys.argv[1])
+    if len(sys.argv) > 3:
+        print("{} packets written".format(index.extract(sys.argv[2], sys.argv[3])))
+    else:
+        index.print_summary()
@@ -0,0 +1,181 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from scp import SCPClient
+import paramiko
+from util.ssh import CommandResult
+
+
+class AsyncSSHConnector:
+    """
+    This class have ssh connect, command, scp and tunneling features for asyncio
+    - Blocking paramiko calls run on a bounded thread pool, the event loop is never blocked
+    - Connect retry waits with `asyncio.sleep`(exponential backoff with full jitter)
+    - One event loop can drive hundreds of hosts(`run_many` limits hosts at once)
+
+    Init
+        pem_key_path: key pair path(default key of every connect)
+        user: user name on server(default: ec2-user)
+        max_workers: thread pool size for blocking calls(default: 32)
+        retries: connect retry count(default: 3)
+        base_delay: first backoff seconds(default: 1)
+        max_delay: max backoff seconds(default: 30)
+        connect_timeout: tcp/banner timeout seconds(default: 10)
+    """
+    def __init__(self, pem_key_path="./TEST-PEM.pem", user="ec2-user", max_workers=32,
+                 retries=3, base_delay=1, max_delay=30, connect_timeout=10):
+        self.pem_key_path = pem_key_path
+        self.user = user
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.connect_timeout = connect_timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._keys = {}
+        self._keys_lock = threading.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Shutdown thread pool(clients are closed by caller)"""
+        self.executor.shutdown(wait=False)
+
+    async def _run(self, func, *args):
+        """Run blocking function on thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _backoff(self, attempt):
+        """Backoff seconds for attempt(full jitter)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _load_key(self, pem_key_path):
+        # called from executor threads
+        with self._keys_lock:
+            if pem_key_path not in self._keys:
+                self._keys[pem_key_path] = paramiko.RSAKey.from_private_key_file(pem_key_path)
+            return self._keys[pem_key_path]
+
+    def _connect_blocking(self, host, port, user, pri_key, bastion):
+        sock = None
+        if bastion is not None:
+            sock = bastion.get_transport().open_channel("direct-tcpip", (host, port), ("127.0.0.1", 0))
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            client.connect(hostname=host, port=port, username=user, pkey=pri_key, sock=sock,
+                           timeout=self.connect_timeout, banner_timeout=self.connect_timeout)
+        except Exception:
+            client.close()
+            raise
+
+        return client
+
+    async def connect(self, host, port=22, user=None, pem_key_path=None, bastion=None):
+        """
+        Connect ssh with retry
+
+        :param host: host ip address
+        :param port: ssh port
+        :param user: user name on server(default: connector user)
+        :param pem_key_path: key pair path(default: connector key)
+        :param bastion: connected bastion client to tunnel through(default: None, connect directly)
+        :return: paramiko.SSHClient
+        """
+        pri_key = await self._run(self._load_key, pem_key_path or self.pem_key_path)
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._run(self._connect_blocking, host, port, user or self.user, pri_key, bastion)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+
+    async def tunnel(self, bastion, remote_ip, remote_port=22):
+        """
+        Open direct-tcpip channel from bastion to private server
+
+        :param bastion: connected bastion client
+        :param remote_ip: private server ip address
+        :param remote_port: private server port
+        :return: paramiko.Channel(socket like object)
+        """
+        return await self._run(bastion.get_transport().open_channel, "direct-tcpip",
+                               (remote_ip, remote_port), ("127.0.0.1", 0))
+
+    def _exec_blocking(self, client, command, host):
+        start = time.time()
+        result = CommandResult(host=host)
+        stdin, stdout, stderr = client.exec_command(command)
+        result.stdout = stdout.read().decode("utf-8", "replace")
+        result.stderr = stderr.read().decode("utf-8", "replace")
+        result.exit_code = stdout.channel.recv_exit_status()
+        result.duration = time.time() - start
+
+        return result
+
+    async def exec(self, client, command, host=None):
+        """
+        Run command on remote server
+
+        :param client: connected client
+        :param command: command to run
+        :param host: host name for result(default: peer address)
+        :return: CommandResult
+        """
+        if host is None:
+            host = client.get_transport().getpeername()[0]
+        return await self._run(self._exec_blocking, client, command, host)
+
+    def _put_blocking(self, client, local_path, remote_path):
+        with SCPClient(client.get_transport()) as scp:
+            scp.put(local_path, remote_path, preserve_times=True)
+
+    def _get_blocking(self, client, remote_path, local_path):
+        with SCPClient(client.get_transport()) as scp:
+            scp.get(remote_path, local_path)
+
+    async def put(self, client, local_path, remote_path):
+        """Send file using scp"""
+        await self._run(self._put_blocking, client, local_path, remote_path)
+
+    async def get(self, client, remote_path, local_path):
+        """Get file using scp"""
+        await self._run(self._get_blocking, client, remote_path, local_path)
+
+    async def run_many(self, hosts, command, bastion=None, port=22, concurrency=20):
+        """
+        Connect and run command on many hosts
+
+        :param hosts: host ip address list
+        :param command: command to run on every host
+        :param bastion: connected bastion client(default: None, connect directly)
+        :param port: ssh port of hosts
+        :param concurrency: max hosts at once
+        :return: CommandResult list(same order as hosts)
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_one(host):
+            async with semaphore:
+                start = time.time()
+                client = None
+                try:
+                    client = await self.connect(host, port=port, bastion=bastion)
+                    result = await self.exec(client, command, host=host)
+                except Exception as e:
+                    result = CommandResult(host=host, error="{}: {}".format(type(e).__name__, e))
+                finally:
+                    if client is not None:
+                        client.close()
+                result.duration = time.time() - start
+
+                return result
+
+        return await asyncio.gather(*(run_one(host) for host in hosts))
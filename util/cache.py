@@ -0,0 +1,207 @@
+import threading
+import time
+from collections import OrderedDict
+
+# resource type: (describe operation, list key, id key, filter name)
+DESCRIBE = {
+    "instance": ("describe_instances", "Reservations", "InstanceId", "instance-id"),
+    "subnet": ("describe_subnets", "Subnets", "SubnetId", "subnet-id"),
+    "security_group": ("describe_security_groups", "SecurityGroups", "GroupId", "group-id"),
+    "network_interface": ("describe_network_interfaces", "NetworkInterfaces", "NetworkInterfaceId",
+                          "network-interface-id"),
+}
+READ_PREFIXES = ("Describe", "Get", "List")
+CHUNK = 200
+
+
+def _ids_in(value, found):
+    """Collect every string in api parameters(resource ids are somewhere in them)"""
+    if isinstance(value, str):
+        found.add(value)
+    elif isinstance(value, dict):
+        for item in value.values():
+            _ids_in(item, found)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _ids_in(item, found)
+
+    return found
+
+
+class DescribeCache:
+    """
+    This class keep describe results of ec2 resources by resource id
+    - Read-through: `get_many` describes only missing or expired ids(one filtered describe per 200 ids)
+    - Entries expire after `ttl` seconds, the least recently used entry is evicted over `max_size`
+    - Write calls of attached clients drop entries of ids in their parameters(ex. TerminateInstances, CreateTags)
+    - Keys are (region, resource type, id)
+
+    Init
+        ttl: seconds an entry is used(default: 60)
+        max_size: max number of entries(default: 10000)
+    """
+    def __init__(self, ttl=60, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def attach(self, client):
+        """
+        Register invalidation hooks on client events(reads are not touched)
+
+        :param client: boto3 client
+        :return: client
+        """
+        region = client.meta.region_name
+        events = client.meta.events
+        service_id = client.meta.service_model.service_id.hyphenize()
+
+        def before_parameter_build(params, model, context, **kwargs):
+            if not model.name.startswith(READ_PREFIXES):
+                context["cache_ids"] = _ids_in(params, set())
+
+        def after_call(context, **kwargs):
+            ids = context.get("cache_ids")
+            if ids:
+                self.invalidate(region, ids)
+
+        events.register("before-parameter-build.{}".format(service_id), before_parameter_build)
+        events.register("after-call.{}".format(service_id), after_call)
+
+        return client
+
+    def put(self, client, resource_type, items):
+        """
+        Store described items
+
+        :param client: boto3 client the items were described with
+        :param resource_type: key of DESCRIBE
+        :param items: described item list
+        """
+        region = client.meta.region_name
+        id_key = DESCRIBE[resource_type][2]
+        expires = time.time() + self.ttl
+        with self._lock:
+            for item in items:
+                key = (region, resource_type, item[id_key])
+                self._entries[key] = (expires, item)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def lookup(self, client, resource_type, ids):
+        """
+        Get cached items without describe calls
+
+        :param client: boto3 client
+        :param resource_type: key of DESCRIBE
+        :param ids: resource id list
+        :return: {id: item} of cached ids
+        """
+        region = client.meta.region_name
+        now = time.time()
+        found = {}
+        with self._lock:
+            for resource_id in ids:
+                key = (region, resource_type, resource_id)
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] < now:
+                    del self._entries[key]
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                self._entries.move_to_end(key)
+                found[resource_id] = entry[1]
+
+        return found
+
+    def get_many(self, client, resource_type, ids):
+        """
+        Get items, ids not cached are described in one call per chunk
+
+        :param client: boto3 client
+        :param resource_type: key of DESCRIBE
+        :param ids: resource id list
+        :return: {id: item}(ids that don't exist are left out)
+        """
+        found = self.lookup(client, resource_type, ids)
+        missing = [resource_id for resource_id in dict.fromkeys(ids) if resource_id not in found]
+        if missing:
+            items = self._describe(client, resource_type, missing)
+            self.put(client, resource_type, items)
+            id_key = DESCRIBE[resource_type][2]
+            found.update((item[id_key], item) for item in items)
+
+        return found
+
+    def get(self, client, resource_type, resource_id):
+        """Get one item(None if it doesn't exist)"""
+        return self.get_many(client, resource_type, [resource_id]).get(resource_id)
+
+    def prefetch(self, client, resource_type, ids):
+        """Fill cache for many ids before they are used one by one"""
+        self.get_many(client, resource_type, ids)
+
+    def _describe(self, client, resource_type, ids):
+        operation, items_key, _, filter_name = DESCRIBE[resource_type]
+        items = []
+        for i in range(0, len(ids), CHUNK):
+            # describe by filter doesn't fail on ids that don't exist
+            kwargs = {"Filters": [{"Name": filter_name, "Values": ids[i:i + CHUNK]}]}
+            for page in client.get_paginator(operation).paginate(**kwargs):
+                page_items = page.get(items_key, [])
+                if items_key == "Reservations":
+                    page_items = [instance for reservation in page_items for instance in reservation["Instances"]]
+                items.extend(page_items)
+
+        return items
+
+    def invalidate(self, region=None, ids=None):
+        """
+        Drop entries
+
+        :param region: region name(default: None, all regions)
+        :param ids: resource ids(default: None, all ids)
+        """
+        with self._lock:
+            if region is not None and ids is not None:
+                keys = [key for key in ((region, resource_type, resource_id)
+                                        for resource_type in DESCRIBE for resource_id in ids) if key in self._entries]
+            else:
+                keys = [key for key in self._entries
+                        if (region is None or key[0] == region) and (ids is None or key[2] in ids)]
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += len(keys)
+
+    def stats(self):
+        """Get hit, miss, eviction and invalidation counters"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                    "evictions": self.evictions, "invalidations": self.invalidations, "size": len(self._entries)}
+
+    def print_summary(self):
+        """Print counters"""
+        stats = self.stats()
+        if not stats["hits"] + stats["misses"]:
+            return
+        print("Describe cache: {hits} hits, {misses} misses({hit_rate:.0%}), {evictions} evictions, "
+              "{invalidations} invalidations".format(**stats))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+
+# process wide cache used by `util.session` clients
+cache = DescribeCache()
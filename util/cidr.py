@@ -0,0 +1,157 @@
+import bisect
+import ipaddress
+import threading
+
+_az_lock = threading.Lock()
+_az_cache = {}
+
+
+def availability_zones(ec2_client, region):
+    """
+    Get available zone names of region(one describe call per region, cached)
+
+    :param ec2_client: boto3.client('ec2') object
+    :param region: region name
+    :return: zone name list(ex. ["us-east-1a", "us-east-1b" ...])
+    """
+    zones = _az_cache.get(region)
+    if zones is None:
+        with _az_lock:
+            zones = _az_cache.get(region)
+            if zones is None:
+                response = ec2_client.describe_availability_zones(
+                    Filters=[{"Name": "state", "Values": ["available"]},
+                             {"Name": "zone-type", "Values": ["availability-zone"]}])
+                zones = _az_cache[region] = sorted(zone["ZoneName"] for zone in response["AvailabilityZones"])
+
+    return zones
+
+
+def az_suffix(zone, region):
+    """
+    Get zone suffix used in names
+    Example: ("us-east-1c", "us-east-1") -> "c"
+    """
+    return zone[len(region):] if zone.startswith(region) else zone
+
+
+def default_prefix(vpc_prefix):
+    """Default subnet prefix of VPC(/8 -> /16, /16 -> /24, smaller VPCs -> /28 at most)"""
+    return min(vpc_prefix + 8, 28)
+
+
+class CIDRPlanner:
+    """
+    This class allocate subnet CIDR blocks of one VPC with integer arithmetic
+    - Any VPC prefix, any subnet prefix(subnets of different sizes can be mixed)
+    - Each block is the lowest free block aligned to its size
+    - Used ranges are a sorted interval list, every size keeps a cursor(allocation is not a rescan)
+    - First block of the default size is reserved(subnets start at block 1 like 10.0.1.0/24)
+
+    Init
+        vpc_cidr: VPC CIDR block
+        existing: CIDR list already used in VPC(default: None)
+        reserve_first: reserve block 0 of the default subnet size(default: True)
+    """
+    def __init__(self, vpc_cidr, existing=None, reserve_first=True):
+        self.network = ipaddress.ip_network(vpc_cidr)
+        self.start = int(self.network.network_address)
+        self.end = self.start + self.network.num_addresses
+        self.default_prefix = default_prefix(self.network.prefixlen)
+        self._starts = []
+        self._ends = []
+        self._cidrs = []
+        self._cursor = {}
+
+        if reserve_first:
+            self._insert(self.start, self.start + self._size(self.default_prefix), None)
+        for cidr in existing or []:
+            self.reserve(cidr)
+
+    def _size(self, prefix):
+        if prefix < self.network.prefixlen or prefix > self.network.max_prefixlen:
+            raise ValueError("subnet prefix /{} doesn't fit VPC {}".format(prefix, self.network))
+        return 1 << (self.network.max_prefixlen - prefix)
+
+    def _insert(self, start, end, cidr):
+        index = bisect.bisect_left(self._starts, start)
+        self._starts.insert(index, start)
+        self._ends.insert(index, end)
+        self._cidrs.insert(index, cidr)
+
+    def overlaps(self, cidr):
+        """
+        Get used CIDR blocks that overlap cidr
+
+        :param cidr: CIDR block
+        :return: overlapping CIDR list("reserved" for the reserved first block)
+        """
+        net = ipaddress.ip_network(cidr)
+        start = int(net.network_address)
+        end = start + net.num_addresses
+        index = bisect.bisect_left(self._ends, start + 1)
+        found = []
+        while index < len(self._starts) and self._starts[index] < end:
+            found.append(self._cidrs[index] or "reserved")
+            index += 1
+
+        return found
+
+    def reserve(self, cidr):
+        """
+        Mark CIDR block as used(existing subnet)
+
+        :param cidr: CIDR block
+        :raise ValueError: if cidr is outside VPC or overlaps other subnet
+        """
+        net = ipaddress.ip_network(cidr)
+        if not net.subnet_of(self.network):
+            raise ValueError("{} is outside VPC {}".format(cidr, self.network))
+        overlapping = [used for used in self.overlaps(cidr) if used != "reserved"]
+        if overlapping:
+            raise ValueError("{} overlaps {}".format(cidr, ", ".join(overlapping)))
+        if self.overlaps(cidr):
+            # existing subnet in the reserved first block, drop the reservation
+            index = self._cidrs.index(None)
+            del self._starts[index], self._ends[index], self._cidrs[index]
+            self._cursor = {}
+        start = int(net.network_address)
+        self._insert(start, start + net.num_addresses, str(net))
+
+    def allocate(self, prefix=None):
+        """
+        Get the lowest free aligned block
+
+        :param prefix: subnet prefix(default: None, VPC prefix + 8)
+        :return: CIDR block
+        """
+        prefix = prefix or self.default_prefix
+        size = self._size(prefix)
+        candidate = self._cursor.get(prefix, self.start)
+        index = bisect.bisect_right(self._starts, candidate) - 1
+        while True:
+            # skip the interval that contains candidate, then align up to block size
+            if index >= 0 and self._ends[index] > candidate:
+                candidate = self._ends[index]
+            candidate = self.start + -(-(candidate - self.start) // size) * size
+            next_index = index + 1
+            if candidate + size > self.end:
+                raise ValueError("VPC {} has no free /{} block".format(self.network, prefix))
+            if next_index >= len(self._starts) or candidate + size <= self._starts[next_index]:
+                break
+            index = next_index
+
+        cidr = "{}/{}".format(ipaddress.ip_address(candidate), prefix)
+        self._insert(candidate, candidate + size, cidr)
+        self._cursor[prefix] = candidate + size
+
+        return cidr
+
+    def allocate_many(self, count, prefix=None):
+        """Allocate count blocks of one prefix"""
+        return [self.allocate(prefix) for _ in range(count)]
+
+    @property
+    def used(self):
+        """Used CIDR list(address order)"""
+        return [cidr for cidr in self._cidrs if cidr]
@@ -1,7 +1,12 @@
+import functools
+import inspect
+from util.trace import tracer
+
 
 class Printer(object):
     """
     This class help you print easily
+    Decorated function is recorded as a span of `util.trace.tracer`
 
     Parameters
         pre: prefix print message
@@ -12,15 +17,52 @@ class Printer(object):
         self.post = post
 
     def __call__(self, func):
+        @functools.wraps(func)
         def wrappee(*args, **kwargs):
             if self.pre:
                 print("Waiting for {} ...".format(self.pre))
 
-            f = func(*args, **kwargs)
+            with tracer.span(func.__qualname__):
+                f = func(*args, **kwargs)
 
             if self.post:
                 print("{} ...".format(self.post))
 
             return f
 
-        return wrappee
\ No newline at end of file
+        wrappee.traced = True
+
+        return wrappee
+
+
+class Trace(object):
+    """
+    This class record function or all methods of class(except dunder methods) as spans of `util.trace.tracer`
+    Methods already decorated with `Printer` are not wrapped again
+
+    Parameters
+        name: span name(default: None, qualified function name)
+    """
+    def __init__(self, name=None):
+        self.name = name
+
+    def _wrap(self, func, name):
+        @functools.wraps(func)
+        def wrappee(*args, **kwargs):
+            with tracer.span(name):
+                return func(*args, **kwargs)
+
+        wrappee.traced = True
+
+        return wrappee
+
+    def __call__(self, target):
+        if not inspect.isclass(target):
+            return self._wrap(target, self.name or target.__qualname__)
+
+        for attr, value in list(vars(target).items()):
+            if attr.startswith("__") or not inspect.isfunction(value) or getattr(value, "traced", False):
+                continue
+            setattr(target, attr, self._wrap(value, "{}.{}".format(self.name or target.__name__, attr)))
+
+        return target
@@ -0,0 +1,192 @@
+import time
+from util.trace import tracer, submit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Step:
+    """
+    This class is a single node of the dependency graph
+
+    Init
+        name: step name(unique in graph)
+        func: callable to run(no arguments)
+        requires: step names that must be finished before this step
+    """
+    def __init__(self, name, func, requires=None):
+        self.name = name
+        self.func = func
+        self.requires = list(requires or [])
+        self.result = None
+        self.error = None
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self):
+        """Elapsed seconds of this step(None if not finished)"""
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+class DAGExecutor:
+    """
+    This class run steps on a thread pool as soon as their dependencies are done
+    - Independent steps run concurrently
+    - If a step fails, no new step is started and the first error is raised
+    - Each step is a span of `util.trace.tracer` under the span that called `run`
+
+    Init
+        max_workers: thread pool size(default: 8)
+    """
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.steps = OrderedDict()
+        self.started_at = None
+        self.finished_at = None
+
+    def add(self, name, func, requires=None):
+        """
+        Add step to graph
+
+        :param name: step name
+        :param func: callable to run
+        :param requires: step name list to wait for
+        :return: self
+        """
+        if name in self.steps:
+            raise ValueError("duplicated step: {}".format(name))
+        self.steps[name] = Step(name, func, requires)
+
+        return self
+
+    def _validate(self):
+        """Check unknown dependencies and cycles"""
+        for step in self.steps.values():
+            for dep in step.requires:
+                if dep not in self.steps:
+                    raise ValueError("step '{}' requires unknown step '{}'".format(step.name, dep))
+
+        self.topological_order()
+
+    def topological_order(self):
+        """
+        Get step names in dependency order(stable by insertion order)
+
+        :return: step name list
+        """
+        order = []
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError("dependency cycle: {}".format(" -> ".join(path + [name])))
+            state[name] = "visiting"
+            for dep in self.steps[name].requires:
+                visit(dep, path + [name])
+            state[name] = "done"
+            order.append(name)
+
+        for name in self.steps:
+            visit(name, [])
+
+        return order
+
+    def _run_step(self, step):
+        step.start = time.time()
+        try:
+            with tracer.span(step.name, kind="step"):
+                step.result = step.func()
+        except Exception as e:
+            step.error = e
+            raise
+        finally:
+            step.end = time.time()
+
+        return step
+
+    def run(self):
+        """
+        Run all steps
+
+        :return: {step name: step result}
+        """
+        self._validate()
+
+        done = set()
+        pending = OrderedDict(self.steps)
+        running = {}
+        error = None
+
+        self.started_at = time.time()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                if error is None:
+                    for name, step in list(pending.items()):
+                        if all(dep in done for dep in step.requires):
+                            running[submit(pool, self._run_step, step)] = step
+                            del pending[name]
+
+                if not running:
+                    break
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    exc = future.exception()
+                    if exc is not None:
+                        if error is None:
+                            error = exc
+                        continue
+                    done.add(step.name)
+        self.finished_at = time.time()
+
+        if error is not None:
+            raise error
+
+        return {name: step.result for name, step in self.steps.items()}
+
+    def critical_path(self):
+        """
+        Get the chain of steps that decided the total build time
+        - Walk back from the last finished step through the dependency that finished latest
+
+        :return: step list(first to last)
+        """
+        finished = [s for s in self.steps.values() if s.end is not None]
+        if not finished:
+            return []
+
+        path = []
+        step = max(finished, key=lambda s: s.end)
+        while step is not None:
+            path.append(step)
+            deps = [self.steps[d] for d in step.requires if self.steps[d].end is not None]
+            step = max(deps, key=lambda s: s.end) if deps else None
+
+        return list(reversed(path))
+
+    def print_summary(self):
+        """Print elapsed time of each step and critical path"""
+        if self.started_at is None:
+            return
+
+        total = (self.finished_at or time.time()) - self.started_at
+        serial = sum(s.duration for s in self.steps.values() if s.duration is not None)
+
+        print("----- Step timings -----")
+        for step in sorted(self.steps.values(), key=lambda s: s.start or float("inf")):
+            if step.duration is None:
+                print("{:<20} not finished".format(step.name))
+                continue
+            print("{:<20} start +{:7.1f}s  took {:7.1f}s".format(step.name,
+                                                              step.start - self.started_at,
+                                                              step.duration))
+
+        path = self.critical_path()
+        print("----- Critical path -----")
+        print(" -> ".join("{}({:.1f}s)".format(s.name, s.duration) for s in path))
+        print("Total: {:.1f}s (sum of all steps: {:.1f}s)".format(total, serial))
@@ -0,0 +1,250 @@
+import gzip
+import re
+import shlex
+import struct
+import time
+
+#########
+# pcap file format helpers
+#########
+
+GLOBAL_HEADER_LEN = 24
+RECORD_HEADER_LEN = 16
+
+MAGIC_USEC = 0xa1b2c3d4
+MAGIC_NSEC = 0xa1b23c4d
+
+
+def parse_global_header(header):
+    """
+    parse pcap global header
+
+    :param header: first 24 bytes of pcap
+    :return: (struct endian prefix("<"|">"), is nanosecond, snaplen, linktype)
+    """
+    for endian in ("<", ">"):
+        magic = struct.unpack(endian + "I", header[:4])[0]
+        if magic in (MAGIC_USEC, MAGIC_NSEC):
+            _, _, _, _, _, snaplen, linktype = struct.unpack(endian + "IHHiIII", header[:GLOBAL_HEADER_LEN])
+            return endian, magic == MAGIC_NSEC, snaplen, linktype
+
+    raise ValueError("not a pcap file(magic: {})".format(header[:4].hex()))
+
+
+def open_pcap(path, mode="rb"):
+    """open pcap file(`.gz` files are opened with gzip)"""
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def parse_tcpdump_stats(text):
+    """
+    parse tcpdump exit summary
+    Example:
+        input: "10 packets captured\\n12 packets received by filter\\n2 packets dropped by kernel"
+        output: {"captured": 10, "received": 12, "dropped": 2}
+
+    :param text: tcpdump stderr
+    :return: stats dict(missing values are not included)
+    """
+    stats = {}
+    patterns = {"captured": r"(\d+) packets? captured",
+                "received": r"(\d+) packets? received by filter",
+                "dropped": r"(\d+) packets? dropped by kernel",
+                "if_dropped": r"(\d+) packets? dropped by interface"}
+    for key, pattern in patterns.items():
+        match = re.search(pattern, text)
+        if match:
+            stats[key] = int(match.group(1))
+
+    return stats
+
+
+def build_bpf_filter(expression=None, exclude=None):
+    """
+    build BPF filter expression for tcpdump
+    Example:
+        input: expression="tcp port 80", exclude=[("10.0.1.5", 50022, 22)]
+        output: "(tcp port 80) and not (tcp and host 10.0.1.5 and port 50022 and port 22)"
+
+    :param expression: filter to capture(default: None, all packets)
+    :param exclude: (peer ip, peer port, local port) list of tcp connections to skip(ex. control ssh)
+    :return: filter string(empty string if no filter)
+    """
+    parts = []
+    if expression:
+        parts.append("({})".format(expression))
+    for ip, peer_port, local_port in exclude or []:
+        parts.append("not (tcp and host {} and port {} and port {})".format(ip, peer_port, local_port))
+
+    return " and ".join(parts)
+
+
+class CaptureOptions:
+    """
+    This class hold tcpdump capture options
+
+    Init
+        expression: BPF filter to capture(default: None, all packets)
+        snaplen: bytes to capture per packet(-s, default: None, tcpdump default)
+        ring_file_mb: rotate file every N MB(-C, default: None)
+        ring_file_count: keep only N files(-W, ring buffer with ring_file_mb, default: None)
+        buffer_kb: kernel capture buffer size in KiB(-B, default: None)
+        exclude_control_ssh: skip the ssh connection that controls the capture(default: True)
+    """
+    def __init__(self, expression=None, snaplen=None, ring_file_mb=None, ring_file_count=None,
+                 buffer_kb=None, exclude_control_ssh=True):
+        if ring_file_count and not ring_file_mb:
+            raise ValueError("ring_file_count needs ring_file_mb")
+
+        self.expression = expression
+        self.snaplen = snaplen
+        self.ring_file_mb = ring_file_mb
+        self.ring_file_count = ring_file_count
+        self.buffer_kb = buffer_kb
+        self.exclude_control_ssh = exclude_control_ssh
+
+    def tcpdump_args(self, eth, output, control_ssh=None, ring=True):
+        """
+        make tcpdump arguments
+
+        :param eth: ethernet interface
+        :param output: -w target(file name or "-" for stdout)
+        :param control_ssh: (peer ip, peer port, local port) of control ssh connection
+        :param ring: use -C/-W options(False for stdout)
+        :return: argument string
+        """
+        args = ["-i", eth]
+        if self.snaplen:
+            args += ["-s", str(self.snaplen)]
+        if self.buffer_kb:
+            args += ["-B", str(self.buffer_kb)]
+        if ring and self.ring_file_mb:
+            args += ["-C", str(self.ring_file_mb)]
+            if self.ring_file_count:
+                args += ["-W", str(self.ring_file_count)]
+        if output == "-":
+            args.append("-U")
+        args += ["-w", output]
+
+        exclude = [control_ssh] if self.exclude_control_ssh and control_ssh else None
+        bpf = build_bpf_filter(self.expression, exclude)
+        if bpf:
+            args.append(shlex.quote(bpf))
+
+        return " ".join(args)
+
+
+class PcapStreamParser:
+    """
+    This class split a pcap byte stream(arbitrary chunks) into packet records
+
+    - `feed(data)` returns complete records(16 byte header + packet data)
+    - `global_header` is set after first 24 bytes
+    """
+    def __init__(self):
+        self.global_header = None
+        self.endian = None
+        self._buf = bytearray()
+
+    def feed(self, data):
+        """
+        Add bytes and get complete records
+
+        :param data: bytes from stream
+        :return: record bytes list
+        """
+        self._buf.extend(data)
+        if self.global_header is None:
+            if len(self._buf) < GLOBAL_HEADER_LEN:
+                return []
+            self.global_header = bytes(self._buf[:GLOBAL_HEADER_LEN])
+            self.endian = parse_global_header(self.global_header)[0]
+            del self._buf[:GLOBAL_HEADER_LEN]
+
+        records = []
+        offset = 0
+        while len(self._buf) - offset >= RECORD_HEADER_LEN:
+            incl_len = struct.unpack_from(self.endian + "I", self._buf, offset + 8)[0]
+            end = offset + RECORD_HEADER_LEN + incl_len
+            if len(self._buf) < end:
+                break
+            records.append(bytes(self._buf[offset:end]))
+            offset = end
+        del self._buf[:offset]
+
+        return records
+
+    @property
+    def pending_bytes(self):
+        """Bytes of incomplete record"""
+        return len(self._buf)
+
+
+class RotatingPcapWriter:
+    """
+    This class write pcap records to local files and rotate them by size or time
+    Every file starts with the global header, so each file is a valid pcap
+
+    Init
+        path_prefix: file path prefix(files: {prefix}-0000.pcap, {prefix}-0001.pcap ...)
+        rotate_bytes: max bytes per file(default: None, no limit)
+        rotate_seconds: max seconds per file(default: None, no limit)
+        compress: gzip files(default: False)
+    """
+    def __init__(self, path_prefix, rotate_bytes=None, rotate_seconds=None, compress=False):
+        self.path_prefix = path_prefix
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.compress = compress
+
+        self.global_header = None
+        self.files = []
+        self._file = None
+        self._file_bytes = 0
+        self._file_opened = None
+
+    def _open(self):
+        self.close()
+        path = "{}-{:04d}.pcap{}".format(self.path_prefix, len(self.files), ".gz" if self.compress else "")
+        self._file = open_pcap(path, "wb")
+        self._file.write(self.global_header)
+        self._file_bytes = GLOBAL_HEADER_LEN
+        self._file_opened = time.time()
+        self.files.append(path)
+
+    def _need_rotate(self, size):
+        if self._file_bytes == GLOBAL_HEADER_LEN:
+            return False
+        if self.rotate_bytes and self._file_bytes + size > self.rotate_bytes:
+            return True
+        if self.rotate_seconds and time.time() - self._file_opened >= self.rotate_seconds:
+            return True
+        return False
+
+    def write_header(self, global_header):
+        """Set global header and open first file"""
+        self.global_header = global_header
+        self._open()
+
+    def write(self, record):
+        """Write one record(rotate before write if needed)"""
+        if self._file is None or self._need_rotate(len(record)):
+            self._open()
+        self._file.write(record)
+        self._file_bytes += len(record)
+
+    def tick(self):
+        """
+        Close current file if rotate_seconds passed
+        Call this while no packet arrives(a quiet link still rotates), next record opens a new file
+        """
+        if self._file is not None and self.rotate_seconds and self._file_bytes > GLOBAL_HEADER_LEN \
+                and time.time() - self._file_opened >= self.rotate_seconds:
+            self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
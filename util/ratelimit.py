@@ -0,0 +1,212 @@
+import threading
+import time
+from collections import deque
+from util.utils import THROTTLE_ERROR_CODES
+from util.trace import tracer
+
+# requests per second before the first throttle(EC2 API request token bucket defaults)
+READ_RATE = 20
+READ_BURST = 100
+WRITE_RATE = 5
+WRITE_BURST = 50
+READ_PREFIXES = ("Describe", "Get", "List")
+
+
+class TokenBucket:
+    """
+    This class is a token bucket with AIMD rate(additive increase, multiplicative decrease)
+    - A throttle response halves the rate, every success adds `increase` up to the initial rate
+    - Tokens are reserved under lock and waited outside it, callers are served in order
+
+    Init
+        rate: tokens per second
+        burst: bucket size
+        min_rate: lowest rate after throttles(default: 0.5)
+        increase: rate added per success(default: 0.1)
+    """
+    def __init__(self, rate, burst, min_rate=0.5, increase=0.1):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.increase = increase
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Take one token(sleep until it is available)
+
+        :return: waited seconds
+        """
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+    def on_success(self):
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            # drop saved burst, next calls are paced by the new rate
+            self.tokens = min(self.tokens, 0)
+
+
+class ActionMetrics:
+    """
+    This class hold metrics of one (service, region, action)
+    - Latency is kept for the last `max_samples` calls
+    """
+    def __init__(self, max_samples=10000):
+        self.calls = 0
+        self.errors = 0
+        self.throttles = 0
+        self.retries = 0
+        self.waited = 0.0
+        self.latencies = deque(maxlen=max_samples)
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0.0
+        values = sorted(self.latencies)
+        return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class RateLimiter:
+    """
+    This class limit and measure every AWS API call of attached clients
+    - One token bucket per (service, region, action)
+    - Hooks on botocore events
+        - before-call: start latency timer
+        - before-send: take a token(every attempt, retries included)
+        - needs-retry: throttle response decreases bucket rate
+        - after-call: record latency, retries and error(api call is counted on current trace span)
+    - Clients of `util.session` are attached automatically
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.metrics = {}
+        self._lock = threading.RLock()
+
+    def _key(self, service, region, event_name):
+        return service, region, event_name.rsplit(".", 1)[-1]
+
+    def bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    if key[2].startswith(READ_PREFIXES):
+                        bucket = TokenBucket(READ_RATE, READ_BURST)
+                    else:
+                        bucket = TokenBucket(WRITE_RATE, WRITE_BURST)
+                    self.buckets[key] = bucket
+
+        return bucket
+
+    def metric(self, key):
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.setdefault(key, ActionMetrics())
+
+        return metric
+
+    def attach(self, client, service, region):
+        """
+        Register hooks on client events
+
+        :param client: boto3 client
+        :param service: service name used in metrics
+        :param region: region name
+        :return: client
+        """
+        events = client.meta.events
+        service_id = client.meta.service_model.service_id.hyphenize()
+
+        def before_call(context, **kwargs):
+            context["rate_limit_started"] = time.time()
+
+        def before_send(event_name, **kwargs):
+            key = self._key(service, region, event_name)
+            waited = self.bucket(key).acquire()
+            if waited:
+                with self._lock:
+                    self.metric(key).waited += waited
+
+        def needs_retry(event_name, response, **kwargs):
+            if response is None:
+                return None
+            code = response[1].get("Error", {}).get("Code")
+            if code in THROTTLE_ERROR_CODES:
+                key = self._key(service, region, event_name)
+                self.bucket(key).on_throttle()
+                with self._lock:
+                    self.metric(key).throttles += 1
+            return None
+
+        def after_call(event_name, parsed, context, **kwargs):
+            key = self._key(service, region, event_name)
+            tracer.record_api_call()
+            started = context.get("rate_limit_started")
+            failed = "Error" in parsed
+            if not failed:
+                self.bucket(key).on_success()
+            metric = self.metric(key)
+            with self._lock:
+                metric.calls += 1
+                metric.errors += 1 if failed else 0
+                metric.retries += parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+                if started is not None:
+                    metric.latencies.append(time.time() - started)
+
+        # registered first, other handlers(retry handler, stubs) may return a response and stop the chain
+        events.register_first("before-call.{}".format(service_id), before_call)
+        events.register_first("before-send.{}".format(service_id), before_send)
+        events.register_first("needs-retry.{}".format(service_id), needs_retry)
+        events.register_first("after-call.{}".format(service_id), after_call)
+
+        return client
+
+    def reset(self):
+        """Clear metrics(bucket rates are kept)"""
+        with self._lock:
+            self.metrics = {}
+
+    def print_summary(self):
+        """Print calls, throttles, retries and latency percentiles per action"""
+        if not self.metrics:
+            return
+        print("----- AWS API calls -----")
+        print("{:<40} {:>6} {:>6} {:>8} {:>7} {:>8} {:>8} {:>8} {:>8}".format(
+            "ACTION", "CALLS", "ERRORS", "THROTTLE", "RETRIES", "WAITED", "P50", "P90", "P99"))
+        with self._lock:
+            items = sorted(self.metrics.items(), key=lambda item: item[1].calls, reverse=True)
+            for (service, region, action), metric in items:
+                print("{:<40} {:>6} {:>6} {:>8} {:>7} {:>7.1f}s {:>7.3f}s {:>7.3f}s {:>7.3f}s".format(
+                    "{}:{}:{}".format(service, region, action)[:40], metric.calls, metric.errors, metric.throttles,
+                    metric.retries, metric.waited, metric.percentile(50), metric.percentile(90),
+                    metric.percentile(99)))
+        print("Total: {} calls, {} throttles, {} retries".format(sum(m.calls for _, m in items),
+                                                                 sum(m.throttles for _, m in items),
+                                                                 sum(m.retries for _, m in items)))
+
+
+# process wide limiter used by `util.session`
+limiter = RateLimiter()
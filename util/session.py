@@ -0,0 +1,106 @@
+import threading
+import boto3
+from botocore.config import Config
+from util.ratelimit import limiter
+from util.cache import cache
+
+# sized for the largest thread pools(DAG steps, fleet launch, teardown)
+MAX_POOL_CONNECTIONS = 50
+RETRIES = {"mode": "adaptive", "max_attempts": 10}
+
+_lock = threading.RLock()
+_local = threading.local()
+_sessions = {}
+_clients = {}
+_config = Config(max_pool_connections=MAX_POOL_CONNECTIONS, retries=RETRIES)
+
+
+def configure(max_pool_connections=MAX_POOL_CONNECTIONS, retries=None, **kwargs):
+    """
+    Change botocore config of new clients(cached clients are dropped)
+
+    :param max_pool_connections: http connections per client
+    :param retries: retry config(default: adaptive mode, 10 attempts)
+    :param kwargs: other `botocore.config.Config` options
+    """
+    global _config
+    with _lock:
+        _config = Config(max_pool_connections=max_pool_connections, retries=retries or RETRIES, **kwargs)
+        clear()
+
+
+def get_config():
+    return _config
+
+
+def get_session(profile=None):
+    """
+    Get process wide boto3 session of profile
+
+    :param profile: aws profile name(default: None, default credentials)
+    :return: boto3.session.Session
+    """
+    with _lock:
+        session = _sessions.get(profile)
+        if session is None:
+            session = _sessions[profile] = boto3.session.Session(profile_name=profile)
+
+        return session
+
+
+def get_client(service, region=None, profile=None):
+    """
+    Get cached client(made once per service, region and profile)
+    boto3 clients are thread safe, one client is shared by all threads
+    Calls go through `util.ratelimit.limiter`, writes invalidate `util.cache.cache`
+
+    :param service: service name(ec2, elbv2 ...)
+    :param region: region name
+    :param profile: aws profile name
+    :return: boto3 client
+    """
+    key = (service, region, profile)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    # session is not thread safe, clients are made under lock
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = get_session(profile).client(service, region_name=region, config=_config)
+            _clients[key] = cache.attach(limiter.attach(client, service, region))
+
+        return client
+
+
+def get_resource(service, region=None, profile=None):
+    """
+    Get cached resource of current thread
+    boto3 resources are not thread safe, each thread has its own resource
+
+    :param service: service name(ec2 ...)
+    :param region: region name
+    :param profile: aws profile name
+    :return: boto3 resource
+    """
+    resources = getattr(_local, "resources", None)
+    if resources is None:
+        resources = _local.resources = {}
+
+    key = (service, region, profile)
+    resource = resources.get(key)
+    if resource is None:
+        with _lock:
+            resource = resources[key] = get_session(profile).resource(service, region_name=region, config=_config)
+            cache.attach(limiter.attach(resource.meta.client, service, region))
+
+    return resource
+
+
+def clear():
+    """Drop cached sessions and clients(resources of other threads are dropped on their next config change)"""
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
+        _local.resources = {}
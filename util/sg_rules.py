@@ -0,0 +1,221 @@
+import ipaddress
+from collections import namedtuple
+
+Rule = namedtuple("Rule", ["protocol", "f_port", "t_port", "cidr"])
+
+PROTOCOL_NAMES = {"6": "tcp", "17": "udp", "1": "icmp", "58": "icmpv6", "all": "-1"}
+PORT_PROTOCOLS = ("tcp", "udp")
+TYPE_PROTOCOLS = ("icmp", "icmpv6")
+DIRECTIONS = ("ingress", "egress")
+# direction: (describe key, authorize operation, revoke operation)
+OPERATIONS = {
+    "ingress": ("IpPermissions", "authorize_security_group_ingress", "revoke_security_group_ingress"),
+    "egress": ("IpPermissionsEgress", "authorize_security_group_egress", "revoke_security_group_egress"),
+}
+
+
+def normalize_rule(protocol, f_port=None, t_port=None, cidr="0.0.0.0/0"):
+    """
+    Make one comparable rule
+    Example:
+        input: ("6", 80, None, "10.0.1.7/16")
+        output: Rule("tcp", 80, 80, "10.0.0.0/16")
+
+    :param protocol: protocol name or number(-1: all)
+    :param f_port: from port(icmp type)
+    :param t_port: to port(icmp code, default: f_port)
+    :param cidr: IPv4 or IPv6 CIDR block
+    :return: Rule
+    """
+    protocol = str(protocol).lower()
+    protocol = PROTOCOL_NAMES.get(protocol, protocol)
+    cidr = str(ipaddress.ip_network(cidr, strict=False))
+
+    if protocol in PORT_PROTOCOLS:
+        if f_port is None:
+            f_port, t_port = 0, 65535
+        f_port, t_port = int(f_port), int(f_port if t_port is None else t_port)
+        if not 0 <= f_port <= t_port <= 65535:
+            raise ValueError("invalid port range {}-{} of {} rule".format(f_port, t_port, protocol))
+    elif protocol in TYPE_PROTOCOLS:
+        f_port = -1 if f_port is None else int(f_port)
+        t_port = -1 if t_port is None else int(t_port)
+    else:
+        f_port = t_port = None
+
+    return Rule(protocol, f_port, t_port, cidr)
+
+
+def _sort_key(rule):
+    return rule.protocol, -2 if rule.f_port is None else rule.f_port, -2 if rule.t_port is None else rule.t_port, \
+        rule.cidr
+
+
+def merge_rules(rules):
+    """
+    Merge rules that reach the same CIDR
+    - Same protocol, overlapping or adjacent port ranges(80-80, 81-90 -> 80-90)
+    - Any rule of a CIDR that also has an all traffic(-1) rule
+
+    :param rules: Rule iterable
+    :return: Rule set
+    """
+    all_traffic = set(rule.cidr for rule in rules if rule.protocol == "-1")
+    merged = set()
+    ranges = {}
+    for rule in rules:
+        if rule.cidr in all_traffic and rule.protocol != "-1":
+            continue
+        if rule.protocol in PORT_PROTOCOLS:
+            ranges.setdefault((rule.protocol, rule.cidr), []).append((rule.f_port, rule.t_port))
+        else:
+            merged.add(rule)
+
+    for (protocol, cidr), port_ranges in ranges.items():
+        port_ranges.sort()
+        f_port, t_port = port_ranges[0]
+        for next_f, next_t in port_ranges[1:]:
+            if next_f <= t_port + 1:
+                t_port = max(t_port, next_t)
+                continue
+            merged.add(Rule(protocol, f_port, t_port, cidr))
+            f_port, t_port = next_f, next_t
+        merged.add(Rule(protocol, f_port, t_port, cidr))
+
+    return merged
+
+
+class RuleSet:
+    """
+    This class keep normalized rules of one direction of security group
+    - Rules of the repo format({"cidr", "protocol", "f_port", "t_port"}) are normalized and merged
+    - Rules described from AWS are kept as they are(`from_permissions`), so a diff revokes exact existing rules
+    - `to_permissions` groups rules of the same protocol and ports into one IpPermission(one API call per direction)
+
+    Init
+        rules: rule dict list or Rule iterable(default: None)
+        merge: merge port ranges and duplicated rules(default: True)
+    """
+    def __init__(self, rules=None, merge=True):
+        normalized = []
+        for rule in rules or []:
+            if not isinstance(rule, Rule):
+                rule = normalize_rule(rule.get("protocol", "-1"), rule.get("f_port"), rule.get("t_port"),
+                                      rule.get("cidr", "0.0.0.0/0"))
+            normalized.append(rule)
+
+        self.rules = frozenset(merge_rules(normalized) if merge else normalized)
+
+    @classmethod
+    def from_permissions(cls, permissions):
+        """
+        Make RuleSet from `IpPermissions` of describe_security_groups
+        Security group and prefix list sources are not managed and left out
+
+        :param permissions: IpPermission list
+        :return: RuleSet
+        """
+        rules = []
+        for permission in permissions:
+            cidrs = [ip_range["CidrIp"] for ip_range in permission.get("IpRanges", [])] + \
+                    [ip_range["CidrIpv6"] for ip_range in permission.get("Ipv6Ranges", [])]
+            for cidr in cidrs:
+                rules.append(normalize_rule(permission["IpProtocol"], permission.get("FromPort"),
+                                            permission.get("ToPort"), cidr))
+
+        return cls(rules, merge=False)
+
+    def diff(self, current):
+        """
+        Get rules to add and revoke to make current rules these rules
+
+        :param current: RuleSet of existing group
+        :return: (add RuleSet, revoke RuleSet)
+        """
+        return RuleSet(self.rules - current.rules, merge=False), RuleSet(current.rules - self.rules, merge=False)
+
+    def to_permissions(self):
+        """
+        Make `IpPermissions` parameter
+
+        :return: IpPermission list(one per protocol and port range)
+        """
+        permissions = {}
+        for rule in sorted(self.rules, key=_sort_key):
+            key = (rule.protocol, rule.f_port, rule.t_port)
+            permission = permissions.get(key)
+            if permission is None:
+                permission = permissions[key] = {"IpProtocol": rule.protocol}
+                if rule.f_port is not None:
+                    permission.update(FromPort=rule.f_port, ToPort=rule.t_port)
+            if ipaddress.ip_network(rule.cidr).version == 6:
+                permission.setdefault("Ipv6Ranges", []).append({"CidrIpv6": rule.cidr})
+            else:
+                permission.setdefault("IpRanges", []).append({"CidrIp": rule.cidr})
+
+        return list(permissions.values())
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __iter__(self):
+        return iter(sorted(self.rules, key=_sort_key))
+
+    def __eq__(self, other):
+        return isinstance(other, RuleSet) and self.rules == other.rules
+
+    def __repr__(self):
+        return "RuleSet({})".format(list(self))
+
+
+def submit(ec2_client, group_id, direction, add=None, revoke=None):
+    """
+    Send rule changes of one direction(one authorize call, one revoke call at most)
+    New rules are authorized before old rules are revoked
+
+    :param ec2_client: boto3.client('ec2')
+    :param group_id: security group id
+    :param direction: "ingress" or "egress"
+    :param add: RuleSet to authorize
+    :param revoke: RuleSet to revoke
+    :return: number of API calls
+    """
+    _, authorize_operation, revoke_operation = OPERATIONS[direction]
+    calls = 0
+    if add:
+        getattr(ec2_client, authorize_operation)(GroupId=group_id, IpPermissions=add.to_permissions())
+        calls += 1
+    if revoke:
+        getattr(ec2_client, revoke_operation)(GroupId=group_id, IpPermissions=revoke.to_permissions())
+        calls += 1
+
+    return calls
+
+
+def sync_rules(ec2_client, group_id, ingress=None, egress=None, group=None, prune=True):
+    """
+    Make rules of security group the desired rules with only the changed rules
+
+    :param ec2_client: boto3.client('ec2')
+    :param group_id: security group id
+    :param ingress: desired inbound rule list(default: None, inbound rules are not changed)
+    :param egress: desired outbound rule list(default: None, outbound rules are not changed)
+    :param group: described group(default: None, described here with one call)
+    :param prune: revoke existing rules that are not desired
+    :return: {direction: (add RuleSet, revoke RuleSet)}
+    """
+    if group is None:
+        group = ec2_client.describe_security_groups(GroupIds=[group_id])["SecurityGroups"][0]
+
+    changes = {}
+    for direction, desired in zip(DIRECTIONS, (ingress, egress)):
+        if desired is None:
+            continue
+        current = RuleSet.from_permissions(group.get(OPERATIONS[direction][0], []))
+        add, revoke = RuleSet(desired).diff(current)
+        if not prune:
+            revoke = RuleSet()
+        submit(ec2_client, group_id, direction, add, revoke)
+        changes[direction] = (add, revoke)
+
+    return changes
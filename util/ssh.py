@@ -1,11 +1,155 @@
-import boto3
+import codecs
+import select
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from scp import SCPClient, SCPException
 import paramiko
 import time
 import sshtunnel
+from util.ssh_pool import SSHPool
+from util.session import get_resource
 from util.utils import *
 
 
+class CommandResult:
+    """
+    This class hold the result of a command on one host
+
+    Init
+        host: target host
+        exit_code: exit status of command(None if command was not run)
+        stdout: decoded standard output(last lines only when streamed by `run_parallel`)
+        stderr: decoded standard error(last lines only when streamed by `run_parallel`)
+        duration: elapsed seconds(connect + command)
+        error: exception message if connect or command failed
+    """
+    def __init__(self, host, exit_code=None, stdout="", stderr="", duration=0.0, error=None):
+        self.host = host
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None and self.exit_code == 0
+
+
+class StreamResult:
+    """
+    This class hold the result of a streamed command
+
+    Init
+        command: command string
+    """
+    def __init__(self, command):
+        self.command = command
+        self.exit_code = None
+        self.started_at = None
+        self.finished_at = None
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+
+    @property
+    def duration(self):
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+
+class _LineBuffer:
+    """Decode bytes incrementally and split complete lines(partial line is kept up to max_line)"""
+    def __init__(self, max_line):
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.max_line = max_line
+        self.partial = ""
+
+    def feed(self, data, final=False):
+        text = self.partial + self.decoder.decode(data, final=final)
+        lines = text.split("\n")
+        self.partial = lines.pop()
+        if final and self.partial:
+            lines.append(self.partial)
+            self.partial = ""
+        while len(self.partial) >= self.max_line:
+            lines.append(self.partial[:self.max_line])
+            self.partial = self.partial[self.max_line:]
+
+        return lines
+
+
+class CommandStream:
+    """
+    This class run command on remote server and iterate output lines as they arrive
+    - Iterate (stream name("stdout"|"stderr"), line) tuples
+    - Memory use is bounded by chunk_size and max_line, not by output size
+    - `result` has exit code, timestamps and byte counts after iteration
+
+    Init
+        client: paramiko.SSHClient
+        commands: command to run
+        chunk_size: bytes to read at once(default: 32KB)
+        max_line: longer lines are split(default: 64KB)
+        poll_interval: seconds to wait for new data(default: 0.5)
+    """
+    def __init__(self, client, commands, chunk_size=32768, max_line=65536, poll_interval=0.5):
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.result = StreamResult(commands)
+        self._buffers = {"stdout": _LineBuffer(max_line), "stderr": _LineBuffer(max_line)}
+
+        self.channel = client.get_transport().open_session()
+        self.result.started_at = time.time()
+        self.channel.exec_command(commands)
+
+    def _read(self, name):
+        """
+        Read one chunk of stream if data is ready
+
+        :param name: "stdout" or "stderr"
+        :return: (True if data was read, complete lines of the chunk)
+        """
+        if name == "stdout":
+            if not self.channel.recv_ready():
+                return False, []
+            data = self.channel.recv(self.chunk_size)
+            self.result.stdout_bytes += len(data)
+        else:
+            if not self.channel.recv_stderr_ready():
+                return False, []
+            data = self.channel.recv_stderr(self.chunk_size)
+            self.result.stderr_bytes += len(data)
+
+        return True, self._buffers[name].feed(data)
+
+    def __iter__(self):
+        try:
+            while True:
+                # one chunk per stream per round, a busy stdout doesn't starve stderr
+                active = False
+                for name in ("stdout", "stderr"):
+                    read, lines = self._read(name)
+                    active = active or read
+                    for line in lines:
+                        yield name, line
+                if active:
+                    continue
+                if self.channel.exit_status_ready() and not self.channel.recv_ready() \
+                        and not self.channel.recv_stderr_ready():
+                    break
+                select.select([self.channel], [], [], self.poll_interval)
+
+            for name in ("stdout", "stderr"):
+                for line in self._buffers[name].feed(b"", final=True):
+                    yield name, line
+
+            self.result.exit_code = self.channel.recv_exit_status()
+            self.result.finished_at = time.time()
+        finally:
+            self.channel.close()
+
+
 class SSHConnector:
     """
     This class have ssh connect, ssh tunneling, scp features to remote server
@@ -14,7 +158,13 @@ class SSHConnector:
        region: region
     """
     def __init__(self, region="us-east-2"):
-        self.ec2 = boto3.resource("ec2", region_name=region)
+        self.region = region
+        self.pool = None
+
+    @property
+    def ec2(self):
+        """ec2 resource of current thread(`util.session`)"""
+        return get_resource("ec2", self.region)
 
     def _ssh_connect_with_retry(self, ssh, ip_address, retries, pem_key_path, port):
         """Try ssh connect recursive if fail(3 times)"""
@@ -62,12 +212,37 @@ class SSHConnector:
             pass
 
     def command_delivery(self, commands, is_buf_over=False):
-        """Delivery command to remote server"""
-        stdin, stdout, stderr = self.ssh.exec_command(commands)
+        """
+        Delivery command to remote server
+        Output lines are printed as they arrive
+
+        :param commands: command to run
+        :param is_buf_over: True: don't wait for output(long running command like tcpdump)
+        :return: StreamResult(None if is_buf_over)
+        """
+        if is_buf_over:
+            self.ssh.exec_command(commands)
+            return None
+
+        return self.stream_command(commands, callback=lambda name, line: print(line))
+
+    def stream_command(self, commands, callback=None):
+        """
+        Run command and stream output lines
+
+        :param commands: command to run
+        :param callback: function(stream name, line) called for every line
+            None: return `CommandStream` to iterate lines yourself(`result` is set after iteration)
+        :return: StreamResult if callback is set, else CommandStream
+        """
+        stream = CommandStream(self.ssh, commands)
+        if callback is None:
+            return stream
 
-        if not is_buf_over:
-            print(stdout.read())
-            print(stderr.read())
+        for name, line in stream:
+            callback(name, line)
+
+        return stream.result
 
     def tunneling(self, host, host_port, pem_key_path,
                   remote_ip, remote_port, user="ec2-user",
@@ -82,6 +257,90 @@ class SSHConnector:
             local_bind_address=(local_ip, local_port)
     )
 
+    def connect_pool(self, pool, ip_address, user=None, pem_key_path=None):
+        """
+        Use session from `util.ssh_pool.SSHPool` as current session
+        The pool owns the session, call `release_pool` instead of closing `self.ssh`
+        """
+        self.ssh = pool.get(ip_address, user=user, pem_key_path=pem_key_path)
+        self.pool = pool
+
+    def release_pool(self):
+        """Give back current session to its `util.ssh_pool.SSHPool`"""
+        if self.pool is not None:
+            self.pool.release(self.ssh)
+            self.pool = None
+
+    def _run_on_host(self, pool, target_ip, commands, callback=None, keep_lines=200):
+        """
+        Run command on one host using pooled session
+        Output is streamed(`CommandStream`), only the last keep_lines lines per stream are kept in result
+
+        :param pool: `SSHPool`
+        :param target_ip: target ip address
+        :param commands: command to run
+        :param callback: function(host, stream name, line) called for every line(default: None)
+        :param keep_lines: lines per stream kept in result
+        :return: CommandResult
+        """
+        start = time.time()
+        result = CommandResult(host=target_ip)
+        tails = {"stdout": deque(maxlen=keep_lines), "stderr": deque(maxlen=keep_lines)}
+        try:
+            with pool.lease(target_ip) as client:
+                stream = CommandStream(client, commands)
+                for name, line in stream:
+                    tails[name].append(line)
+                    if callback is not None:
+                        callback(target_ip, name, line)
+                result.exit_code = stream.result.exit_code
+        except Exception as e:
+            result.error = "{}: {}".format(type(e).__name__, e)
+        finally:
+            result.stdout = "".join(line + "\n" for line in tails["stdout"])
+            result.stderr = "".join(line + "\n" for line in tails["stderr"])
+            result.duration = time.time() - start
+
+        return result
+
+    def run_parallel(self, target_ips, commands, pem_key_path=None, user="ec2-user", bastion_ip=None,
+                     max_workers=5, pool=None, callback=None, keep_lines=200):
+        """
+        Run command on many hosts at once
+        Sessions come from one `SSHPool`(one bastion transport, a channel per host)
+        Output is streamed line by line, long provisioning output is not held in memory
+
+        :param target_ips: target ip address list
+        :param commands: command to run on every host
+        :param pem_key_path: key pair path
+        :param user: user name on server
+        :param bastion_ip: bastion ip address for private hosts(default: None, connect directly)
+        :param max_workers: max hosts at once(protect bastion)
+        :param pool: `SSHPool` to reuse(default: None, make and close a new pool)
+        :param callback: function(host, stream name, line) called for every line as it arrives(default: None)
+        :param keep_lines: last lines per stream kept in CommandResult(default: 200)
+        :return: CommandResult list(same order as target_ips)
+        """
+        own_pool = pool is None
+        if own_pool:
+            pool = SSHPool(bastion_ip=bastion_ip, pem_key_path=pem_key_path, user=user)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool_executor:
+                return list(pool_executor.map(lambda ip: self._run_on_host(pool, ip, commands, callback, keep_lines),
+                                              target_ips))
+        finally:
+            if own_pool:
+                pool.close()
+
+    @staticmethod
+    def print_results(results):
+        """Print result table of `run_parallel`"""
+        print("{:<16} {:>5} {:>8}  {}".format("HOST", "EXIT", "TIME", "ERROR"))
+        for r in results:
+            print("{:<16} {:>5} {:>7.1f}s  {}".format(r.host, "-" if r.exit_code is None else r.exit_code,
+                                                     r.duration, r.error or ""))
+
 
 if __name__ == '__main__':
     wi = SSHConnector(region="us-east-1")
@@ -0,0 +1,185 @@
+import threading
+import time
+from contextlib import contextmanager
+import paramiko
+
+
+class SSHPool:
+    """
+    This class keep ssh sessions to remote servers and reuse them
+    - One persistent transport to the bastion
+    - Private hosts are reached by `direct-tcpip` channels over that transport(no local port)
+    - Sessions are cached by (host, user, key path) and closed after idle_timeout
+    - `get` leases the session until `release`(or use `lease`), leased sessions are never evicted
+
+    Init
+        bastion_ip: bastion ip address(default: None, connect hosts directly)
+        pem_key_path: key pair path(default key of every session)
+        user: user name on server(default: ec2-user)
+        bastion_port: bastion ssh port(default: 22)
+        idle_timeout: seconds to keep unused session(default: 300)
+        retries: connect retry count(default: 3)
+        interval: seconds between connect retries(default: 5)
+    """
+    def __init__(self, bastion_ip=None, pem_key_path="./TEST-PEM.pem", user="ec2-user",
+                 bastion_port=22, idle_timeout=300, retries=3, interval=5):
+        self.bastion_ip = bastion_ip
+        self.pem_key_path = pem_key_path
+        self.user = user
+        self.bastion_port = bastion_port
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.interval = interval
+
+        self.bastion = None
+        self.sessions = {}
+        self.last_used = {}
+        self.leases = {}
+        self._client_keys = {}
+        self._keys = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self._bastion_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _load_key(self, pem_key_path):
+        with self._lock:
+            if pem_key_path not in self._keys:
+                self._keys[pem_key_path] = paramiko.RSAKey.from_private_key_file(pem_key_path)
+            return self._keys[pem_key_path]
+
+    def _connect(self, host, port, user, pem_key_path, sock_factory=None):
+        """Connect new ssh client with retry"""
+        pri_key = self._load_key(pem_key_path)
+        for attempt in range(self.retries + 1):
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                sock = sock_factory() if sock_factory else None
+                client.connect(hostname=host, port=port, username=user, pkey=pri_key, sock=sock)
+                return client
+            except Exception:
+                client.close()
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.interval)
+
+    def _bastion_transport(self):
+        """Get bastion transport(connect or reconnect if needed)"""
+        with self._bastion_lock:
+            transport = self.bastion.get_transport() if self.bastion else None
+            if transport is None or not transport.is_active():
+                if self.bastion:
+                    self.bastion.close()
+                self.bastion = self._connect(self.bastion_ip, self.bastion_port, self.user, self.pem_key_path)
+                transport = self.bastion.get_transport()
+                transport.set_keepalive(30)
+
+            return transport
+
+    def _open_channel(self, host, port):
+        """Open direct-tcpip channel from bastion to host"""
+        return self._bastion_transport().open_channel("direct-tcpip", (host, port), ("127.0.0.1", 0))
+
+    @staticmethod
+    def _is_alive(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def get(self, host, user=None, pem_key_path=None, port=22):
+        """
+        Get ssh session to host(reuse cached session)
+
+        :param host: host ip address
+        :param user: user name on server(default: pool user)
+        :param pem_key_path: key pair path(default: pool key)
+        :param port: ssh port on host
+        :return: paramiko.SSHClient(do not close, the pool owns it, `release` it when done)
+        """
+        user = user or self.user
+        pem_key_path = pem_key_path or self.pem_key_path
+        key = (host, user, pem_key_path)
+
+        self.evict_idle()
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            client = self.sessions.get(key)
+            if client is None or not self._is_alive(client):
+                if client is not None:
+                    client.close()
+                sock_factory = None
+                if self.bastion_ip is not None:
+                    sock_factory = lambda: self._open_channel(host, port)
+                client = self._connect(host, port, user, pem_key_path, sock_factory)
+                with self._lock:
+                    self.sessions[key] = client
+                    self._client_keys[id(client)] = key
+
+            with self._lock:
+                self.last_used[key] = time.time()
+                self.leases[key] = self.leases.get(key, 0) + 1
+
+        return client
+
+    def release(self, client):
+        """
+        Give back session got from `get`(idle time starts when no lease is left)
+
+        :param client: paramiko.SSHClient from `get`
+        """
+        with self._lock:
+            key = self._client_keys.get(id(client))
+            if key is None or not self.leases.get(key):
+                return
+            self.leases[key] -= 1
+            self.last_used[key] = time.time()
+
+    @contextmanager
+    def lease(self, host, user=None, pem_key_path=None, port=22):
+        """Get ssh session to host for `with` block"""
+        client = self.get(host, user=user, pem_key_path=pem_key_path, port=port)
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def evict_idle(self):
+        """Close sessions that were not used for idle_timeout seconds(leased sessions are kept)"""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, used in self.last_used.items()
+                       if now - used > self.idle_timeout and not self.leases.get(key)]
+            clients = [self.sessions.pop(key) for key in expired if key in self.sessions]
+            for key in expired:
+                del self.last_used[key]
+                self.leases.pop(key, None)
+            for client in clients:
+                self._client_keys.pop(id(client), None)
+
+        for client in clients:
+            client.close()
+
+    def close(self):
+        """Close all sessions and bastion transport"""
+        with self._lock:
+            clients = list(self.sessions.values())
+            self.sessions.clear()
+            self.last_used.clear()
+            self.leases.clear()
+            self._client_keys.clear()
+
+        for client in clients:
+            client.close()
+
+        with self._bastion_lock:
+            if self.bastion:
+                self.bastion.close()
+                self.bastion = None
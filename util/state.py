@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+
+# resource type: (describe operation, list key, id key, filter name, alive check)
+EC2_CHECKS = {
+    "vpc": ("describe_vpcs", "Vpcs", "VpcId", "vpc-id", None),
+    "subnet": ("describe_subnets", "Subnets", "SubnetId", "subnet-id", None),
+    "internet_gateway": ("describe_internet_gateways", "InternetGateways", "InternetGatewayId",
+                         "internet-gateway-id", None),
+    "route_table": ("describe_route_tables", "RouteTables", "RouteTableId", "route-table-id", None),
+    "nat_gateway": ("describe_nat_gateways", "NatGateways", "NatGatewayId", "nat-gateway-id",
+                    lambda item: item["State"] in ("pending", "available")),
+    "security_group": ("describe_security_groups", "SecurityGroups", "GroupId", "group-id", None),
+    "instance": ("describe_instances", "Reservations", "InstanceId", "instance-id",
+                 lambda item: item["State"]["Name"] in ("pending", "running", "stopping", "stopped")),
+    "key_pair": ("describe_key_pairs", "KeyPairs", "KeyName", "key-name", None),
+}
+
+# resource type: (describe operation, list key, id key)
+ELB_CHECKS = {
+    "load_balancer": ("describe_load_balancers", "LoadBalancers", "LoadBalancerArn"),
+    "target_group": ("describe_target_groups", "TargetGroups", "TargetGroupArn"),
+}
+
+
+class BuildState:
+    """
+    This class keep created resource ids and finished steps in a local json file
+    - File is written on every step completion(write to temp file and rename)
+    - Resources are recorded by type(`vpc`, `subnet`, `instance` ...), a `type:role` key keeps roles apart
+      (ex. `subnet:public`, `subnet:private`)
+    - State of other build settings(region, VPC name, CIDR) is not reused
+    - `resumed` is True if state file existed(even with no finished step)
+
+    Init
+        path: state file path
+        config: build settings saved with state(default: None)
+    """
+    def __init__(self, path, config=None):
+        self.path = path
+        self.config = config or {}
+        self.steps = {}
+        self.resumed = os.path.exists(path)
+        self._lock = threading.Lock()
+
+        if self.resumed:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get("config") != self.config:
+                raise ValueError("state file {} is for another build: {}".format(path, data.get("config")))
+            self.steps = data.get("steps", {})
+
+    def is_done(self, step):
+        return self.steps.get(step, {}).get("done", False)
+
+    def resources(self, step):
+        """Get recorded resources of step({type: id list})"""
+        return self.steps.get(step, {}).get("resources", {})
+
+    def complete(self, step, resources=None):
+        """
+        Mark step finished and save file
+
+        :param step: step name
+        :param resources: created resources({type: id list})
+        """
+        with self._lock:
+            self.steps[step] = {"done": True, "resources": resources or {}, "finished_at": time.time()}
+            self._save()
+
+    def reset(self, steps):
+        """Mark steps not finished(recorded resources are dropped)"""
+        with self._lock:
+            for step in steps:
+                self.steps.pop(step, None)
+            self._save()
+
+    def _save(self):
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as f:
+            json.dump({"config": self.config, "steps": self.steps}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def _ids_by_type(self):
+        ids = {}
+        for step, data in self.steps.items():
+            if not data.get("done"):
+                continue
+            for key, values in data.get("resources", {}).items():
+                ids.setdefault(key.split(":")[0], set()).update(values)
+
+        return ids
+
+    def reconcile(self, ec2_client, elb_client, requires):
+        """
+        Check recorded resources still exist and reset steps that lost them
+        - One batched describe per resource type
+        - Steps that need a reset step are reset too
+
+        :param ec2_client: boto3.client('ec2')
+        :param elb_client: boto3.client('elbv2')
+        :param requires: {step name: required step names}
+        :return: reset step names
+        """
+        alive = {}
+        for resource_type, ids in self._ids_by_type().items():
+            alive[resource_type] = _existing(ec2_client, elb_client, resource_type, sorted(ids))
+
+        lost = set()
+        for step, data in self.steps.items():
+            for key, values in data.get("resources", {}).items():
+                if not set(values) <= alive.get(key.split(":")[0], set()):
+                    lost.add(step)
+
+        # dependents of a lost step are built again on top of the new resources
+        changed = True
+        while changed:
+            changed = False
+            for step, deps in requires.items():
+                if step not in lost and self.is_done(step) and any(dep in lost for dep in deps):
+                    lost.add(step)
+                    changed = True
+
+        lost = sorted(step for step in lost if self.is_done(step))
+        if lost:
+            self.reset(lost)
+
+        return lost
+
+
+def _existing(ec2_client, elb_client, resource_type, ids):
+    """Get ids that exist in AWS(one paginated describe call per type)"""
+    if resource_type in ELB_CHECKS:
+        operation, key, id_key = ELB_CHECKS[resource_type]
+        items = []
+        for page in elb_client.get_paginator(operation).paginate():
+            items.extend(page.get(key, []))
+        return set(item[id_key] for item in items) & set(ids)
+
+    operation, key, id_key, filter_name, alive = EC2_CHECKS[resource_type]
+    items = []
+    for i in range(0, len(ids), 200):
+        kwargs = {"Filters": [{"Name": filter_name, "Values": ids[i:i + 200]}]}
+        if operation == "describe_nat_gateways":
+            kwargs = {"Filter": kwargs["Filters"]}
+        if ec2_client.can_paginate(operation):
+            pages = ec2_client.get_paginator(operation).paginate(**kwargs)
+        else:
+            pages = [getattr(ec2_client, operation)(**kwargs)]
+        for page in pages:
+            page_items = page.get(key, [])
+            if key == "Reservations":
+                page_items = [instance for reservation in page_items for instance in reservation["Instances"]]
+            items.extend(page_items)
+
+    return set(item[id_key] for item in items if alive is None or alive(item))
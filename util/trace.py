@@ -0,0 +1,183 @@
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    This class is one timed phase of a trace
+    - api_calls: AWS API calls made directly in this span
+    - waiter_time: seconds spent in waiters directly in this span
+    """
+    def __init__(self, name, parent=None, kind="call"):
+        self.name = name
+        self.parent = parent
+        self.kind = kind
+        self.thread = threading.current_thread().name
+        self.thread_id = threading.get_ident()
+        self.start = time.time()
+        self.end = None
+        self.api_calls = 0
+        self.waiter_time = 0.0
+        self.error = None
+        self.children = []
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def total(self, attr):
+        """Sum of attribute in this span and all children"""
+        return getattr(self, attr) + sum(child.total(attr) for child in self.children)
+
+    def to_dict(self):
+        return {"name": self.name,
+                "kind": self.kind,
+                "thread": self.thread,
+                "start": self.start,
+                "duration": self.duration,
+                "api_calls": self.api_calls,
+                "api_calls_total": self.total("api_calls"),
+                "waiter_time": self.waiter_time,
+                "waiter_time_total": self.total("waiter_time"),
+                "error": self.error,
+                "children": [child.to_dict() for child in self.children]}
+
+
+class Tracer:
+    """
+    This class collect nested spans of a process
+    - Current span is kept in a context variable, spans nest per thread and per task
+    - Threads started with `propagate` or `submit` continue the span of the caller
+    - Export to json tree or Chrome trace event format(chrome://tracing, Perfetto)
+    """
+    def __init__(self):
+        self.roots = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, kind="call"):
+        parent = _current.get()
+        span = Span(name, parent=parent, kind=kind)
+        with self._lock:
+            (parent.children if parent is not None else self.roots).append(span)
+
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = "{}: {}".format(type(e).__name__, e)
+            raise
+        finally:
+            span.end = time.time()
+            _current.reset(token)
+            if kind == "waiter" and parent is not None:
+                with self._lock:
+                    parent.waiter_time += span.duration
+
+    def waiting(self, name):
+        """Span of a waiter, its time is added to waiter time of the parent span"""
+        return self.span(name, kind="waiter")
+
+    def record_api_call(self):
+        """Count one AWS API call on current span"""
+        span = _current.get()
+        if span is not None:
+            with self._lock:
+                span.api_calls += 1
+
+    def clear(self):
+        with self._lock:
+            self.roots = []
+
+    def to_dict(self):
+        with self._lock:
+            return {"spans": [span.to_dict() for span in self.roots]}
+
+    def to_chrome(self):
+        """
+        Convert spans to Chrome trace events(complete events, microseconds)
+
+        :return: trace event dict
+        """
+        events = []
+
+        def walk(span):
+            events.append({"name": span.name, "cat": span.kind, "ph": "X",
+                           "ts": int(span.start * 1e6), "dur": int(span.duration * 1e6),
+                           "pid": 1, "tid": span.thread_id,
+                           "args": {"api_calls": span.api_calls, "waiter_time": round(span.waiter_time, 3),
+                                    "error": span.error}})
+            for child in span.children:
+                walk(child)
+
+        with self._lock:
+            for span in self.roots:
+                walk(span)
+            threads = {span.thread_id: span.thread for span in self._all_spans()}
+        for tid, name in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}})
+
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def _all_spans(self):
+        stack = list(self.roots)
+        while stack:
+            span = stack.pop()
+            stack.extend(span.children)
+            yield span
+
+    def save(self, path):
+        """Save spans to json file"""
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def save_chrome(self, path):
+        """Save spans to Chrome trace event file"""
+        with open(path, "w") as f:
+            json.dump(self.to_chrome(), f)
+
+    def print_summary(self, max_depth=2):
+        """Print span tree(time, api calls, waiter time)"""
+        def walk(span, depth):
+            print("{:<50} {:>8.1f}s {:>6} {:>8.1f}s".format(("  " * depth + span.name)[:50], span.duration,
+                                                           span.total("api_calls"), span.total("waiter_time")))
+            if depth < max_depth:
+                for child in span.children:
+                    walk(child, depth + 1)
+
+        print("----- Trace -----")
+        print("{:<50} {:>9} {:>6} {:>9}".format("SPAN", "TIME", "CALLS", "WAITER"))
+        with self._lock:
+            roots = list(self.roots)
+        for span in roots:
+            walk(span, 0)
+
+
+def propagate(func):
+    """
+    Bind func to the current span(use with thread pools)
+    Every call runs in its own copy of the caller context
+
+    :param func: callable
+    :return: wrapped callable
+    """
+    context = contextvars.copy_context()
+
+    def wrapper(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
+
+
+def submit(pool, func, *args, **kwargs):
+    """`pool.submit` that continues the current span in the worker thread"""
+    return pool.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+# process wide tracer
+tracer = Tracer()
@@ -1,7 +1,19 @@
+import random
+import time
+from botocore.exceptions import ClientError
+from util.decorators import Trace
+from util.waiter import wait_for
+from util.cache import cache
+
 #########
 # Utils
 #########
 
+THROTTLE_ERROR_CODES = ("Throttling", "ThrottlingException", "RequestLimitExceeded",
+                        "TooManyRequestsException", "RequestThrottled")
+DEPENDENCY_ERROR_CODES = ("DependencyViolation", "ResourceInUse")
+
+@Trace()
 def add_name_tag(obj, name):
     """
     add name tag for `boto3.resource` object
@@ -12,6 +24,7 @@ def add_name_tag(obj, name):
     """
     obj.create_tags(Tags=[{"Key": "Name", "Value": name}])
 
+@Trace()
 def add_name_tag_ec2(ec2_client, instance_id, name):
     """
     add name tag for `boto3.client('ec2')` object
@@ -32,6 +45,7 @@ def add_name_tag_ec2(ec2_client, instance_id, name):
         ]
     )
 
+@Trace()
 def get_ip(ec2, instance_id, is_pub):
     """
     get ec2 instance ip address
@@ -41,10 +55,58 @@ def get_ip(ec2, instance_id, is_pub):
     :param is_pub: True: public ip address, False: private ip address
     :return: public or private ip address
     """
-    instance = ec2.Instance(id=instance_id)
-    instance.wait_until_running()
-    current_instance = list(ec2.instances.filter(InstanceIds=[instance_id]))
+    return get_ips(ec2.meta.client, [instance_id], is_pub)[0]
+
+
+@Trace()
+def get_ips(ec2_client, instance_ids, is_pub):
+    """
+    get ip addresses of many ec2 instances
+    Running instances in `util.cache.cache` are not described again
+    Other instances are waited running with one describe call per poll, the last poll has the addresses
+
+    :param ec2_client: boto3.client('ec2') object
+    :param instance_ids: target ec2 instance id list
+    :param is_pub: True: public ip address, False: private ip address
+    :return: ip address list(same order as instance_ids)
+    """
+    instances = cache.lookup(ec2_client, "instance", instance_ids)
+    pending = [instance_id for instance_id in instance_ids
+               if instances.get(instance_id, {}).get("State", {}).get("Name") != "running"]
+    if pending:
+        ready = wait_for(ec2_client, "instance_running", pending)
+        cache.put(ec2_client, "instance", ready.values())
+        instances.update(ready)
+    key = "PublicIpAddress" if is_pub else "PrivateIpAddress"
+
+    return [instances[instance_id].get(key) for instance_id in instance_ids]
 
-    if is_pub:
-        return current_instance[0].public_ip_address
-    return current_instance[0].private_ip_address
\ No newline at end of file
+def name_tag_spec(resource_type, name):
+    """
+    make `TagSpecifications` parameter to tag resource at creation time
+
+    :param resource_type: resource type(subnet, instance, security-group ...)
+    :param name: name(string)
+    :return: TagSpecifications list
+    """
+    return [{"ResourceType": resource_type, "Tags": [{"Key": "Name", "Value": name}]}]
+
+def call_with_backoff(func, *args, retries=5, base_delay=0.5, max_delay=20,
+                      error_codes=THROTTLE_ERROR_CODES, **kwargs):
+    """
+    call AWS API and retry with exponential backoff(full jitter) when throttled
+
+    :param func: boto3 function to call
+    :param retries: max retry count
+    :param base_delay: first backoff seconds
+    :param max_delay: max backoff seconds
+    :param error_codes: error codes to retry(default: throttling errors)
+    :return: func result
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in error_codes or attempt == retries:
+                raise
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
@@ -0,0 +1,186 @@
+import time
+from botocore.exceptions import ClientError, WaiterError
+from util.trace import tracer
+
+
+class WaitSpec:
+    """
+    This class describe how to poll one kind of wait
+
+    Init
+        operation: describe operation name
+        request: function(ids) -> describe kwargs
+        items_key: list key of response(ex. "Reservations", "NatGateways")
+        id_key: id key of item
+        ready: function(item) -> True if ready
+        failed: function(item) -> True if item never becomes ready
+        missing_ready: True if an id not in response is ready(deleted waits)
+        chunk: max ids per describe call
+        flatten: function(response items) -> item list(ex. instances of reservations)
+    """
+    def __init__(self, operation, request, items_key, id_key, ready, failed=None, missing_ready=False,
+                 chunk=1000, flatten=None):
+        self.operation = operation
+        self.request = request
+        self.items_key = items_key
+        self.id_key = id_key
+        self.ready = ready
+        self.failed = failed or (lambda item: False)
+        self.missing_ready = missing_ready
+        self.chunk = chunk
+        self.flatten = flatten or (lambda items: items)
+
+
+def _instances(reservations):
+    return [instance for reservation in reservations for instance in reservation["Instances"]]
+
+
+def _instance_state(item):
+    return item["State"]["Name"]
+
+
+# filters are used where possible, describe by filter doesn't fail on ids not visible yet
+WAIT_SPECS = {
+    "instance_running": WaitSpec(
+        "describe_instances",
+        lambda ids: {"Filters": [{"Name": "instance-id", "Values": ids}]},
+        "Reservations", "InstanceId",
+        ready=lambda item: _instance_state(item) == "running",
+        failed=lambda item: _instance_state(item) in ("shutting-down", "terminated", "stopping", "stopped"),
+        chunk=200, flatten=_instances),
+    "instance_terminated": WaitSpec(
+        "describe_instances",
+        lambda ids: {"Filters": [{"Name": "instance-id", "Values": ids}]},
+        "Reservations", "InstanceId",
+        ready=lambda item: _instance_state(item) == "terminated",
+        missing_ready=True, chunk=200, flatten=_instances),
+    "instance_status_ok": WaitSpec(
+        "describe_instance_status",
+        lambda ids: {"InstanceIds": ids, "IncludeAllInstances": True},
+        "InstanceStatuses", "InstanceId",
+        ready=lambda item: item["InstanceStatus"]["Status"] == "ok" and item["SystemStatus"]["Status"] == "ok",
+        failed=lambda item: item["InstanceState"]["Name"] in ("shutting-down", "terminated"),
+        chunk=100),
+    "nat_gateway_available": WaitSpec(
+        "describe_nat_gateways",
+        lambda ids: {"Filter": [{"Name": "nat-gateway-id", "Values": ids}]},
+        "NatGateways", "NatGatewayId",
+        ready=lambda item: item["State"] == "available",
+        failed=lambda item: item["State"] in ("failed", "deleting", "deleted"),
+        chunk=200),
+    "nat_gateway_deleted": WaitSpec(
+        "describe_nat_gateways",
+        lambda ids: {"Filter": [{"Name": "nat-gateway-id", "Values": ids}]},
+        "NatGateways", "NatGatewayId",
+        ready=lambda item: item["State"] in ("deleted", "failed"),
+        missing_ready=True, chunk=200),
+}
+
+
+class WaitEngine:
+    """
+    This class wait many resources of one type with batched describe calls
+    - One describe call per poll for all pending resources(chunked by the describe limit)
+    - Poll interval starts short and backs off while nothing changes
+    - Each resource is reported as soon as it is ready(`on_ready`)
+    - mode "all": return when all resources are ready, mode "first": return when any resource is ready
+    - Ids not visible yet(eventual consistency) are polled again, not failed
+
+    Init
+        client: boto3 client of the resource service
+        timeout: max seconds to wait(default: 900)
+        initial_delay: first poll interval(default: 1)
+        max_delay: longest poll interval(default: 15)
+        factor: interval multiplier when no resource became ready(default: 1.5)
+    """
+    def __init__(self, client, timeout=900, initial_delay=1, max_delay=15, factor=1.5):
+        self.client = client
+        self.timeout = timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+
+    def _describe(self, spec, ids):
+        """Describe ids with paginated, chunked calls and get {id: item}"""
+        items = {}
+        for i in range(0, len(ids), spec.chunk):
+            kwargs = spec.request(ids[i:i + spec.chunk])
+            try:
+                if self.client.can_paginate(spec.operation):
+                    pages = self.client.get_paginator(spec.operation).paginate(**kwargs)
+                else:
+                    pages = [getattr(self.client, spec.operation)(**kwargs)]
+                for page in pages:
+                    for item in spec.flatten(page.get(spec.items_key, [])):
+                        items[item[spec.id_key]] = item
+            except ClientError as e:
+                if not e.response.get("Error", {}).get("Code", "").endswith("NotFound"):
+                    raise
+
+        return items
+
+    def wait(self, name, ids, mode="all", on_ready=None):
+        """
+        Wait resources
+
+        :param name: wait name(key of WAIT_SPECS)
+        :param ids: resource id list
+        :param mode: "all" or "first"
+        :param on_ready: function(id, item) called once per ready resource(item is None if deleted)
+        :return: {id: last described item} of ready resources
+        """
+        if mode not in ("all", "first"):
+            raise ValueError("unknown wait mode: {}".format(mode))
+        spec = WAIT_SPECS[name]
+        pending = list(dict.fromkeys(ids))
+        ready = {}
+        delay = self.initial_delay
+        deadline = time.time() + self.timeout
+
+        with tracer.waiting(name):
+            while pending:
+                items = self._describe(spec, pending)
+                newly_ready = []
+                for resource_id in pending:
+                    item = items.get(resource_id)
+                    if item is None:
+                        if not spec.missing_ready:
+                            continue
+                    elif spec.failed(item):
+                        raise WaiterError(name=name, reason="{} is in failure state".format(resource_id),
+                                          last_response=item)
+                    elif not spec.ready(item):
+                        continue
+                    newly_ready.append(resource_id)
+                    ready[resource_id] = item
+                    if on_ready is not None:
+                        on_ready(resource_id, item)
+
+                pending = [resource_id for resource_id in pending if resource_id not in ready]
+                if not pending or (mode == "first" and ready):
+                    break
+                if time.time() + delay > deadline:
+                    raise WaiterError(name=name, reason="timeout after {}s, pending: {}".format(self.timeout, pending),
+                                      last_response=items)
+
+                time.sleep(delay)
+                if not newly_ready:
+                    delay = min(self.max_delay, delay * self.factor)
+
+        return ready
+
+
+def wait_for(client, name, ids, mode="all", timeout=900, on_ready=None):
+    """
+    Wait resources with default `WaitEngine`
+
+    :param client: boto3 client
+    :param name: wait name(instance_running, instance_terminated, instance_status_ok,
+                 nat_gateway_available, nat_gateway_deleted)
+    :param ids: resource id list
+    :param mode: "all" or "first"
+    :param timeout: max seconds to wait
+    :param on_ready: function(id, item) called once per ready resource
+    :return: {id: last described item} of ready resources
+    """
+    return WaitEngine(client, timeout=timeout).wait(name, ids, mode=mode, on_ready=on_ready)